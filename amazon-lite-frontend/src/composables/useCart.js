@@ -47,6 +47,31 @@ export function useCart() {
     }
   };
 
+  // 批量添加 (一次请求，返回完整购物车)
+  const addManyToCart = async (items) => {
+    if (!isLoggedIn.value) {
+      alert('请先登录企业账户');
+      router.push('/login');
+      return;
+    }
+    if (!items.length) return;
+    try {
+      loading.value = true;
+      const res = await api.post('/cart/batch', {
+        items: items.map(i => ({ variant_id: i.variantId, quantity: i.quantity, op: 'add' }))
+      });
+      cartItems.value = res.data.items;
+      if (res.data.errors.length) {
+        alert('部分规格添加失败: ' + res.data.errors.map(e => e.detail).join('; '));
+      }
+      isCartOpen.value = true;
+    } catch (e) {
+      alert('添加失败: ' + (e.response?.data?.detail || '网络错误'));
+    } finally {
+      loading.value = false;
+    }
+  };
+
   // 🟢 [新功能] 修改数量 (同步后端)
   const updateQuantity = async (itemId, newQuantity) => {
     if (!isLoggedIn.value) return;
@@ -109,6 +134,7 @@ export function useCart() {
     cartTotal,
     fetchCart,
     addToCart,
+    addManyToCart,
     updateQuantity,
     removeFromCart
   };
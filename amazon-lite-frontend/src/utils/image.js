@@ -0,0 +1,7 @@
+// src/utils/image.js
+
+// 后端 /static 下的图片可用 ?size=thumb|medium 取缩放后的 WebP；外链图片原样返回
+export function sizedImage(url, size = 'thumb') {
+  if (!url || !url.includes('/static/') || url.includes('?')) return url;
+  return `${url}?size=${size}`;
+}
@@ -0,0 +1,71 @@
+"""
+成本批量计算基准：python bench_costs.py [行数]
+
+随机生成成本记录 (结构从 300 种中抽取)，对比
+  - compute_cost         逐行单条计算 (铜重按结构缓存)
+  - 逐行缓存铜重 + 向量化  铜重逐行查 copper_weight 缓存，其余运算向量化
+  - compute_costs_batch  芯线组展平后 np.bincount 求和
+分别统计 结构重复 (缓存命中率高) 与 结构各不相同 两种数据。
+"""
+import random
+import statistics
+import sys
+import time
+
+import numpy as np
+
+import cost_engine
+from cost_engine import COST_FIELDS, compute_cost, compute_costs_batch, copper_weight, freeze_structure
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+GAUGES = [0.3, 0.5, 0.75, 1.13, 1.38, 1.78, 2.25, 2.52, 3.0]
+
+
+def random_structure():
+    return [{"cores": random.randint(1, 5), "strands": random.choice([1, 7, 19, 37]), "gauge": random.choice(GAUGES)}
+            for _ in range(random.randint(1, 3))]
+
+
+def make_rows(distinct: bool):
+    specs = [random_structure() for _ in range(300)]
+    return [(freeze_structure(random_structure() if distinct else random.choice(specs)), random.choice(["Cu", "Al"]),
+             random.choice([100.0, 200.0, 1000.0]) + (random.random() if distinct else 0.0),
+             round(random.uniform(1, 800), 3), round(random.uniform(8, 12), 4), round(random.uniform(0.5, 2), 3),
+             round(random.uniform(0, 60), 2)) for _ in range(N)]
+
+
+def memoized_batch(structures, materials, lengths, *rest):
+    """上一版实现：铜重逐行走缓存函数"""
+    original = cost_engine.copper_weights
+    cost_engine.copper_weights = lambda s, m, l: np.fromiter(map(copper_weight, s, m, l), dtype=float, count=len(s))
+    try:
+        return compute_costs_batch(structures, materials, lengths, *rest)
+    finally:
+        cost_engine.copper_weights = original
+
+
+def timed(fn, rows, rounds: int = 3):
+    samples = []
+    for _ in range(rounds):
+        copper_weight.cache_clear()
+        t0 = time.perf_counter()
+        fn(rows)
+        samples.append(time.perf_counter() - t0)
+    return statistics.median(samples)
+
+
+if __name__ == "__main__":
+    random.seed(42)
+    cases = {
+        "compute_cost": lambda rows: [compute_cost(*r) for r in rows],
+        "逐行缓存铜重 + 向量化": lambda rows: memoized_batch(*zip(*rows)),
+        "compute_costs_batch": lambda rows: compute_costs_batch(*zip(*rows)),
+    }
+    print(f"{N} 行")
+    print(f"{'实现':<24}{'结构重复':>12}{'结构各异':>12}")
+    data = {"repeated": make_rows(False), "distinct": make_rows(True)}
+    for label, fn in cases.items():
+        t_rep, t_dis = timed(fn, data["repeated"]), timed(fn, data["distinct"])
+        print(f"{label:<24}{t_rep * 1000:>9.1f} ms{t_dis * 1000:>9.1f} ms")
+    batch = compute_costs_batch(*zip(*data["distinct"]))
+    assert [{f: batch[f][i].item() for f in COST_FIELDS} for i in range(N)] == [compute_cost(*r) for r in data["distinct"]]
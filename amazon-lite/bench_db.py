@@ -0,0 +1,106 @@
+"""
+数据库配置并发读写基准：python bench_db.py [秒数]
+
+每种配置启动 PROCESSES 个子进程模拟多 worker 部署 (配置在导入 main 时读取)，每个进程同时运行
+读协程 (分页读取商品 + 规格) 与写协程 (加购物车 + 改库存，每次一个事务)，
+汇总吞吐、p95 延迟与失败数 (如 database is locked)。
+  - sqlite-default  SQLAlchemy 默认参数 (DB_TUNING=False，回滚日志模式)
+  - sqlite-wal      WAL + synchronous=NORMAL + busy_timeout + cache/mmap
+  - postgres        设置 BENCH_PG_URL=postgresql+asyncpg://... 时运行
+"""
+import os
+import sys
+import json
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+
+PROCESSES, READERS, WRITERS = 4, 4, 2
+
+
+def run_profile(mode: str, seconds: float):
+    import asyncio
+    from main import engine, AsyncSessionLocal, Base, Category, Product, ProductVariant, CartItem, User, select, selectinload, update
+
+    async def seed():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+            await conn.run_sync(Base.metadata.create_all)
+        async with AsyncSessionLocal() as db:
+            db.add(User(email="bench@example.com", hashed_password="x"))
+            cat = Category(name="Power Cable")
+            db.add(cat)
+            await db.flush()
+            for i in range(200):
+                db.add(Product(name=f"YJV-{i}", description="", price=0, is_active=True, category_id=cat.id,
+                               variants=[ProductVariant(spec=f"{i}-{j}", color="黑", price=10.0, stock=10 ** 6, unit="米") for j in range(3)]))
+            await db.commit()
+
+    async def worker(op, deadline, samples, errors):
+        while time.perf_counter() < deadline:
+            t0 = time.perf_counter()
+            try:
+                await op()
+                samples.append(time.perf_counter() - t0)
+            except Exception:
+                errors.append(1)
+
+    async def read():
+        async with AsyncSessionLocal() as db:
+            query = select(Product).options(selectinload(Product.variants)).offset(random.randrange(180)).limit(20)
+            (await db.execute(query)).scalars().all()
+
+    async def write():
+        async with AsyncSessionLocal() as db:
+            variant_id = random.randint(1, 600)
+            db.add(CartItem(user_id=1, variant_id=variant_id, quantity=1))
+            await db.execute(update(ProductVariant).where(ProductVariant.id == variant_id).values(stock=ProductVariant.stock - 1))
+            await db.commit()
+
+    async def bench():
+        deadline = time.perf_counter() + seconds
+        reads, writes, errors = [], [], []
+        await asyncio.gather(*[worker(read, deadline, reads, errors) for _ in range(READERS)],
+                             *[worker(write, deadline, writes, errors) for _ in range(WRITERS)])
+        await engine.dispose()
+        return {"reads": reads, "writes": writes, "errors": len(errors)}
+
+    if mode == "seed":
+        asyncio.run(seed())
+    else:
+        print(json.dumps(asyncio.run(bench())))
+
+
+if __name__ == "__main__":
+    if os.environ.get("BENCH_CHILD"):
+        run_profile(os.environ["BENCH_CHILD"], float(os.environ["BENCH_SECONDS"]))
+        sys.exit()
+    seconds = sys.argv[1] if len(sys.argv) > 1 else "10"
+    tmp = tempfile.mkdtemp()
+    profiles = [
+        ("sqlite-default", {"DATABASE_URL": f"sqlite+aiosqlite:///{tmp}/default.db", "DB_TUNING": "false"}),
+        ("sqlite-wal", {"DATABASE_URL": f"sqlite+aiosqlite:///{tmp}/wal.db", "DB_TUNING": "true"}),
+    ]
+    if os.environ.get("BENCH_PG_URL"):
+        profiles.append(("postgres", {"DATABASE_URL": os.environ["BENCH_PG_URL"], "DB_TUNING": "true"}))
+    print(f"{PROCESSES} 个进程 × ({READERS} 读 + {WRITERS} 写协程)，每种配置 {seconds}s")
+    print(f"{'配置':<16}{'读/秒':>10}{'写/秒':>10}{'读 p95':>12}{'写 p95':>12}{'失败':>8}")
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    p95 = lambda xs: statistics.quantiles(xs, n=20)[-1] * 1000 if len(xs) > 1 else 0.0
+    for name, env in profiles:
+        child_env = {**os.environ, **env, "BENCH_SECONDS": seconds,
+                     "SECRET_KEY": os.environ.get("SECRET_KEY", "bench"), "FIRST_SUPERUSER_PASSWORD": "bench"}
+        seed = subprocess.run([sys.executable, __file__], env={**child_env, "BENCH_CHILD": "seed"}, capture_output=True, text=True, cwd=cwd)
+        if seed.returncode != 0:
+            print(f"{name:<16}运行失败: {seed.stderr.strip().splitlines()[-1] if seed.stderr.strip() else seed.returncode}")
+            continue
+        procs = [subprocess.Popen([sys.executable, __file__], env={**child_env, "BENCH_CHILD": "run"}, stdout=subprocess.PIPE, text=True, cwd=cwd)
+                 for _ in range(PROCESSES)]
+        results = [json.loads(p.communicate()[0].strip().splitlines()[-1]) for p in procs]
+        reads = [x for r in results for x in r["reads"]]
+        writes = [x for r in results for x in r["writes"]]
+        errors = sum(r["errors"] for r in results)
+        secs = float(seconds)
+        print(f"{name:<16}{len(reads) / secs:>10.0f}{len(writes) / secs:>10.0f}{p95(reads):>9.1f} ms{p95(writes):>9.1f} ms{errors:>8}")
@@ -0,0 +1,81 @@
+"""
+列表接口响应体积/延迟基准：python bench_responses.py [商品数]
+
+在临时 SQLite 库中生成 N 个商品 (每个 3 个规格) 与 N 条成本记录，对比
+  - 序列化：旧写法 (逐行 model_validate + model_dump + 标准库 json) 与 orm_json
+  - 传输：identity / gzip / br 三种 Accept-Encoding 下的响应字节数与耗时
+"""
+import os
+import sys
+import json
+import statistics
+import tempfile
+import time
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+_db = os.path.join(tempfile.mkdtemp(), "bench.db")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{_db}"
+os.environ.setdefault("SECRET_KEY", "bench")
+os.environ.setdefault("FIRST_SUPERUSER_PASSWORD", "bench-admin")
+
+from fastapi.testclient import TestClient
+
+import main
+from main import AsyncSessionLocal, Category, Product, ProductVariant, ProductCost, ProductResponse, orm_json, select, selectinload
+
+
+async def seed():
+    async with AsyncSessionLocal() as db:
+        cat = Category(name="Power Cable")
+        db.add(cat)
+        await db.flush()
+        for i in range(N):
+            p = Product(name=f"YJV 4*{i % 240}+1*{i % 120}", description="铜芯交联聚乙烯绝缘聚氯乙烯护套电力电缆 " * 2,
+                        price=0, is_active=True, image_url=f"/static/uploads/p{i}.jpg", category_id=cat.id)
+            p.variants = [ProductVariant(spec=f"{i}-{j}", color="黑", price=12.5 + j, stock=100, unit="米", sku_code=f"SKU-{i}-{j}")
+                          for j in range(3)]
+            db.add(p)
+            db.add(ProductCost(spec_name=f"BV-{i}", category="BV", core_structure=[{"cores": 1, "strands": 7, "gauge": 1.13}],
+                               total_weight=12.3, copper_price=9.8, pvc_price=1.2, labor_cost=3, copper_weight=7.0,
+                               copper_amount=68.6, pvc_weight=5.3, pvc_amount=6.36, total_cost=77.96, reference_price=89.65))
+        await db.commit()
+
+
+async def serialization(rounds: int = 5):
+    async with AsyncSessionLocal() as db:
+        products = (await db.execute(select(Product).options(selectinload(Product.variants)).limit(N))).scalars().all()
+    legacy, fast = [], []
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        json.dumps([ProductResponse.model_validate(p).model_dump(mode="json") for p in products], ensure_ascii=False).encode()
+        legacy.append(time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        orm_json(ProductResponse, products)
+        fast.append(time.perf_counter() - t0)
+    return statistics.median(legacy), statistics.median(fast)
+
+
+def timed_get(client, url, headers, rounds: int = 10):
+    samples = []
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        r = client.get(url, headers=headers)
+        samples.append(time.perf_counter() - t0)
+        assert r.status_code == 200, r.text
+    raw = r.headers.get("content-length")
+    return int(raw) if raw else len(r.content), statistics.median(samples), r.headers.get("content-encoding", "identity")
+
+
+if __name__ == "__main__":
+    with TestClient(main.app) as client:
+        client.portal.call(seed)
+        token = client.post("/api/v1/auth/login", data={"username": main.settings.FIRST_SUPERUSER,
+                                                         "password": main.settings.FIRST_SUPERUSER_PASSWORD}).json()["access_token"]
+        legacy, fast = client.portal.call(serialization)
+        print(f"{N} 个商品序列化: 旧写法 {legacy * 1000:7.1f} ms   orm_json {fast * 1000:7.1f} ms")
+        print(f"{'接口':<32}{'编码':<10}{'字节':>12}{'中位耗时':>12}")
+        for url in (f"/api/v1/products/?limit={N}", f"/api/v1/admin/costs/?limit={N}"):
+            for accept in ("identity", "gzip", "br"):
+                headers = {"Accept-Encoding": accept, "Authorization": f"Bearer {token}"}
+                size, latency, used = timed_get(client, url, headers)
+                print(f"{url:<32}{used:<10}{size:>12,}{latency * 1000:>10.1f} ms")
@@ -0,0 +1,155 @@
+"""
+线缆成本计算引擎
+create_cost_record / update_cost_record / sync_costs_with_market 共用同一套公式：
+
+    铜重 = Σ(线径² × 股数 × 芯数 × 密度 × 长度) / 100
+    铜金额 = 铜重 × 铜单价              PVC 重 = max(0, 总重 - 铜重)
+    总成本 = 铜金额 + PVC 金额 + 人工    参考售价 = 总成本 × 1.15
+
+单条 (compute_cost) 与批量 (compute_costs_batch) 入口使用相同的运算顺序与 Python round，
+两者结果逐位一致 (见 tests/test_cost_engine.py)；性能对比见 bench_costs.py。
+"""
+import math
+from functools import lru_cache
+from itertools import chain
+from typing import Iterable, Optional, Sequence
+
+import numpy as np
+
+DENSITY = {"Cu": 0.7, "Al": 0.214}
+DEFAULT_DENSITY = DENSITY["Cu"]
+MARKUP = 1.15
+
+# 铜价加工费 (元/吨)；按顺序匹配，BVR 必须排在 BV 之前
+PROCESS_FEES = {"BVR": 1000, "BV": 200, "RVV": 700}
+SURCHARGE_RULES = (("BVR", PROCESS_FEES["BVR"]), ("RVV", PROCESS_FEES["RVV"]), ("BV", PROCESS_FEES["BV"]))
+
+COST_FIELDS = ("copper_weight", "copper_amount", "pvc_weight", "pvc_amount", "total_cost", "reference_price")
+
+# 紧凑、可哈希的芯线结构：((芯数, 股数, 线径), ...)
+CoreStructure = tuple
+
+
+def freeze_structure(groups: Iterable) -> CoreStructure:
+    """把 CoreGroup 对象或 JSON 字典列表转成可哈希的元组 (可作为缓存键)"""
+    frozen = []
+    for g in groups or ():
+        if isinstance(g, dict): frozen.append((g["cores"], g["strands"], g["gauge"]))
+        else: frozen.append((g.cores, g.strands, g.gauge))
+    return tuple(frozen)
+
+
+class CostInputError(ValueError):
+    """输入缺失或不是有限数值；rows 为 {行下标: [错误说明]} (单条计算时下标为 0)"""
+    def __init__(self, rows: dict):
+        self.rows = rows
+        super().__init__("; ".join(f"row {i}: {', '.join(errors)}" for i, errors in rows.items()))
+
+
+def input_errors(structure: CoreStructure, length, total_weight, copper_price, pvc_price, labor_cost) -> list:
+    """单行输入校验 (labor_cost 可为空，按 0 计)；批量与单条入口共用，坏行在两者中都被拒绝而不是算出 NaN"""
+    errors = []
+    for name, value in (("length", length), ("total_weight", total_weight), ("copper_price", copper_price),
+                        ("pvc_price", pvc_price), ("labor_cost", 0.0 if labor_cost is None else labor_cost)):
+        if value is None: errors.append(f"{name} is missing")
+        elif not isinstance(value, (int, float)) or not math.isfinite(value): errors.append(f"{name} is not a finite number")
+    if any(v is None or not isinstance(v, (int, float)) or not math.isfinite(v) for group in structure for v in group):
+        errors.append("core_structure has a missing or non-numeric value")
+    return errors
+
+
+def batch_input_errors(structures, lengths, total_weights, copper_prices, pvc_prices, labor_costs) -> dict:
+    """批量校验，返回 {行下标: [错误说明]}：全部为有限数值时只做一次向量检查，否则逐行找出坏行"""
+    try:
+        arrays = [np.asarray(values, dtype=float) for values in (lengths, total_weights, copper_prices, pvc_prices)]
+        arrays.append(np.fromiter((0.0 if c is None else c for c in labor_costs), dtype=float, count=len(labor_costs)))
+        arrays.append(np.fromiter(chain.from_iterable(chain.from_iterable(structures)), dtype=float))
+        if all(np.isfinite(a).all() for a in arrays): return {}
+    except (TypeError, ValueError):
+        pass  # 含 None 等无法转成 float 的值
+    rows = zip(structures, lengths, total_weights, copper_prices, pvc_prices, labor_costs)
+    return {i: errors for i, row in enumerate(rows) if (errors := input_errors(*row))}
+
+
+def density_of(material: Optional[str]) -> float:
+    return DENSITY.get(material, DEFAULT_DENSITY)
+
+
+@lru_cache(maxsize=8192)
+def copper_weight(structure: CoreStructure, material: str, length: float) -> float:
+    """未取整的铜重 (kg)，按 (结构, 材质, 长度) 缓存；逐组顺序累加，与 copper_weights 的 bincount 一致"""
+    density = density_of(material)
+    total = 0.0
+    for cores, strands, gauge in structure:
+        total += (gauge ** 2 * strands * cores * density * length) / 100.0
+    return total
+
+
+def copper_weights(structures: Sequence[CoreStructure], materials: Sequence[str], lengths: Sequence[float]) -> np.ndarray:
+    """批量未取整铜重：芯线组展平成数组一次计算，再用 np.bincount 按记录求和"""
+    n = len(structures)
+    owner = np.repeat(np.arange(n), np.fromiter(map(len, structures), dtype=np.intp, count=n))
+    groups = np.fromiter(chain.from_iterable(chain.from_iterable(structures)), dtype=float).reshape(-1, 3)
+    cores, strands, gauge = groups.T
+    density = np.fromiter((density_of(m) for m in materials), dtype=float, count=n)
+    length = np.asarray(lengths, dtype=float)
+    group_cw = (gauge ** 2 * strands * cores * density[owner] * length[owner]) / 100.0
+    return np.bincount(owner, weights=group_cw, minlength=n)
+
+
+@lru_cache(maxsize=512)
+def category_surcharge(category: Optional[str]) -> int:
+    cat_upper = category.upper() if category else ""
+    for keyword, fee in SURCHARGE_RULES:
+        if keyword in cat_upper: return fee
+    return 0
+
+
+def copper_usd_price(market_cny: float, exchange_rate: float, category: Optional[str]) -> float:
+    """沪铜 (元/吨) 折算为含加工费的美元/公斤单价"""
+    base_cny = (market_cny * 0.935) + 1500.0
+    return ((base_cny + category_surcharge(category)) / exchange_rate) / 1000.0
+
+
+def compute_cost(structure: CoreStructure, material: str, length: float, total_weight: float,
+                 copper_price: float, pvc_price: float, labor_cost: float) -> dict:
+    """单条计算，返回 COST_FIELDS 对应的取整结果；输入非法时抛出 CostInputError"""
+    errors = input_errors(structure, length, total_weight, copper_price, pvc_price, labor_cost)
+    if errors: raise CostInputError({0: errors})
+    total_cw = copper_weight(structure, material, length)
+    cw = round(total_cw, 4)
+    ca = round(total_cw * copper_price, 2)
+    pw = max(0.0, round(total_weight - total_cw, 4))
+    pa = round(pw * pvc_price, 2)
+    tc = round(ca + pa + (labor_cost or 0.0), 2)
+    return {"copper_weight": cw, "copper_amount": ca, "pvc_weight": pw, "pvc_amount": pa,
+            "total_cost": tc, "reference_price": round(tc * MARKUP, 2)}
+
+
+def _round_array(values: np.ndarray, ndigits: int) -> np.ndarray:
+    """逐元素使用 Python round (np.round 在 .5 边界上可能与 round 差一位)"""
+    return np.fromiter((round(v, ndigits) for v in values.tolist()), dtype=float, count=len(values))
+
+
+def compute_costs_batch(structures: Sequence[CoreStructure], materials: Sequence[str], lengths: Sequence[float],
+                        total_weights: Sequence[float], copper_prices: Sequence[float],
+                        pvc_prices: Sequence[float], labor_costs: Sequence[float]) -> dict:
+    """
+    批量计算，返回 {字段: ndarray}；铜重由 copper_weights 向量化计算，取整仍逐元素用 Python round。
+    任一行输入非法时抛出 CostInputError (列出全部坏行)，调用方应先用 input_errors 过滤并上报。
+    """
+    bad = batch_input_errors(structures, lengths, total_weights, copper_prices, pvc_prices, labor_costs)
+    if bad: raise CostInputError(bad)
+    total_cw = copper_weights(structures, materials, lengths)
+    copper_prices = np.asarray(copper_prices, dtype=float)
+    total_weights = np.asarray(total_weights, dtype=float)
+    pvc_prices = np.asarray(pvc_prices, dtype=float)
+    labor = np.asarray([c or 0.0 for c in labor_costs], dtype=float)
+
+    cw = _round_array(total_cw, 4)
+    ca = _round_array(total_cw * copper_prices, 2)
+    pw = np.maximum(0.0, _round_array(total_weights - total_cw, 4))
+    pa = _round_array(pw * pvc_prices, 2)
+    tc = _round_array(ca + pa + labor, 2)
+    return dict(zip(COST_FIELDS, (cw, ca, pw, pa, tc, _round_array(tc * MARKUP, 2))))
+
@@ -0,0 +1,30 @@
+"""
+图片处理：缩略图与响应式尺寸变体，统一输出 WebP。
+在独立进程池中执行 (CPU 密集，且 Pillow 解码大图时会长时间持有 GIL)。
+任务函数放在这个轻量模块中，子进程反序列化任务时只需导入这里；但 spawn 子进程启动时
+仍会重新导入父进程的 __main__：以 `python main.py` 启动时即整个 main.py (作为 __mp_main__，
+不执行 `if __name__ == "__main__"` 块)，以 `uvicorn main:app` 启动时则是 uvicorn 的入口脚本。
+
+Pillow 为可选依赖：未安装时 AVAILABLE 为 False，调用方应跳过生成并直接使用原图。
+"""
+import os
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+AVAILABLE = Image is not None
+
+
+def make_webp(src: str, dst: str, max_side: int, quality: int = 80) -> int:
+    """把 src 等比缩放到长边不超过 max_side 并保存为 WebP，返回输出文件字节数"""
+    with Image.open(src) as im:
+        im = ImageOps.exif_transpose(im)  # 手机照片按 EXIF 方向摆正
+        if im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGBA" if "transparency" in im.info else "RGB")
+        im.thumbnail((max_side, max_side))
+        tmp = f"{dst}.{os.getpid()}.tmp"
+        im.save(tmp, "WEBP", quality=quality, method=4)
+    os.replace(tmp, dst)  # 原子替换，读者不会看到写了一半的文件
+    return os.path.getsize(dst)
@@ -1,33 +1,67 @@
 import os
-import shutil
+import hashlib
+import multiprocessing
 import enum
-import requests
+import json
+import time
+import asyncio
+import uuid
+import base64
+import httpx
 import magic  # pip install python-magic (Windows需安装 python-magic-bin)
 import uvicorn
 import bcrypt
-from datetime import datetime, timedelta
-from typing import List, Optional, Any
+import csv
+import io
+import openpyxl
+import gzip
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Any, Literal, Union
+from collections import OrderedDict, deque
+from itertools import islice
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from contextlib import asynccontextmanager
 
 # FastAPI & Pydantic
-from fastapi import FastAPI, APIRouter, Depends, HTTPException, status, UploadFile, File, Query
+from fastapi import FastAPI, APIRouter, Depends, HTTPException, status, UploadFile, File, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, StreamingResponse, FileResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.staticfiles import NotModifiedResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError, TypeAdapter
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 # SQLAlchemy & AsyncIO
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker, declarative_base, relationship, backref, selectinload, joinedload
-from sqlalchemy import Boolean, Column, Integer, String, Float, DateTime, ForeignKey, Text, Enum, JSON, select, or_, cast, desc, delete
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, sessionmaker, declarative_base, relationship, backref, selectinload, joinedload, aliased
+from sqlalchemy import Boolean, Column, Integer, String, Float, DateTime, ForeignKey, Text, Enum, JSON, Index, select, or_, and_, cast, desc, delete, insert, case, exists, text, update, func, event, inspect, bindparam
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm.attributes import set_committed_value
+
+# 成本计算引擎 / 图片处理
+import cost_engine
+import imaging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # JWT
-from jose import JWTError, jwt
+from jose import ExpiredSignatureError, JWTError, jwt
 
 # Scheduler
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 # ==========================================
 # 1. 配置 (Config)
@@ -35,6 +69,19 @@ from apscheduler.schedulers.background import BackgroundScheduler
 class Settings(BaseSettings):
     # 数据库配置
     DATABASE_URL: str = "sqlite+aiosqlite:///./amazon_cable.db"
+    DB_TUNING: bool = True  # 按方言应用下方连接参数；False 时使用 SQLAlchemy 默认配置 (基准对比用)
+    # SQLite：WAL 下读写互不阻塞，synchronous=NORMAL 在 WAL 中只在检查点 fsync
+    SQLITE_JOURNAL_MODE: str = "WAL"
+    SQLITE_SYNCHRONOUS: str = "NORMAL"
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000  # 写锁被占用时的等待时间，超时报 database is locked
+    SQLITE_CACHE_SIZE_KB: int = 65536  # 每个连接的页缓存
+    SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024
+    # PostgreSQL (postgresql+asyncpg://...，需另行安装 asyncpg)
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: int = 30  # 等待空闲连接的秒数
+    DB_POOL_RECYCLE: int = 1800  # 连接最长复用秒数，避免被服务端/防火墙静默断开
+    DB_STATEMENT_CACHE_SIZE: int = 500  # asyncpg 预编译语句缓存；经 PgBouncer 事务池连接时设为 0
 
     # 从 .env 读取，若无则使用默认值（仅限开发环境）
     
@@ -56,6 +103,71 @@ class Settings(BaseSettings):
     SINA_API_URL: str = "http://hq.sinajs.cn/list=nf_CU0"
     EXCHANGE_RATE_API: str = "https://api.exchangerate-api.com/v4/latest/USD"
 
+    # 行情抓取 (超时 / 重试退避 / 熔断 / 汇率缓存)
+    MARKET_SINA_TIMEOUT: float = 5.0
+    MARKET_FX_TIMEOUT: float = 5.0
+    MARKET_RETRIES: int = 2  # 失败后的重试次数，间隔按 MARKET_BACKOFF_SECONDS 指数增长
+    MARKET_BACKOFF_SECONDS: float = 0.5
+    MARKET_BREAKER_THRESHOLD: int = 3  # 连续失败次数达到后熔断
+    MARKET_BREAKER_COOLDOWN: int = 300  # 熔断持续秒数
+    MARKET_FX_TTL_SECONDS: int = 21600  # 汇率缓存 6 小时
+    PRICE_CACHE_MAX_AGE: int = 300  # /meta/prices 的浏览器缓存秒数
+
+    # SSE 推送 (/api/v1/stream)
+    STREAM_MAX_CONNECTIONS: int = 500
+    STREAM_QUEUE_SIZE: int = 100  # 单个客户端积压超过该条数即断开 (慢消费者)
+    STREAM_HEARTBEAT_SECONDS: int = 15
+    STREAM_AUTH_CONCURRENCY: int = 5  # 同时查库鉴权的 SSE 连接数上限，须小于 DB_POOL_SIZE (推送期间不占用连接)
+
+    # 缓存配置
+    CATALOG_CACHE_SIZE: int = 128  # 商品列表缓存的查询组合上限 (LRU)
+    DASHBOARD_COUNTERS: bool = True  # 是否维护订单/询价状态计数表 (看板 O(1) 读取)
+    TOKEN_BLOCKLIST_POLL_SECONDS: int = 5  # 多 worker 间同步已注销 token 与商品目录缓存版本的轮询间隔
+    TOKEN_BLOCKLIST_POLL_OVERLAP: int = 100  # 每次轮询回看的 id 数量 (id 在提交前分配，小 id 可能晚于大 id 提交)
+    TOKEN_BLOCKLIST_PRUNE_SECONDS: int = 3600  # 清理已过期黑名单记录的间隔
+    AUTH_CACHE_TTL_SECONDS: int = 30  # 鉴权缓存 (token 解析结果 / 用户快照) 的有效期
+    AUTH_CACHE_SIZE: int = 4096
+
+    # 密码哈希 (bcrypt 在线程池中执行，避免阻塞事件循环)
+    BCRYPT_ROUNDS: int = 12
+    PASSWORD_HASH_WORKERS: int = 4  # 同时进行的哈希/校验上限
+    PASSWORD_HASH_QUEUE_TIMEOUT: float = 5.0  # 排队超过该秒数返回 503
+    PASSWORD_REHASH_ON_LOGIN: bool = False  # 登录成功且 cost 与 BCRYPT_ROUNDS 不一致时自动重新哈希
+
+    # 库存预留 (下单即占用库存，待确认订单超时后自动释放)
+    RESERVATION_TTL_MINUTES: int = 1440
+    RESERVATION_SWEEP_SECONDS: int = 60
+
+    # 司机定位 (内存缓冲，定时合并写库)
+    LOCATION_FLUSH_SECONDS: int = 5  # 每个订单在一个周期内只写入最后一次位置
+    LOCATION_HISTORY_SIZE: int = 20  # 每个司机保留的最近定位点数
+    LOCATION_ACTIVE_SECONDS: int = 300  # 超过该秒数未上报的司机不再视为在线
+    LOCATION_ASSIGNMENT_TTL_SECONDS: int = 30  # 订单归属缓存的有效期；多 worker 部署下改派/结单最迟在该时间后生效
+
+    # 公开物流追踪 (/orders/track/{id} 与 WebSocket 推送)
+    TRACK_CACHE_SECONDS: int = 5  # 轮询接口的快照缓存时间
+    TRACK_REFRESH_SECONDS: int = 15  # 有观看者的订单按该间隔兜底刷新 (覆盖其他 worker 的变更)
+    TRACK_WS_PER_IP: int = 20
+    TRACK_WS_MAX_CONNECTIONS: int = 2000
+
+    # 图片上传 (内容寻址存储 + 后台缩略图)
+    UPLOAD_MAX_BYTES: int = 5 * 1024 * 1024
+    UPLOAD_CHUNK_BYTES: int = 256 * 1024
+    THUMBNAIL_MAX_SIDE: int = 320
+    IMAGE_WORKERS: int = 2  # 图片处理进程数
+
+    # 静态文件 (/static)
+    STATIC_MAX_AGE: int = 3600  # 非内容哈希命名文件的浏览器缓存秒数 (过期后以 ETag 协商)
+    IMAGE_MEDIUM_MAX_SIDE: int = 960  # ?size=medium 的长边像素 (?size=thumb 使用 THUMBNAIL_MAX_SIDE)
+    IMAGE_CACHE_MAX_BYTES: int = 512 * 1024 * 1024  # 尺寸变体磁盘缓存上限，超出后淘汰最久未用的文件
+
+    # 响应压缩 (按 Accept-Encoding 协商 br / gzip)
+    COMPRESS_MIN_BYTES: int = 1024  # 小于该字节数的响应不压缩，0 表示关闭压缩
+
+    # 批量导入 (CSV / XLSX)
+    IMPORT_CHUNK_SIZE: int = 500  # 每块读取/写入的行数，同时决定单次事务大小
+    IMPORT_MAX_ERRORS: int = 1000  # 错误报告最多返回的行数
+
     model_config = SettingsConfigDict(
         env_file=".env", 
         case_sensitive=True,
@@ -67,17 +179,48 @@ settings = Settings()
 # 全局路径配置
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 STATIC_DIR = os.path.join(BASE_DIR, "static")
+IMAGE_CACHE_DIR = os.path.join(BASE_DIR, "cache", "images")
 
 # ==========================================
 # 2. 数据库 (Database)
 # ==========================================
-connect_args = {"check_same_thread": False} if "sqlite" in settings.DATABASE_URL else {}
+def engine_options(url: str) -> dict:
+    """按方言组装 create_async_engine 参数 (SQLite 的 PRAGMA 在连接建立时由 apply_sqlite_pragmas 设置)"""
+    url = make_url(url)
+    if url.get_backend_name() == "sqlite":
+        return {"url": url, "connect_args": {"check_same_thread": False}}
+    if not settings.DB_TUNING:
+        return {"url": url}
+    options = {
+        "url": url, "pool_size": settings.DB_POOL_SIZE, "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_timeout": settings.DB_POOL_TIMEOUT, "pool_recycle": settings.DB_POOL_RECYCLE, "pool_pre_ping": True,
+    }
+    if url.get_driver_name() == "asyncpg":
+        # asyncpg 自身的语句缓存 + SQLAlchemy 适配层的预编译缓存，两者需同时关闭才能兼容 PgBouncer
+        options["url"] = url.update_query_dict({"prepared_statement_cache_size": str(settings.DB_STATEMENT_CACHE_SIZE)})
+        options["connect_args"] = {
+            "statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE,
+            "server_settings": {"application_name": "amazon-cable", "jit": "off"},  # 短查询为主，JIT 编译得不偿失
+        }
+    return options
 
-engine = create_async_engine(
-    settings.DATABASE_URL,
-    echo=False,
-    connect_args=connect_args,
-)
+engine = create_async_engine(echo=False, **engine_options(settings.DATABASE_URL))
+
+def sqlite_pragmas() -> list:
+    return [
+        f"PRAGMA journal_mode={settings.SQLITE_JOURNAL_MODE}",
+        f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}",
+        f"PRAGMA busy_timeout={settings.SQLITE_BUSY_TIMEOUT_MS}",
+        f"PRAGMA cache_size=-{settings.SQLITE_CACHE_SIZE_KB}",
+        f"PRAGMA mmap_size={settings.SQLITE_MMAP_SIZE}",
+    ]
+
+if engine.dialect.name == "sqlite" and settings.DB_TUNING:
+    @event.listens_for(engine.sync_engine, "connect")
+    def apply_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in sqlite_pragmas(): cursor.execute(pragma)
+        cursor.close()
 
 AsyncSessionLocal = sessionmaker(
     bind=engine,
@@ -89,6 +232,19 @@ AsyncSessionLocal = sessionmaker(
 
 Base = declarative_base()
 
+def ensure_columns(conn):
+    """create_all 不会改动已有表：为已存在的表补齐模型中新增的 (可空) 列及索引"""
+    insp = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        if not insp.has_table(table.name): continue
+        existing = {c["name"] for c in insp.get_columns(table.name)}
+        missing = [col for col in table.columns if col.name not in existing]
+        for col in missing:
+            conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {col.name} {col.type.compile(dialect=conn.dialect)}"))
+        indexed = {i["name"] for i in insp.get_indexes(table.name)}
+        for idx in table.indexes:
+            if idx.name not in indexed: idx.create(conn, checkfirst=True)
+
 # ==========================================
 # 3. 模型定义 (Models)
 # ==========================================
@@ -106,6 +262,12 @@ class OrderStatus(str, enum.Enum):
     COMPLETED = "completed"
     CANCELLED = "cancelled"
 
+class LedgerKind(str, enum.Enum):
+    RESERVE = "reserve"  # 下单预留
+    COMMIT = "commit"  # 确认订单，实际扣减库存
+    RELEASE = "release"  # 取消或超时，释放预留
+    RESTOCK = "restock"  # 已扣减订单作废，库存返还
+
 class InquiryStatus(str, enum.Enum):
     PENDING = "pending"
     QUOTED = "quoted"
@@ -136,12 +298,14 @@ class TokenBlocklist(Base):
     id = Column(Integer, primary_key=True, index=True)
     token = Column(String, unique=True, index=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=True, index=True)  # token 自身的 exp，过期后可删除
 
 class Category(Base):
     __tablename__ = "categories"
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, index=True)
     parent_id = Column(Integer, ForeignKey("categories.id"), nullable=True)
+    path = Column(String, index=True, nullable=True)  # 祖先路径 "/1/4/9/" (含自身)，前缀匹配即为整棵子树
     products = relationship("Product", back_populates="category")
     children = relationship("Category", backref=backref("parent", remote_side=[id]))
 
@@ -153,11 +317,15 @@ class Product(Base):
     price = Column(Float)
     is_active = Column(Boolean, default=True)
     image_url = Column(String, nullable=True)
-    category_id = Column(Integer, ForeignKey("categories.id"))
+    category_id = Column(Integer, ForeignKey("categories.id"), index=True)
     cost_id = Column(Integer, ForeignKey("product_costs.id"), nullable=True) # 关联成本
 
     category = relationship("Category", back_populates="products")
-    variants = relationship("ProductVariant", back_populates="product", cascade="all, delete-orphan")
+    # 仅加载未软删除的变体 (已删除变体保留行，避免购物车/询价中的 variant_id 悬空)
+    variants = relationship(
+        "ProductVariant", back_populates="product", cascade="all, delete-orphan",
+        primaryjoin="and_(Product.id == ProductVariant.product_id, ProductVariant.deleted_at.is_(None))",
+    )
     cost_source = relationship("ProductCost")
 
 class ProductVariant(Base):
@@ -172,6 +340,8 @@ class ProductVariant(Base):
     sku_code = Column(String, nullable=True)
     copper_weight = Column(Float, default=0.0)
     process_cost = Column(Float, default=0.0)
+    deleted_at = Column(DateTime, nullable=True, index=True)  # 软删除时间
+    reserved = Column(Integer, default=0)  # 待确认订单占用的数量，可用量 = stock - reserved
 
     product = relationship("Product", back_populates="variants")
     cart_items = relationship("CartItem", back_populates="variant")
@@ -193,6 +363,7 @@ class Order(Base):
     driver_lat = Column(Float, nullable=True)
     driver_lng = Column(Float, nullable=True)
     delivery_photo_url = Column(String, nullable=True)
+    delivery_photo_thumb_url = Column(String, nullable=True)  # 后台生成的 WebP 缩略图
     status = Column(Enum(OrderStatus), default=OrderStatus.PENDING_CONFIRMATION)
     original_total_price = Column(Float, default=0.0)
     final_total_price = Column(Float, default=0.0)
@@ -299,6 +470,33 @@ class ProductCost(Base):
     # 🟢 [新增] 标记是否已转为商品
     is_converted = Column(Boolean, default=False)
 
+class CacheVersion(Base):
+    """进程内缓存的共享版本号：任一 worker 写入后递增，其他 worker 轮询到变化即清空本地缓存"""
+    __tablename__ = "cache_versions"
+    name = Column(String, primary_key=True)  # catalog
+    version = Column(Integer, default=0, nullable=False)
+
+class StatusCounter(Base):
+    """订单/询价按状态的计数与金额汇总 (看板用，随状态流转在同一事务内更新)"""
+    __tablename__ = "status_counters"
+    scope = Column(String, primary_key=True)  # order / inquiry
+    status = Column(String, primary_key=True)
+    count = Column(Integer, default=0, nullable=False)
+    amount = Column(Float, default=0.0, nullable=False)
+
+class InventoryLedger(Base):
+    """库存流水 (只追加)；ProductVariant.reserved 为其中未结预留的汇总，可随时由流水重建"""
+    __tablename__ = "inventory_ledger"
+    id = Column(Integer, primary_key=True, index=True)
+    variant_id = Column(Integer, ForeignKey("product_variants.id"), index=True, nullable=False)
+    order_id = Column(Integer, ForeignKey("orders.id"), nullable=True)
+    kind = Column(Enum(LedgerKind), nullable=False)
+    quantity = Column(Integer, nullable=False)
+    expires_at = Column(DateTime, nullable=True, index=True)  # 仅预留记录
+    created_at = Column(DateTime, default=datetime.utcnow)
+    # 每个订单的每个规格每种流水至多一条，并发重复结清时由唯一约束拦截
+    __table_args__ = (Index("ix_inventory_ledger_order_variant_kind", "order_id", "variant_id", "kind", unique=True),)
+
 # ==========================================
 # 4. Schemas (Pydantic)
 # ==========================================
@@ -357,13 +555,16 @@ class ProductBase(BaseModel):
 class ProductCreate(ProductBase):
     variants: List[ProductVariantCreate] = []
 
+class ProductVariantUpsert(ProductVariantCreate):
+    id: Optional[int] = None  # 已有变体的 id；缺省时按 sku_code 匹配
+
 class ProductUpdate(BaseModel):
     name: Optional[str] = None
     description: Optional[str] = None
     image_url: Optional[str] = None
     category_id: Optional[int] = None
     has_variants: Optional[bool] = None
-    variants: Optional[List[ProductVariantCreate]] = None
+    variants: Optional[List[ProductVariantUpsert]] = None
     unit: Optional[str] = None
 
 class ProductResponse(ProductBase):
@@ -373,6 +574,21 @@ class ProductResponse(ProductBase):
     class Config:
         from_attributes = True
 
+class VariantAvailability(BaseModel):
+    variant_id: int
+    stock: int
+    reserved: int
+    available: int
+
+class VariantChangeSummary(BaseModel):
+    inserted: List[int] = []
+    updated: List[int] = []
+    deleted: List[int] = []
+    unchanged: int = 0
+
+class ProductUpdateResponse(ProductResponse):
+    changes: Optional[VariantChangeSummary] = None
+
 # User
 class UserBase(BaseModel):
     email: str
@@ -418,6 +634,20 @@ class Token(BaseModel):
 class TokenData(BaseModel):
     email: Optional[str] = None
 
+class Principal(BaseModel):
+    """当前登录用户的只读快照 (鉴权缓存用，不绑定数据库会话)"""
+    id: int
+    email: str
+    username: Optional[str] = None
+    company_name: Optional[str] = None
+    role: str
+    is_admin: bool = False
+    is_active: bool = True
+    discount_rate: Optional[float] = 0.0
+    class Config:
+        from_attributes = True
+        frozen = True
+
 # Cart
 class CartItemCreate(BaseModel):
     variant_id: int
@@ -441,6 +671,23 @@ class CartItemResponse(BaseModel):
     class Config:
         from_attributes = True
 
+class CartBatchOp(BaseModel):
+    variant_id: Optional[int] = None
+    sku_code: Optional[str] = None  # 未提供 variant_id 时按 SKU 匹配
+    quantity: int = 0
+    op: Literal["add", "set", "remove"] = "add"  # add 累加 / set 设为该数量 (0 删除) / remove 删除；add/set 的负数记入 errors
+
+class CartBatchRequest(BaseModel):
+    items: List[CartBatchOp]
+
+class CartBatchError(BaseModel):
+    index: int
+    detail: str
+
+class CartBatchResponse(BaseModel):
+    items: List[CartItemResponse] = []
+    errors: List[CartBatchError] = []
+
 # Order
 class OrderItemResponse(BaseModel):
     id: int
@@ -464,6 +711,7 @@ class OrderResponse(BaseModel):
     driver_lat: Optional[float] = None
     driver_lng: Optional[float] = None
     delivery_photo_url: Optional[str] = None
+    delivery_photo_thumb_url: Optional[str] = None
     status: OrderStatusEnum
     original_total_price: float
     final_total_price: float
@@ -475,6 +723,19 @@ class OrderResponse(BaseModel):
 class DriverLocationUpdate(BaseModel):
     lat: float
     lng: float
+    recorded_at: Optional[datetime] = None  # 设备定位时间，缺省为服务器接收时间
+
+class DriverLocationBatch(BaseModel):
+    fixes: List[DriverLocationUpdate]
+    order_ids: List[int] = []  # 仅 /orders/driver/location 使用：本次位置同步到哪些配送中的订单
+
+class DriverPosition(BaseModel):
+    driver_id: int
+    lat: float
+    lng: float
+    recorded_at: datetime
+    order_ids: List[int] = []
+    history: Optional[List[DriverLocationUpdate]] = None
 
 class AssignDriverRequest(BaseModel):
     driver_id: int
@@ -651,9 +912,36 @@ def verify_password(plain_password: str, hashed_password: str):
 
 def get_password_hash(password: str):
     pwd_bytes = password.encode('utf-8')
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=settings.BCRYPT_ROUNDS)
     return bcrypt.hashpw(pwd_bytes, salt).decode('utf-8')
 
+def password_needs_rehash(hashed_password: str) -> bool:
+    """哈希格式 $2b$<cost>$...，cost 与当前配置不同则需要重新哈希"""
+    try:
+        return int(hashed_password.split("$")[2]) != settings.BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return False
+
+# bcrypt 计算期间释放 GIL，放进线程池即可并行且不阻塞事件循环
+password_executor = ThreadPoolExecutor(max_workers=settings.PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+password_slots = asyncio.Semaphore(settings.PASSWORD_HASH_WORKERS)
+
+async def run_password_job(fn, *args):
+    try:
+        await asyncio.wait_for(password_slots.acquire(), settings.PASSWORD_HASH_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="Server busy, please retry", headers={"Retry-After": "1"})
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_executor, fn, *args)
+    finally:
+        password_slots.release()
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await run_password_job(verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password: str) -> str:
+    return await run_password_job(get_password_hash, password)
+
 async def get_db():
     async with AsyncSessionLocal() as session:
         try:
@@ -665,50 +953,89 @@ async def get_user_by_email(db: AsyncSession, email: str):
     result = await db.execute(select(User).filter(User.email == email))
     return result.scalars().first()
 
-async def is_token_revoked(db: AsyncSession, token: str) -> bool:
-    result = await db.execute(select(TokenBlocklist).filter(TokenBlocklist.token == token))
-    return result.scalars().first() is not None
+def is_token_revoked(token: str) -> bool:
+    return token in revoked_tokens
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)) -> Principal:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    if await is_token_revoked(db, token):
+    if is_token_revoked(token):
         raise HTTPException(status_code=401, detail="Token has been revoked", headers={"WWW-Authenticate": "Bearer"})
-    try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None: raise credentials_exception
-    except JWTError: raise credentials_exception
-    
-    user = await get_user_by_email(db, email=email)
-    if user is None: raise credentials_exception
-    if not user.is_active: raise HTTPException(status_code=400, detail="Inactive user")
-    return user
-
-async def get_current_active_superuser(current_user: User = Depends(get_current_user)) -> User:
+    email = token_claims_cache.get(token)
+    if email is None:
+        try:
+            payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+            email: str = payload.get("sub")
+            if email is None: raise credentials_exception
+        except JWTError: raise credentials_exception
+        # 缓存不得超过 token 自身的有效期
+        ttl = payload["exp"] - time.time() if "exp" in payload else None
+        token_claims_cache.put(token, email, ttl)
+
+    principal = principal_cache.get(email)
+    if principal is None:
+        user = await get_user_by_email(db, email=email)
+        if user is None: raise credentials_exception
+        principal = Principal.model_validate(user)
+        principal_cache.put(email, principal)
+    if not principal.is_active: raise HTTPException(status_code=400, detail="Inactive user")
+    return principal
+
+async def get_current_active_superuser(current_user: Principal = Depends(get_current_user)) -> Principal:
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Admin privileges required")
     return current_user
 
-async def validate_image_security(file: UploadFile):
-    MAX_FILE_SIZE = 5 * 1024 * 1024
-    ALLOWED_MIMES = ["image/jpeg", "image/png", "image/webp"]
-    header = await file.read(2048)
-    await file.seek(0)
+IMAGE_EXTENSIONS = {"image/jpeg": "jpg", "image/png": "png", "image/webp": "webp"}
+
+def sniff_image_type(header: bytes) -> str:
+    """按文件头识别图片类型 (不信任客户端的文件名/Content-Type)"""
     if not header: raise HTTPException(status_code=400, detail="Empty file")
     try:
         mime_type = magic.from_buffer(header, mime=True)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"File analysis failed: {str(e)}")
-    if mime_type not in ALLOWED_MIMES:
+    if mime_type not in IMAGE_EXTENSIONS:
         raise HTTPException(status_code=400, detail=f"Invalid file type: {mime_type}")
-    await file.seek(0, 2)
-    file_size = file.file.tell()
-    await file.seek(0)
-    if file_size > MAX_FILE_SIZE: raise HTTPException(status_code=400, detail="File too large")
+    return mime_type
+
+def encode_cursor(ts: Optional[datetime], row_id: int) -> str:
+    """游标分页：把 (时间戳, id) 编码为不透明字符串；时间戳可为空 (旧数据或只按 id 分页)"""
+    raw = json.dumps([ts.isoformat() if ts else None, row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple[Optional[datetime], int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        ts, row_id = json.loads(raw)
+        return (datetime.fromisoformat(ts) if ts is not None else None), int(row_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def apply_keyset(query, ts_col, id_col, after: Optional[str]):
+    """
+    按 (ts_col, id_col) 倒序排列，时间戳为空的行排在最后；传入 after 时从该游标之后继续 (seek，而非 OFFSET)。
+    ts_col 必须是写入后不再变化的列，否则记录被修改后会在翻页中重复或丢失；ts_col=None 时只按 id 分页。
+    """
+    if ts_col is None:
+        query = query.order_by(desc(id_col))
+        if after: query = query.filter(id_col < decode_cursor(after)[1])
+        return query
+    query = query.order_by(desc(ts_col).nulls_last(), desc(id_col))
+    if after:
+        ts, row_id = decode_cursor(after)
+        if ts is None: query = query.filter(ts_col.is_(None), id_col < row_id)
+        else: query = query.filter(or_(ts_col < ts, and_(ts_col == ts, id_col < row_id), ts_col.is_(None)))
+    return query
+
+def set_next_cursor(response: Response, rows, ts_attr: Optional[str], limit: int):
+    """整页返回时通过 X-Next-Cursor 头给出下一页游标 (列表响应结构保持不变)"""
+    if rows and len(rows) >= limit:
+        last = rows[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor(getattr(last, ts_attr) if ts_attr else None, last.id)
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
@@ -716,6 +1043,14 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
 
+def get_token_expiry(token: str) -> Optional[datetime]:
+    """读取 token 的 exp (不校验签名，仅用于黑名单过期清理)"""
+    try:
+        exp = jwt.get_unverified_claims(token).get("exp")
+        return datetime.utcfromtimestamp(exp) if exp else None
+    except JWTError:
+        return None
+
 # ==========================================
 # 6. CRUD 逻辑集合
 # ==========================================
@@ -723,150 +1058,1693 @@ async def get_cart_items(db: AsyncSession, user_id: int):
     query = select(CartItem).options(joinedload(CartItem.variant).joinedload(ProductVariant.product)).filter(CartItem.user_id == user_id)
     return (await db.execute(query)).scalars().all()
 
+async def price_cart(db: AsyncSession, user_id: int):
+    """一次 JOIN 查询取出购物车各行的规格与商品信息 (跳过已下架/软删除的规格)"""
+    query = (
+        select(
+            CartItem.id, CartItem.quantity, ProductVariant.id.label("variant_id"), ProductVariant.spec, ProductVariant.color,
+            ProductVariant.unit, ProductVariant.price, Product.id.label("product_id"), Product.name, Product.image_url,
+        )
+        .join(ProductVariant, CartItem.variant_id == ProductVariant.id)
+        .join(Product, ProductVariant.product_id == Product.id)
+        .where(CartItem.user_id == user_id, ProductVariant.deleted_at.is_(None))
+        .order_by(CartItem.id)
+    )
+    return (await db.execute(query)).all()
+
 async def create_order_from_cart(db: AsyncSession, user_id: int, discount_rate: float):
-    cart_items = await get_cart_items(db, user_id)
-    if not cart_items: return None
-    original_total = 0.0
-    order_items_data = []
-    
-    for item in cart_items:
-        variant = item.variant
-        product = variant.product
-        subtotal = variant.price * item.quantity
-        original_total += subtotal
-        
-        order_items_data.append({
-            "product_id": product.id, 
-            "variant_id": variant.id, # 🟢 关键：记录规格ID
-            "product_name": product.name, 
-            "product_image": product.image_url,
-            "product_spec": variant.spec, 
-            "product_color": variant.color, 
-            "product_unit": variant.unit,
-            "unit_price": variant.price, 
-            "quantity": item.quantity, 
-            "subtotal": subtotal
-        })
-        
+    """
+    下单：购物车计价 -> 预留库存 -> 订单头 INSERT ... RETURNING -> 明细多行 INSERT -> 清空购物车，
+    全部在同一事务内完成，响应由手头数据直接构造，不再回查。
+    """
+    lines = await price_cart(db, user_id)
+    if not lines: return None
+    order_items_data = [{
+        "product_id": line.product_id,
+        "variant_id": line.variant_id, # 🟢 关键：记录规格ID
+        "product_name": line.name,
+        "product_image": line.image_url,
+        "product_spec": line.spec,
+        "product_color": line.color,
+        "product_unit": line.unit,
+        "unit_price": line.price,
+        "quantity": line.quantity,
+        "subtotal": line.price * line.quantity,
+    } for line in lines]
+    original_total = sum(d["subtotal"] for d in order_items_data)
     final_total = round(original_total * (1 - discount_rate), 2)
-    db_order = Order(
-        user_id=user_id, 
-        status=OrderStatus.PENDING_CONFIRMATION, 
-        original_total_price=original_total, 
-        final_total_price=final_total
-    )
-    db.add(db_order)
-    await db.flush()
-    
+
+    # 预留库存：可用量不足时整单回滚
+    quantities = {}
     for item_data in order_items_data:
-        db.add(OrderItem(order_id=db_order.id, **item_data))
-        
+        quantities[item_data["variant_id"]] = quantities.get(item_data["variant_id"], 0) + item_data["quantity"]
+    short = await reserve_stock(db, quantities)
+    if short:
+        await db.rollback()
+        names = [f"{d['product_name']} ({d['product_spec']})" for d in order_items_data if d["variant_id"] in short]
+        raise HTTPException(status_code=400, detail=f"库存不足: {', '.join(dict.fromkeys(names))}")
+
+    header = {
+        "user_id": user_id, "status": OrderStatus.PENDING_CONFIRMATION, "created_at": datetime.utcnow(),
+        "original_total_price": original_total, "final_total_price": final_total,
+    }
+    order_id = (await db.execute(insert(Order.__table__).values(header).returning(Order.__table__.c.id))).scalar_one()
+    item_ids = (await db.execute(
+        insert(OrderItem.__table__).returning(OrderItem.__table__.c.id, sort_by_parameter_order=True),
+        [{"order_id": order_id, **d} for d in order_items_data],
+    )).scalars().all()
+    expires_at = datetime.utcnow() + timedelta(minutes=settings.RESERVATION_TTL_MINUTES)
+    await write_ledger(db, LedgerKind.RESERVE, order_id, quantities, expires_at)
+    # Core INSERT 不经过 before_flush，看板计数在此同步累加
+    if settings.DASHBOARD_COUNTERS:
+        for stmt in counter_updates({("order", OrderStatus.PENDING_CONFIRMATION.value): (1, final_total)}): await db.execute(stmt)
     await db.execute(delete(CartItem).where(CartItem.user_id == user_id))
     await db.commit()
-    await db.refresh(db_order)
-    return await get_order_by_id(db, db_order.id)
+
+    return OrderResponse(
+        id=order_id, **header,
+        items=[OrderItemResponse(id=item_id, **d) for item_id, d in zip(item_ids, order_items_data)],
+    )
 
 async def get_order_by_id(db: AsyncSession, order_id: int):
     query = select(Order).options(joinedload(Order.items), joinedload(Order.user), joinedload(Order.driver)).filter(Order.id == order_id)
     return (await db.execute(query)).unique().scalars().first()
 
 async def create_inquiry_from_cart(db: AsyncSession, user_id: int, user_remark: str = None):
-    cart_items = await get_cart_items(db, user_id)
-    if not cart_items: return None
-    db_inquiry = Inquiry(user_id=user_id, status=InquiryStatus.PENDING, user_remark=user_remark)
-    db.add(db_inquiry)
-    await db.flush()
-    for item in cart_items:
-        db.add(InquiryItem(inquiry_id=db_inquiry.id, variant_id=item.variant.id, product_name=item.variant.product.name,
-                           product_spec=item.variant.spec, product_color=item.variant.color, quantity=item.quantity))
+    """询价：与下单相同的批量路径 (不预留库存)"""
+    lines = await price_cart(db, user_id)
+    if not lines: return None
+    now = datetime.utcnow()
+    header = {"user_id": user_id, "status": InquiryStatus.PENDING, "user_remark": user_remark, "created_at": now, "updated_at": now}
+    inquiry_id = (await db.execute(insert(Inquiry.__table__).values(header).returning(Inquiry.__table__.c.id))).scalar_one()
+    items_data = [{
+        "variant_id": line.variant_id, "product_name": line.name, "product_spec": line.spec,
+        "product_color": line.color, "quantity": line.quantity,
+    } for line in lines]
+    item_ids = (await db.execute(
+        insert(InquiryItem.__table__).returning(InquiryItem.__table__.c.id, sort_by_parameter_order=True),
+        [{"inquiry_id": inquiry_id, **d} for d in items_data],
+    )).scalars().all()
+    if settings.DASHBOARD_COUNTERS:
+        for stmt in counter_updates({("inquiry", InquiryStatus.PENDING.value): (1, 0.0)}): await db.execute(stmt)
     await db.execute(delete(CartItem).where(CartItem.user_id == user_id))
     await db.commit()
-    return await get_inquiry_by_id(db, db_inquiry.id)
+
+    return InquiryResponse(
+        id=inquiry_id, **header,
+        items=[InquiryItemResponse(id=item_id, **d) for item_id, d in zip(item_ids, items_data)],
+    )
 
 async def get_inquiry_by_id(db: AsyncSession, inquiry_id: int):
     query = select(Inquiry).options(joinedload(Inquiry.items), joinedload(Inquiry.user)).filter(Inquiry.id == inquiry_id)
     return (await db.execute(query)).unique().scalars().first()
 
 # ==========================================
-# 7. 定时任务 & 爬虫 (Tasks)
+# 6.1 缓存 (Caches)
 # ==========================================
-def get_realtime_copper_prices():
-    print("🕷️ 正在从新浪财经获取数据...", end=" ")
-    sina_url = settings.SINA_API_URL
-    headers = {"Referer": "https://finance.sina.com.cn/"}
-    cny_price = 0.0
-    try:
-        resp = requests.get(sina_url, headers=headers, timeout=5)
-        if resp.status_code == 200:
-            data_str = resp.text.split('"')[1]
-            data_list = data_str.split(',')
-            if len(data_list) > 8: cny_price = float(data_list[8])
-    except Exception as e:
-        print(f"\n❌ 新浪接口报错: {e}")
-        return None
-    
-    usd_to_cny_rate = 7.07
+class CatalogCache:
+    """
+    商品列表缓存：按查询参数 (category_id, include_descendants, search, skip, limit) 做 LRU，
+    任何商品/分类/库存写操作调用 invalidate() 递增目录版本号并清空缓存。
+    ETag 由 进程标识 + 版本号 组成，重启后不会与旧 ETag 撞车。缓存值为已编码的 JSON bytes，命中时直接发送。
+    多 worker 部署时由 sync() 随黑名单轮询把本进程的失效写入 cache_versions，并应用其他 worker 的失效，
+    因此别的 worker 上的写操作最迟约两个轮询周期后生效。
+    """
+    NAME = "catalog"
+
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self.version = 0
+        self.shared_version: Optional[int] = None  # 上次从 cache_versions 读到的版本号
+        self._unpublished = False
+        self._epoch = uuid.uuid4().hex[:8]
+        self._entries: OrderedDict = OrderedDict()
+
+    @property
+    def etag(self) -> str:
+        return f'W/"catalog-{self._epoch}-{self.version}"'
+
+    def get(self, key):
+        if key not in self._entries: return None
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, publish: bool = True):
+        self.version += 1
+        self._entries.clear()
+        if publish: self._unpublished = True  # 下次 sync 时通知其他 worker
+
+    async def sync(self, db: AsyncSession):
+        """发布本进程的失效 (版本号 +1)，并在其他 worker 递增过版本号时清空本地缓存"""
+        table = CacheVersion.__table__
+        shared = (await db.execute(select(table.c.version).where(table.c.name == self.NAME))).scalar()
+        if shared is None:
+            try:
+                await db.execute(insert(table).values(name=self.NAME, version=0))
+                await db.commit()
+            except IntegrityError:
+                await db.rollback()  # 其他 worker 已创建
+            shared = (await db.execute(select(table.c.version).where(table.c.name == self.NAME))).scalar_one()
+        if shared != self.shared_version:
+            if self.shared_version is not None: self.invalidate(publish=False)
+            self.shared_version = shared
+        if self._unpublished:
+            self._unpublished = False
+            try:
+                bumped = (await db.execute(
+                    update(table).where(table.c.name == self.NAME).values(version=table.c.version + 1).returning(table.c.version)
+                )).scalar_one()
+                await db.commit()
+            except Exception:
+                self._unpublished = True
+                raise
+            # 期间没有其他 worker 递增时，这次变化就是自己的，不必再清空一次
+            if bumped == self.shared_version + 1: self.shared_version = bumped
+
+catalog_cache = CatalogCache(settings.CATALOG_CACHE_SIZE)
+
+def subtree_range(path: str):
+    """子树路径区间 [path, path 末尾 "/" 换成 "0")：'/' 与 '0' 相邻，区间内恰好是以 path 开头的路径 (可走索引)"""
+    return path, path[:-1] + "0"
+
+class CategoryIndex:
+    """
+    分类树快照：一次查询组装出嵌套树与 id -> 节点映射，按目录版本号缓存；
+    分类写操作调用 catalog_cache.invalidate() 后下一次访问重新加载。
+    """
+    def __init__(self):
+        self.version = None
+        self.roots: list = []
+        self.nodes: dict = {}  # id -> {"id", "name", "parent_id", "path", "children"}
+        self.tree_json = b"[]"
+
+    async def load(self, db: AsyncSession) -> "CategoryIndex":
+        if self.version == catalog_cache.version: return self
+        version = catalog_cache.version
+        rows = (await db.execute(select(Category.id, Category.name, Category.parent_id, Category.path).order_by(Category.id))).all()
+        nodes = {r.id: {"id": r.id, "name": r.name, "parent_id": r.parent_id, "path": r.path, "children": []} for r in rows}
+        roots = []
+        for node in nodes.values():
+            if node["parent_id"] is None: roots.append(node)
+            elif parent := nodes.get(node["parent_id"]): parent["children"].append(node)
+        tree = lambda n: {"id": n["id"], "name": n["name"], "parent_id": n["parent_id"], "children": [tree(c) for c in n["children"]]}
+        self.roots, self.nodes, self.tree_json = roots, nodes, dump_json([tree(n) for n in roots])
+        self.version = version
+        return self
+
+    def subtree_filter(self, category_id: int):
+        """Product 的子树过滤条件：category_id IN (路径前缀落在该分类子树内的分类)"""
+        node = self.nodes.get(category_id)
+        if node is None or not node["path"]: return Product.category_id == category_id
+        low, high = subtree_range(node["path"])
+        return Product.category_id.in_(select(Category.id).where(Category.path >= low, Category.path < high))
+
+category_index = CategoryIndex()
+
+async def rebuild_category_paths(db: AsyncSession):
+    """按 parent_id 重算全部分类的祖先路径，只写入有变化的行 (启动时执行；补齐旧数据)"""
+    rows = (await db.execute(select(Category.id, Category.parent_id, Category.path))).all()
+    parents = {r.id: r.parent_id for r in rows}
+    paths = {}
+    def path_of(cid):
+        if cid not in paths:
+            chain, cur = [], cid
+            while cur is not None and cur in parents and cur not in chain and cur not in paths:
+                chain.append(cur)
+                cur = parents[cur]
+            prefix = paths.get(cur, "/")
+            for c in reversed(chain):
+                prefix = paths[c] = f"{prefix}{c}/"
+        return paths[cid]
+    stale = [{"_id": r.id, "path": path_of(r.id)} for r in rows if r.path != path_of(r.id)]
+    if stale:
+        table = Category.__table__
+        await db.execute(update(table).where(table.c.id == bindparam("_id")).values(path=bindparam("path")), stale)
+        await db.commit()
+        catalog_cache.invalidate()
+
+class TTLCache:
+    """带过期时间的 LRU 缓存 (单条目可指定更短的 ttl)"""
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None: return None
+        value, expires = entry
+        if expires <= time.monotonic():
+            self._entries.pop(key, None)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0: return
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+# token -> email (省去重复的 JWT 验签)；email -> Principal (省去每次请求查用户)
+token_claims_cache = TTLCache(settings.AUTH_CACHE_SIZE, settings.AUTH_CACHE_TTL_SECONDS)
+principal_cache = TTLCache(settings.AUTH_CACHE_SIZE, settings.AUTH_CACHE_TTL_SECONDS)
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_principal(mapper, connection, target):
+    """用户资料/状态/折扣变更时清除快照；提交后再清一次，避免提交前被并发请求按旧数据回填"""
+    emails = {target.email, *inspect(target).attrs.email.history.deleted}
+    for email in emails: principal_cache.pop(email)
+    session = Session.object_session(target)
+    if session is not None: session.info.setdefault("stale_principals", set()).update(emails)
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_principal_after_commit(session):
+    for email in session.info.pop("stale_principals", ()): principal_cache.pop(email)
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """判断 If-None-Match 是否命中当前 ETag (支持逗号分隔与 *)"""
+    header = request.headers.get("if-none-match")
+    if not header: return False
+    candidates = [t.strip() for t in header.split(",")]
+    return "*" in candidates or etag in candidates or etag.removeprefix("W/") in candidates
+
+# ==========================================
+# 6.2 全文检索 (Full-text Search)
+# ==========================================
+# fts 表名: (源表, 索引列)。trigram 分词支持任意子串匹配 (含中文与 "4*70+1*35" 这类规格)
+FTS_TABLES = {
+    "products_fts": ("products", ("name", "description")),
+    "product_variants_fts": ("product_variants", ("spec", "sku_code")),
+    "product_costs_fts": ("product_costs", ("spec_name", "remark")),
+    "technical_specs_fts": ("technical_specs", ("model", "feature")),
+}
+
+class SearchIndex:
+    """
+    SQLite FTS5 索引 (external content + 触发器同步)，按 bm25 排序。
+    非 SQLite 或 FTS5/trigram 不可用时 enabled=False，调用方回退到 LIKE。
+    """
+    def __init__(self):
+        self.enabled = False
+
+    def setup(self, conn):
+        """在 lifespan 中通过 run_sync 调用；首次建表时对已有数据做一次 rebuild"""
+        if conn.dialect.name != "sqlite": return
+        try:
+            for fts, (table, cols) in FTS_TABLES.items():
+                exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = :n"), {"n": fts}).first()
+                col_list = ", ".join(cols)
+                new_vals = ", ".join(f"new.{c}" for c in cols)
+                old_vals = ", ".join(f"old.{c}" for c in cols)
+                conn.execute(text(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({col_list}, content='{table}', content_rowid='id', tokenize='trigram')"))
+                conn.execute(text(f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN "
+                                  f"INSERT INTO {fts}(rowid, {col_list}) VALUES (new.id, {new_vals}); END"))
+                conn.execute(text(f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN "
+                                  f"INSERT INTO {fts}({fts}, rowid, {col_list}) VALUES ('delete', old.id, {old_vals}); END"))
+                # 只在索引列变化时重建索引行 (成本同步等批量改价不会触发)
+                conn.execute(text(f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {col_list} ON {table} BEGIN "
+                                  f"INSERT INTO {fts}({fts}, rowid, {col_list}) VALUES ('delete', old.id, {old_vals}); "
+                                  f"INSERT INTO {fts}(rowid, {col_list}) VALUES (new.id, {new_vals}); END"))
+                if not exists:
+                    conn.execute(text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
+            self.enabled = True
+        except OperationalError as e:
+            print(f"⚠️ FTS5 不可用，搜索回退到 LIKE: {e}")
+
+    @staticmethod
+    def to_match(term: str) -> Optional[str]:
+        """转成 FTS5 短语查询；trigram 至少需要 3 个字符，过短返回 None"""
+        term = term.strip()
+        if len(term) < 3: return None
+        return '"' + term.replace('"', '""') + '"'
+
+    def ranking(self, fts: str, term: str):
+        """返回 (id, score) 子查询，score 越小越相关；不可用时返回 None"""
+        match = self.to_match(term) if self.enabled else None
+        if match is None: return None
+        stmt = text(f"SELECT rowid AS id, bm25({fts}) AS score FROM {fts} WHERE {fts} MATCH :q")
+        return stmt.bindparams(q=match).columns(id=Integer, score=Float).subquery(f"{fts}_rank")
+
+    def product_ranking(self, term: str):
+        """商品名称/描述 与 变体规格/SKU 的合并排名 (按商品取最佳分，已删除的规格不参与)"""
+        match = self.to_match(term) if self.enabled else None
+        if match is None: return None
+        stmt = text(
+            "SELECT id, MIN(score) AS score FROM ("
+            " SELECT rowid AS id, bm25(products_fts) AS score FROM products_fts WHERE products_fts MATCH :q"
+            " UNION ALL"
+            " SELECT v.product_id AS id, bm25(product_variants_fts) AS score FROM product_variants_fts"
+            " JOIN product_variants v ON v.id = product_variants_fts.rowid"
+            " WHERE product_variants_fts MATCH :q AND v.deleted_at IS NULL"
+            ") GROUP BY id"
+        )
+        return stmt.bindparams(q=match).columns(id=Integer, score=Float).subquery("product_rank")
+
+search_index = SearchIndex()
+
+def product_search_filter(term: str):
+    """LIKE 回退条件，覆盖与 FTS 相同的字段"""
+    return or_(
+        Product.name.contains(term), Product.description.contains(term),
+        Product.variants.any(or_(ProductVariant.spec.contains(term), ProductVariant.sku_code.contains(term))),
+    )
+
+# ==========================================
+# 6.3 看板计数器 (Dashboard Counters)
+# ==========================================
+COUNTER_SCOPES = {
+    # scope: (模型, 状态枚举, 默认状态, 金额字段)
+    "order": (Order, OrderStatus, OrderStatus.PENDING_CONFIRMATION, "final_total_price"),
+    "inquiry": (Inquiry, InquiryStatus, InquiryStatus.PENDING, None),
+}
+
+def _status_value(value) -> str:
+    return value.value if isinstance(value, enum.Enum) else str(value)
+
+async def rebuild_status_counters(db: AsyncSession):
+    """用 GROUP BY 重建计数表 (启动时执行一次，修正任何漂移)"""
+    await db.execute(delete(StatusCounter))
+    for scope, (model, status_enum, _, amount_field) in COUNTER_SCOPES.items():
+        amount_col = func.coalesce(func.sum(getattr(model, amount_field)), 0.0) if amount_field else func.sum(0.0)
+        rows = (await db.execute(select(model.status, func.count(), amount_col).group_by(model.status))).all()
+        totals = {_status_value(st): (cnt, amt or 0.0) for st, cnt, amt in rows}
+        for st in status_enum:
+            cnt, amt = totals.get(st.value, (0, 0.0))
+            db.add(StatusCounter(scope=scope, status=st.value, count=cnt, amount=amt))
+    await db.commit()
+
+@event.listens_for(Session, "before_flush")
+def _track_status_counters(session, flush_context, instances):
+    """在 flush 前根据 Order/Inquiry 的新增、状态/金额变化、删除计算增量，随同一事务写入计数表"""
+    if not settings.DASHBOARD_COUNTERS: return
+    deltas = {}
+
+    def add(scope, st, n, amt):
+        key = (scope, _status_value(st))
+        cnt, total = deltas.get(key, (0, 0.0))
+        deltas[key] = (cnt + n, total + amt)
+
+    for scope, (model, _, default_status, amount_field) in COUNTER_SCOPES.items():
+        amount_of = lambda obj: (getattr(obj, amount_field) or 0.0) if amount_field else 0.0
+        for obj in session.new:
+            if isinstance(obj, model): add(scope, obj.status or default_status, 1, amount_of(obj))
+        for obj in session.deleted:
+            if isinstance(obj, model): add(scope, obj.status or default_status, -1, -amount_of(obj))
+        for obj in session.dirty:
+            if not isinstance(obj, model) or obj in session.deleted: continue
+            state = inspect(obj)
+            st_hist = state.attrs.status.history
+            old_amount = new_amount = amount_of(obj)
+            if amount_field:
+                amt_hist = state.attrs[amount_field].history
+                if amt_hist.deleted: old_amount = amt_hist.deleted[0] or 0.0
+            if st_hist.deleted:
+                add(scope, st_hist.deleted[0], -1, -old_amount)
+                add(scope, obj.status, 1, new_amount)
+            elif new_amount != old_amount:
+                add(scope, obj.status, 0, new_amount - old_amount)
+
+    if not deltas: return
+    conn = session.connection()
+    for stmt in counter_updates(deltas): conn.execute(stmt)
+
+def counter_updates(deltas: dict):
+    """{(scope, status): (数量增量, 金额增量)} -> UPDATE 语句"""
+    for (scope, st), (cnt, amt) in deltas.items():
+        if cnt == 0 and amt == 0: continue
+        yield (
+            update(StatusCounter)
+            .where(StatusCounter.scope == scope, StatusCounter.status == st)
+            .values(count=StatusCounter.count + cnt, amount=StatusCounter.amount + amt)
+        )
+
+def resolve_stats_range(period: Optional[str], start: Optional[datetime], end: Optional[datetime]):
+    """period: month=本月, 30d=近30天；显式传入的 start/end 优先"""
+    now = datetime.utcnow()
+    if period == "month": start = start or now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    elif period == "30d": start = start or now - timedelta(days=30)
+    elif period: raise HTTPException(status_code=400, detail="period must be 'month' or '30d'")
+    return start, end
+
+# ==========================================
+# 6.4 Token 黑名单 (Revoked Tokens)
+# ==========================================
+class RevokedTokenSet:
+    """
+    已注销 token 的内存集合 (token -> exp)，鉴权时不再查库。
+    启动时全量加载；之后按 id 递增轮询 token_blocklist 同步其他 worker 的注销，
+    并定期删除已过期的记录 (过期 token 本身已无法通过 JWT 校验)。
+    PostgreSQL 的序列在提交前分配 id，较小的 id 可能晚提交，因此每次轮询回看 overlap 个 id (add 是幂等的)。
+    """
+    def __init__(self, overlap: int = 100):
+        self._tokens: dict[str, Optional[datetime]] = {}
+        self.last_id = 0
+        self.overlap = overlap
+
+    def __contains__(self, token: str) -> bool:
+        return token in self._tokens
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def add(self, token: str, expires_at: Optional[datetime]):
+        self._tokens[token] = expires_at
+
+    async def load(self, db: AsyncSession):
+        """全量加载；旧记录缺少 expires_at 时从 token 中补齐，无法读出 exp 的记录 (无法通过校验的 token) 直接删除"""
+        rows = (await db.execute(select(TokenBlocklist))).scalars().all()
+        for row in rows:
+            if row.expires_at is None: row.expires_at = get_token_expiry(row.token)
+        for row in rows:
+            if row.expires_at is None: await db.delete(row)
+        rows = [row for row in rows if row.expires_at is not None]
+        await db.commit()
+        self._tokens = {}
+        for row in rows: self.add(row.token, row.expires_at)
+        self.last_id = max((row.id for row in rows), default=0)
+        self.prune_memory()
+
+    async def poll(self, db: AsyncSession):
+        """增量同步：读取 id 大于 (上次位置 - overlap) 的记录，补上晚提交的小 id"""
+        res = await db.execute(
+            select(TokenBlocklist.id, TokenBlocklist.token, TokenBlocklist.expires_at)
+            .filter(TokenBlocklist.id > self.last_id - self.overlap).order_by(TokenBlocklist.id)
+        )
+        for row_id, token, expires_at in res.all():
+            self.add(token, expires_at)
+            self.last_id = max(self.last_id, row_id)
+
+    def prune_memory(self):
+        now = datetime.utcnow()
+        self._tokens = {t: exp for t, exp in self._tokens.items() if exp is None or exp > now}
+
+    async def prune(self, db: AsyncSession) -> int:
+        res = await db.execute(delete(TokenBlocklist).where(TokenBlocklist.expires_at < datetime.utcnow()))
+        await db.commit()
+        self.prune_memory()
+        return res.rowcount
+
+revoked_tokens = RevokedTokenSet(settings.TOKEN_BLOCKLIST_POLL_OVERLAP)
+
+# ==========================================
+# 6.5 实时推送 (Event Hub)
+# ==========================================
+class Subscription:
+    """一个 SSE 连接的订阅：关注的 topic 及可见范围 (本人/指定订单/管理员全部)"""
+    def __init__(self, topics: set, user_id: Optional[int] = None, is_admin: bool = False, order_id: Optional[int] = None):
+        self.topics = topics
+        self.user_id = user_id
+        self.is_admin = is_admin
+        self.order_id = order_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=settings.STREAM_QUEUE_SIZE)
+
+    def accepts(self, topic: str, data: dict) -> bool:
+        if topic not in self.topics: return False
+        if topic != "orders": return True
+        if self.order_id is not None and data.get("order_id") != self.order_id: return False
+        return self.is_admin or self.user_id in (data.get("user_id"), data.get("driver_id"))
+
+class EventHub:
+    """进程内发布/订阅：publish 不阻塞，队列写满的订阅者直接断开 (客户端会自动重连)"""
+    def __init__(self, max_subscribers: int):
+        self.max_subscribers = max_subscribers
+        self._subs: set[Subscription] = set()
+
+    def subscribe(self, sub: Subscription) -> Subscription:
+        if len(self._subs) >= self.max_subscribers:
+            raise HTTPException(status_code=503, detail="Too many stream connections", headers={"Retry-After": "30"})
+        self._subs.add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        self._subs.discard(sub)
+
+    def publish(self, topic: str, data: dict):
+        for sub in list(self._subs):
+            if not sub.accepts(topic, data): continue
+            try:
+                sub.queue.put_nowait((topic, data))
+            except asyncio.QueueFull:
+                self._drop(sub)
+
+    def _drop(self, sub: Subscription):
+        self.unsubscribe(sub)
+        while not sub.queue.empty(): sub.queue.get_nowait()
+        sub.queue.put_nowait(None)  # 通知该连接结束
+
+event_hub = EventHub(settings.STREAM_MAX_CONNECTIONS)
+# 大量客户端同时重连时，鉴权查库最多占用这么多连接，给普通请求留出连接池
+stream_auth_slots = asyncio.Semaphore(max(1, min(settings.STREAM_AUTH_CONCURRENCY, settings.DB_POOL_SIZE - 1)))
+
+async def authenticate_stream(token: str) -> Principal:
+    """SSE 只在建立连接时鉴权：用短会话查完即归还连接，长连接本身不持有数据库连接"""
+    async with stream_auth_slots:
+        async with AsyncSessionLocal() as db:
+            return await get_current_user(token, db)
+
+def publish_order_event(order: Order):
+    tracking.notify(order.id)
+    event_hub.publish("orders", {
+        "order_id": order.id, "user_id": order.user_id, "driver_id": order.driver_id,
+        "status": _status_value(order.status), "delivery_photo_url": order.delivery_photo_url,
+    })
+
+# ==========================================
+# 6.6 批量导入 (Bulk Import)
+# ==========================================
+def _import_cell(value):
+    if isinstance(value, str):
+        value = value.strip()
+        return value or None
+    return value
+
+def open_import_rows(upload: UploadFile):
+    """
+    打开上传的 CSV / XLSX，校验表头后返回逐行迭代器 (行号, {列名: 值})。
+    XLSX 使用 openpyxl 只读模式流式解析；空行跳过。
+    """
+    name = (upload.filename or "").lower()
+    upload.file.seek(0)
+    if name.endswith(".csv"):
+        stream = io.TextIOWrapper(upload.file, encoding="utf-8-sig", newline="")
+        rows, close = csv.reader(stream), stream.detach
+    elif name.endswith(".xlsx"):
+        try:
+            workbook = openpyxl.load_workbook(upload.file, read_only=True, data_only=True)
+        except Exception:
+            raise HTTPException(status_code=400, detail="无法解析 XLSX 文件")
+        rows, close = workbook.active.iter_rows(values_only=True), workbook.close
+    else:
+        raise HTTPException(status_code=400, detail="仅支持 .csv / .xlsx 文件")
+
+    header = next(rows, None)
+    keys = [str(h).strip().lower() if h is not None else None for h in header or ()]
+    if not any(keys):
+        close()
+        raise HTTPException(status_code=400, detail="文件缺少表头")
+
+    def iterate():
+        try:
+            for line_no, values in enumerate(rows, start=2):
+                record = {k: _import_cell(v) for k, v in zip(keys, values) if k}
+                record = {k: v for k, v in record.items() if v is not None}
+                if record: yield line_no, record
+        finally:
+            close()
+    return iterate()
+
+async def iter_import_chunks(rows, size: int):
+    """在线程池中按块读取 (解析 XLSX 是 CPU 密集操作，避免阻塞事件循环)"""
+    while True:
+        chunk = await run_in_threadpool(lambda: list(islice(rows, size)))
+        if not chunk: return
+        yield chunk
+
+def parse_core_structure(value):
+    """芯线结构：JSON 数组，或简写 "芯数*股数*线径"，多组以 + 连接，如 3*7*1.13+1*7*0.85"""
+    if not isinstance(value, str): return value
     try:
-        rate_resp = requests.get(settings.EXCHANGE_RATE_API, timeout=5)
-        if rate_resp.status_code == 200:
-            usd_to_cny_rate = rate_resp.json().get("rates", {}).get("CNY", 7.07)
-    except: pass
-    
-    usd_price = cny_price / usd_to_cny_rate if cny_price > 0 else 0.0
-    print(f"✅ 获取成功: ¥{cny_price}")
-    return {
-        "CNY": {"source": "沪铜连续", "symbol": "¥", "price": round(cny_price, 2), "change": 0.0},
-        "USD": {"source": f"折算 (1:{usd_to_cny_rate:.2f})", "symbol": "$", "price": round(usd_price, 2), "change": 0.0},
-        "exchange_rate": round(usd_to_cny_rate, 4),
-        "updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if value.startswith("["): return json.loads(value)
+        groups = []
+        for part in value.replace("×", "*").replace("x", "*").replace("X", "*").split("+"):
+            cores, strands, gauge = (p.strip() for p in part.split("*"))
+            groups.append({"cores": int(cores), "strands": int(strands), "gauge": float(gauge)})
+        return groups
+    except ValueError:
+        raise ValueError(f"core_structure: 无法解析 {value!r}")
+
+class ImportReport:
+    """导入结果统计与逐行错误 (错误条数超过上限后只计数)"""
+    def __init__(self, max_errors: int):
+        self.max_errors = max_errors
+        self.started = time.perf_counter()
+        self.total = self.inserted = self.updated = self.failed = 0
+        self.errors = []
+
+    def fail(self, line_no: int, exc: Exception):
+        self.failed += 1
+        if len(self.errors) >= self.max_errors: return
+        if isinstance(exc, ValidationError):
+            messages = [f"{'.'.join(str(p) for p in e['loc'])}: {e['msg']}" for e in exc.errors()]
+        else:
+            messages = [str(exc) or exc.__class__.__name__]
+        self.errors.append({"row": line_no, "errors": messages})
+
+    def result(self) -> dict:
+        return {
+            "total": self.total, "inserted": self.inserted, "updated": self.updated, "failed": self.failed,
+            "errors": self.errors, "errors_truncated": self.failed > len(self.errors),
+            "elapsed_ms": round((time.perf_counter() - self.started) * 1000, 2),
+        }
+
+async def import_cost_chunk(db: AsyncSession, chunk: list, upsert: bool, report: ImportReport):
+    """校验 -> 批量算成本 -> 按 spec_name 分流为多行 INSERT / executemany UPDATE"""
+    valid = {}
+    for line_no, record in chunk:
+        try:
+            if "core_structure" in record: record["core_structure"] = parse_core_structure(record["core_structure"])
+            cost = CostCreate(**record)
+        except (ValidationError, ValueError) as e:
+            report.fail(line_no, e)
+            continue
+        errors = cost_engine.input_errors(cost_engine.freeze_structure(cost.core_structure), cost.length, cost.total_weight,
+                                          cost.copper_price, cost.pvc_price, cost.labor_cost)
+        if errors:  # 如 "nan"/"inf" 可以通过 float 校验，但不能参与计算
+            report.fail(line_no, ValueError("; ".join(errors)))
+            continue
+        # upsert 模式下同一文件中重复的 spec_name 以最后一行为准
+        valid[cost.spec_name if upsert else line_no] = cost
+    if not valid: return
+
+    costs = list(valid.values())
+    computed = cost_engine.compute_costs_batch(
+        [cost_engine.freeze_structure(c.core_structure) for c in costs], [c.material for c in costs], [c.length for c in costs],
+        [c.total_weight for c in costs], [c.copper_price for c in costs], [c.pvc_price for c in costs], [c.labor_cost for c in costs],
+    )
+    columns = {f: computed[f].tolist() for f in cost_engine.COST_FIELDS}
+    now = datetime.utcnow()
+    records = [{**c.dict(), **{f: columns[f][i] for f in cost_engine.COST_FIELDS}, "updated_at": now} for i, c in enumerate(costs)]
+
+    existing = set()
+    if upsert:
+        res = await db.execute(select(ProductCost.spec_name).where(ProductCost.spec_name.in_([c.spec_name for c in costs])))
+        existing = set(res.scalars().all())
+    inserts = [r for r in records if r["spec_name"] not in existing]
+    updates = [{**r, "_spec": r["spec_name"]} for r in records if r["spec_name"] in existing]
+
+    table = ProductCost.__table__
+    conn = await db.connection()
+    if inserts:
+        await conn.execute(insert(table), [{**r, "is_converted": False} for r in inserts])
+    if updates:
+        fields = [k for k in records[0] if k != "spec_name"]
+        stmt = update(table).where(table.c.spec_name == bindparam("_spec")).values({f: bindparam(f) for f in fields})
+        await conn.execute(stmt, updates)
+    report.inserted += len(inserts)
+    report.updated += len(updates)
+
+PRODUCT_IMPORT_FIELDS = ("name", "description", "image_url", "category_id")
+VARIANT_IMPORT_FIELDS = tuple(ProductVariantCreate.model_fields)
+
+async def import_product_chunk(db: AsyncSession, chunk: list, upsert: bool, report: ImportReport):
+    """
+    每行对应一个变体，按 (name, category_id) 归并到商品：
+    已存在的商品直接复用，缺失的批量 INSERT ... RETURNING；变体按 sku_code upsert。
+    """
+    valid = []
+    for line_no, record in chunk:
+        try:
+            product = ProductCreate(
+                **{k: record[k] for k in PRODUCT_IMPORT_FIELDS if k in record},
+                variants=[{k: record[k] for k in VARIANT_IMPORT_FIELDS if k in record}],
+            )
+        except ValidationError as e:
+            report.fail(line_no, e)
+            continue
+        valid.append(product)
+    if not valid: return
+
+    # 1. 解析商品 id
+    product_ids = {}
+    res = await db.execute(
+        select(Product.id, Product.name, Product.category_id)
+        .where(Product.name.in_({p.name for p in valid})).order_by(Product.id)
+    )
+    for pid, name, category_id in res.all():
+        product_ids.setdefault((name, category_id), pid)
+    new_products = {}
+    for p in valid:
+        key = (p.name, p.category_id)
+        if key not in product_ids and key not in new_products:
+            new_products[key] = {"name": p.name, "description": p.description, "image_url": p.image_url, "category_id": p.category_id}
+    conn = await db.connection()
+    if new_products:
+        table = Product.__table__
+        res = await conn.execute(
+            insert(table).returning(table.c.id, table.c.name, table.c.category_id, sort_by_parameter_order=True),
+            list(new_products.values()),
+        )
+        for pid, name, category_id in res.all():
+            product_ids[(name, category_id)] = pid
+
+    # 2. 变体：有 sku_code 且已存在的更新，其余插入 (同一文件中重复的 sku_code 以最后一行为准)
+    variants, by_sku = [], {}
+    for p in valid:
+        v = {**p.variants[0].dict(), "product_id": product_ids[(p.name, p.category_id)]}
+        if v["sku_code"] and upsert: by_sku[v["sku_code"]] = v
+        else: variants.append(v)
+    existing = set()
+    if by_sku:
+        res = await db.execute(select(ProductVariant.sku_code).where(ProductVariant.sku_code.in_(list(by_sku))))
+        existing = set(res.scalars().all())
+    inserts = variants + [v for sku, v in by_sku.items() if sku not in existing]
+    updates = [{**v, "_sku": sku, "deleted_at": None} for sku, v in by_sku.items() if sku in existing]
+
+    table = ProductVariant.__table__
+    if inserts:
+        await conn.execute(insert(table), inserts)
+    if updates:
+        fields = [k for k in updates[0] if k not in ("_sku", "sku_code")]
+        stmt = update(table).where(table.c.sku_code == bindparam("_sku")).values({f: bindparam(f) for f in fields})
+        await conn.execute(stmt, updates)
+    report.inserted += len(inserts)
+    report.updated += len(updates)
+
+async def run_import(db: AsyncSession, upload: UploadFile, handler, upsert: bool) -> dict:
+    """逐块读取并导入，每块单独提交 (缩短 SQLite 写锁时间；按唯一键 upsert，失败后可整表重跑)"""
+    report = ImportReport(settings.IMPORT_MAX_ERRORS)
+    rows = open_import_rows(upload)
+    async for chunk in iter_import_chunks(rows, settings.IMPORT_CHUNK_SIZE):
+        report.total += len(chunk)
+        await handler(db, chunk, upsert, report)
+        await db.commit()
+    return report.result()
+
+# ==========================================
+# 6.7 库存预留 (Stock Reservations)
+# ==========================================
+STOCK_BATCH_SIZE = 400  # 每条 UPDATE 覆盖的变体数 (受 SQLite 绑定参数上限约束)
+
+_variants = ProductVariant.__table__
+_reserved = func.coalesce(_variants.c.reserved, 0)
+
+async def adjust_variants(db: AsyncSession, quantities: dict, values, guard=None) -> List[int]:
+    """
+    按批执行条件 UPDATE (数量以 CASE id 展开，每批一条语句)，返回未被更新的变体 id。
+    values(qty) 给出 SET 子句，guard(qty) 给出附加条件；成功的行由 RETURNING 给出，失败时由调用方回滚。
+    支持行锁的数据库先按 id 顺序加锁，避免并发事务互相死锁。
+    """
+    conn = await db.connection()
+    ids, failed = sorted(quantities), []
+    for offset in range(0, len(ids), STOCK_BATCH_SIZE):
+        batch = ids[offset:offset + STOCK_BATCH_SIZE]
+        qty = case({vid: quantities[vid] for vid in batch}, value=_variants.c.id)
+        if conn.dialect.name != "sqlite":
+            await conn.execute(select(_variants.c.id).where(_variants.c.id.in_(batch)).order_by(_variants.c.id).with_for_update())
+        stmt = update(_variants).where(_variants.c.id.in_(batch)).values(values(qty))
+        if guard is not None: stmt = stmt.where(guard(qty))
+        done = set((await conn.execute(stmt.returning(_variants.c.id))).scalars().all())
+        failed.extend(vid for vid in batch if vid not in done)
+    return failed
+
+async def deduct_stock(db: AsyncSession, quantities: dict) -> List[int]:
+    """扣减实际库存，只能动用可用量 (stock - reserved)：调用方须先释放本订单自身的预留，其他订单的预留不受影响"""
+    return await adjust_variants(db, quantities, lambda q: {"stock": _variants.c.stock - q}, lambda q: _variants.c.stock - _reserved >= q)
+
+async def restore_stock(db: AsyncSession, quantities: dict) -> List[int]:
+    return await adjust_variants(db, quantities, lambda q: {"stock": _variants.c.stock + q})
+
+async def reserve_stock(db: AsyncSession, quantities: dict) -> List[int]:
+    """占用可用量 (stock - reserved)，不足的规格返回其 id"""
+    return await adjust_variants(db, quantities, lambda q: {"reserved": _reserved + q}, lambda q: _variants.c.stock - _reserved >= q)
+
+async def unreserve_stock(db: AsyncSession, quantities: dict) -> List[int]:
+    return await adjust_variants(db, quantities, lambda q: {"reserved": _reserved - q})
+
+def order_quantities(order: Order) -> dict:
+    """按变体汇总订单数量 (同一规格可能出现在多行)"""
+    quantities = {}
+    for item in order.items:
+        if item.variant_id: quantities[item.variant_id] = quantities.get(item.variant_id, 0) + item.quantity
+    return quantities
+
+async def write_ledger(db: AsyncSession, kind: LedgerKind, order_id: Optional[int], quantities: dict, expires_at: Optional[datetime] = None):
+    if not quantities: return
+    now = datetime.utcnow()
+    rows = [{"variant_id": vid, "order_id": order_id, "kind": kind, "quantity": q, "expires_at": expires_at, "created_at": now}
+            for vid, q in quantities.items()]
+    await db.execute(insert(InventoryLedger), rows)
+
+def open_reservations():
+    """尚未被 commit / release 结清的预留流水"""
+    settle = aliased(InventoryLedger)
+    settled = exists().where(
+        settle.order_id == InventoryLedger.order_id, settle.variant_id == InventoryLedger.variant_id,
+        settle.kind.in_([LedgerKind.COMMIT, LedgerKind.RELEASE]),
+    )
+    return select(InventoryLedger.order_id, InventoryLedger.variant_id, InventoryLedger.quantity).where(
+        InventoryLedger.kind == LedgerKind.RESERVE, ~settled)
+
+async def order_reservations(db: AsyncSession, order_id: int) -> dict:
+    rows = (await db.execute(open_reservations().where(InventoryLedger.order_id == order_id))).all()
+    return {r.variant_id: r.quantity for r in rows}
+
+async def release_reservations(db: AsyncSession, order_id: int) -> dict:
+    """释放订单的未结预留 (追加 release 流水并扣回 reserved)"""
+    held = await order_reservations(db, order_id)
+    if held:
+        await write_ledger(db, LedgerKind.RELEASE, order_id, held)
+        await unreserve_stock(db, held)
+    return held
+
+async def rebuild_reserved_counters(db: AsyncSession):
+    """由流水重建全部 reserved 计数 (启动时执行，修正任何漂移)"""
+    held = open_reservations().subquery()
+    total = select(func.coalesce(func.sum(held.c.quantity), 0)).where(held.c.variant_id == ProductVariant.id).scalar_subquery()
+    await db.execute(update(ProductVariant).values(reserved=total).execution_options(synchronize_session=False))
+    await db.commit()
+
+async def sweep_expired_reservations():
+    """
+    释放已超时的预留 (订单仍保持待确认，确认时按实际库存扣减)。
+    先以空更新锁住仍待确认的订单行 (与 confirm / cancel 的状态条件更新互斥)，
+    加锁后再重新读取未结预留，只释放此刻仍未被结清的部分，避免与确认/作废重复扣回 reserved。
+    """
+    async with AsyncSessionLocal() as db:
+        now = datetime.utcnow()
+        candidates = {r.order_id for r in (await db.execute(open_reservations().where(InventoryLedger.expires_at < now))).all()}
+        if not candidates: return
+        locked = (await db.execute(
+            update(Order.__table__)
+            .where(Order.__table__.c.id.in_(candidates), Order.__table__.c.status == OrderStatus.PENDING_CONFIRMATION)
+            .values(status=Order.__table__.c.status)
+            .returning(Order.__table__.c.id)
+        )).scalars().all()
+        rows = (await db.execute(open_reservations().where(InventoryLedger.expires_at < now, InventoryLedger.order_id.in_(locked)))).all() if locked else []
+        if not rows:
+            await db.rollback()  # 已被确认 / 作废结清
+            return
+        by_order, totals = {}, {}
+        for r in rows:
+            by_order.setdefault(r.order_id, {})[r.variant_id] = r.quantity
+            totals[r.variant_id] = totals.get(r.variant_id, 0) + r.quantity
+        try:
+            for order_id, held in by_order.items():
+                await write_ledger(db, LedgerKind.RELEASE, order_id, held)
+            await unreserve_stock(db, totals)
+            await db.commit()
+        except IntegrityError:
+            await db.rollback()  # 其他 worker 已结清，下一轮重新计算
+            return
+        print(f"🧹 已释放超时库存预留: {len(by_order)} 个订单")
+
+# ==========================================
+# 6.8 司机定位 (Driver Locations)
+# ==========================================
+@dataclass(frozen=True)
+class LocationFix:
+    lat: float
+    lng: float
+    recorded_at: datetime
+
+class DriverLocationBuffer:
+    """
+    司机定位的内存缓冲：每个司机保留最近 N 个点 (环形队列)，
+    订单只记录待写入的最新位置，由后台任务按周期合并写库 (同一订单只写最后一次)。
+    订单归属只缓存 assignment_ttl 秒：改派/结单可能发生在其他 worker，过期后由调用方重新查库校验。
+    """
+    def __init__(self, history: int, assignment_ttl: float = 30):
+        self.history = history
+        self.assignment_ttl = assignment_ttl
+        self._tracks: dict[int, deque] = {}  # driver_id -> 最近定位点
+        self._orders: dict[int, set] = {}  # driver_id -> 正在上报的订单
+        self._assignments: dict[int, tuple] = {}  # order_id -> (driver_id, 校验时间 monotonic)
+        self._pending: dict[int, tuple] = {}  # order_id -> (driver_id, LocationFix)
+
+    def assigned_driver(self, order_id: int) -> Optional[int]:
+        """仍在有效期内的已校验归属；过期则丢弃 (订单同时从司机的上报列表移除)"""
+        entry = self._assignments.get(order_id)
+        if entry is None: return None
+        if time.monotonic() - entry[1] > self.assignment_ttl:
+            self.forget_order(order_id)
+            return None
+        return entry[0]
+
+    def assign(self, order_id: int, driver_id: int):
+        previous = self._assignments.get(order_id)
+        if previous and previous[0] != driver_id: self.forget_order(order_id)
+        self._assignments[order_id] = (driver_id, time.monotonic())
+
+    def orders_of(self, driver_id: int) -> List[int]:
+        """司机当前 (归属仍有效) 正在上报的订单"""
+        return sorted(o for o in self._orders.get(driver_id, ()) if self.assigned_driver(o) == driver_id)
+
+    def prune(self):
+        """清理过期的归属 (由定时写库任务顺带调用，避免已结束的订单长期留在内存中)"""
+        for order_id in list(self._assignments): self.assigned_driver(order_id)
+
+    def forget_order(self, order_id: int):
+        """订单改派/结束后调用：不再接受旧司机对该订单的上报 (已缓冲的位置写库时按 driver_id 校验)"""
+        driver_id, _ = self._assignments.pop(order_id, (None, None))
+        if driver_id in self._orders: self._orders[driver_id].discard(order_id)
+
+    def record(self, driver_id: int, fixes: List[LocationFix], order_ids=()) -> Optional[LocationFix]:
+        if not fixes: return None
+        track = self._tracks.setdefault(driver_id, deque(maxlen=self.history))
+        for fix in sorted(fixes, key=lambda f: f.recorded_at):
+            if track and fix.recorded_at < track[-1].recorded_at: continue  # 迟到的旧点不覆盖新位置
+            track.append(fix)
+        if not track: return None
+        latest = track[-1]
+        orders = self._orders.setdefault(driver_id, set())
+        for order_id in order_ids:
+            orders.add(order_id)
+            self._pending[order_id] = (driver_id, latest)
+        return latest
+
+    def active(self, max_age: int) -> list:
+        cutoff = datetime.utcnow() - timedelta(seconds=max_age)
+        return [(driver_id, track) for driver_id, track in self._tracks.items() if track and track[-1].recorded_at >= cutoff]
+
+    def latest_for_order(self, order_id: int) -> Optional[LocationFix]:
+        driver_id = self.assigned_driver(order_id)
+        track = self._tracks.get(driver_id)
+        return track[-1] if track and order_id in self._orders.get(driver_id, ()) else None
+
+    async def flush(self, db: AsyncSession) -> int:
+        """把周期内各订单的最新位置一次 executemany 写入 (仍属该司机且仍在配送中的订单才写)"""
+        self.prune()
+        if not self._pending: return 0
+        pending, self._pending = self._pending, {}
+        params = [{"_id": order_id, "_driver": driver_id, "driver_lat": fix.lat, "driver_lng": fix.lng}
+                  for order_id, (driver_id, fix) in pending.items()]
+        table = Order.__table__
+        stmt = (
+            update(table)
+            .where(table.c.id == bindparam("_id"), table.c.driver_id == bindparam("_driver"), table.c.status == OrderStatus.DELIVERING)
+            .values(driver_lat=bindparam("driver_lat"), driver_lng=bindparam("driver_lng"))
+        )
+        try:
+            await db.execute(stmt, params)
+            await db.commit()
+        except Exception:
+            for order_id, item in pending.items(): self._pending.setdefault(order_id, item)  # 保留更新的点，下轮重试
+            raise
+        return len(params)
+
+driver_locations = DriverLocationBuffer(settings.LOCATION_HISTORY_SIZE, settings.LOCATION_ASSIGNMENT_TTL_SECONDS)
+
+def to_fixes(body: Union["DriverLocationBatch", "DriverLocationUpdate"]) -> List[LocationFix]:
+    updates = body.fixes if isinstance(body, DriverLocationBatch) else [body]
+    now = datetime.utcnow()
+
+    def at(u):
+        if not u.recorded_at: return now
+        ts = u.recorded_at.astimezone(timezone.utc).replace(tzinfo=None) if u.recorded_at.tzinfo else u.recorded_at
+        return min(ts, now)  # 设备时钟超前时以接收时间为准
+    return [LocationFix(u.lat, u.lng, at(u)) for u in updates]
+
+# ==========================================
+# 6.9 物流追踪推送 (Order Tracking)
+# ==========================================
+TRACK_STATUS_TEXT = {
+    "pending_confirmation": "待确认",
+    "confirmed": "仓库备货中",
+    "delivering": "配送途中",
+    "completed": "已送达",
+    "cancelled": "已取消"
+}
+
+async def load_tracking_snapshot(order_id: int) -> Optional[dict]:
+    """公开追踪信息的投影查询：只取状态/司机名/件数，不加载订单明细"""
+    item_count = select(func.count(OrderItem.id)).where(OrderItem.order_id == Order.id).scalar_subquery()
+    query = (
+        select(Order.id, Order.status, Order.created_at, Order.driver_id, Order.driver_lat, Order.driver_lng,
+               User.username, item_count.label("item_count"))
+        .outerjoin(User, User.id == Order.driver_id)
+        .where(Order.id == order_id)
+    )
+    async with AsyncSessionLocal() as db:
+        row = (await db.execute(query)).first()
+    if not row: return None
+
+    # 构建脱敏信息
+    driver_info = "等待分配"
+    if row.driver_id:
+        # 司机姓名脱敏 (如: 王师傅)
+        driver_name = row.username[0] + "师傅" if row.username else "司机"
+        driver_info = f"{driver_name} (正在配送)"
+    status = _status_value(row.status)
+    snapshot = {
+        "id": row.id,
+        "status": status,
+        "status_text": TRACK_STATUS_TEXT.get(status, "处理中"),
+        "driver_info": driver_info,
+        "updated_at": row.created_at.strftime("%Y-%m-%d %H:%M"),
+        "item_count": row.item_count,
+        "driver_location": None,
     }
+    if status == OrderStatus.DELIVERING.value and row.driver_lat is not None:
+        snapshot["driver_location"] = {"lat": row.driver_lat, "lng": row.driver_lng}
+    return snapshot
+
+def with_live_location(snapshot: dict) -> dict:
+    """用内存中的最新定位覆盖快照里 (可能尚未写库的) 司机坐标"""
+    if snapshot["status"] != OrderStatus.DELIVERING.value: return snapshot
+    fix = driver_locations.latest_for_order(snapshot["id"])
+    if not fix: return snapshot
+    return {**snapshot, "driver_location": {"lat": fix.lat, "lng": fix.lng, "recorded_at": fix.recorded_at.isoformat()}}
+
+class TrackingChannel:
+    def __init__(self):
+        self.sockets: set = set()
+        self.wake = asyncio.Event()
+        self.stale = False
+        self.sent: Optional[dict] = None
+        self.task: Optional[asyncio.Task] = None
+
+class TrackingBroadcaster:
+    """
+    按订单 id 分组的 WebSocket 推送：同一订单的所有观看者共用一个快照和一个刷新任务，
+    状态变化 (notify) 时重新查询一次，位置变化时只合并内存坐标；另按 IP 限制连接数。
+    """
+    def __init__(self, per_ip: int, max_connections: int):
+        self.per_ip = per_ip
+        self.max_connections = max_connections
+        self.cache = TTLCache(4096, settings.TRACK_CACHE_SECONDS)
+        self._channels: dict[int, TrackingChannel] = {}
+        self._ips: dict[str, int] = {}
+        self._total = 0
+
+    async def snapshot(self, order_id: int) -> Optional[dict]:
+        snapshot = self.cache.get(order_id)
+        if snapshot is None:
+            snapshot = await load_tracking_snapshot(order_id)
+            if snapshot is not None: self.cache.put(order_id, snapshot)
+        return with_live_location(snapshot) if snapshot else None
+
+    def admit(self, ip: str) -> bool:
+        if self._total >= self.max_connections or self._ips.get(ip, 0) >= self.per_ip: return False
+        self._ips[ip] = self._ips.get(ip, 0) + 1
+        self._total += 1
+        return True
+
+    def release(self, ip: str):
+        self._total -= 1
+        if self._ips.get(ip, 0) <= 1: self._ips.pop(ip, None)
+        else: self._ips[ip] -= 1
+
+    def join(self, order_id: int, ws: WebSocket, sent: dict):
+        channel = self._channels.get(order_id)
+        if channel is None or channel.task.done():
+            channel = self._channels[order_id] = TrackingChannel()
+            channel.sent = sent
+            channel.task = asyncio.create_task(self._pump(order_id, channel))
+        channel.sockets.add(ws)
+
+    def leave(self, order_id: int, ws: WebSocket):
+        channel = self._channels.get(order_id)
+        if channel is None: return
+        channel.sockets.discard(ws)
+        if not channel.sockets:
+            self._channels.pop(order_id, None)
+            channel.wake.set()  # 让刷新任务退出
+
+    def notify(self, order_id: int, stale: bool = True):
+        """订单变化 (stale=True 需重新查库) 或司机位置变化时调用"""
+        if stale: self.cache.pop(order_id)
+        channel = self._channels.get(order_id)
+        if channel is None: return
+        channel.stale = channel.stale or stale
+        channel.wake.set()
+
+    async def _pump(self, order_id: int, channel: TrackingChannel):
+        while channel.sockets:
+            try:
+                await asyncio.wait_for(channel.wake.wait(), settings.TRACK_REFRESH_SECONDS)
+            except asyncio.TimeoutError:
+                channel.stale = True
+            channel.wake.clear()
+            if not channel.sockets: break
+            try:
+                if channel.stale:
+                    channel.stale = False
+                    self.cache.pop(order_id)
+                snapshot = await self.snapshot(order_id)
+            except Exception as e:
+                print(f"❌ 追踪快照刷新失败: {e}")
+                continue
+            if snapshot is None or snapshot == channel.sent: continue
+            channel.sent = snapshot
+            await asyncio.gather(*(self._send(channel, ws, snapshot) for ws in list(channel.sockets)))
+
+    async def _send(self, channel: TrackingChannel, ws: WebSocket, snapshot: dict):
+        try:
+            await asyncio.wait_for(ws.send_json(snapshot), 5)
+        except Exception:
+            channel.sockets.discard(ws)  # 发送失败或过慢的连接由其自身的接收循环清理
+
+tracking = TrackingBroadcaster(settings.TRACK_WS_PER_IP, settings.TRACK_WS_MAX_CONNECTIONS)
+
+# ==========================================
+# 6.10 图片上传 (Uploads)
+# ==========================================
+UPLOAD_DIR = os.path.join(STATIC_DIR, "uploads")
+
+@dataclass(frozen=True)
+class StoredImage:
+    digest: str
+    path: str  # 磁盘路径
+    url: str
+
+    @property
+    def thumb_path(self) -> str:
+        return os.path.splitext(self.path)[0] + ".thumb.webp"
+
+    @property
+    def thumb_url(self) -> str:
+        return os.path.splitext(self.url)[0] + ".thumb.webp"
+
+async def store_image_upload(file: UploadFile) -> StoredImage:
+    """
+    分块读取上传文件：首块校验类型，边写临时文件边计算 SHA-256 并累计大小 (超限立即中止)，
+    完成后按内容哈希落到 uploads/<前两位>/<哈希>.<扩展名>；相同内容只保存一份。
+    """
+    chunk = await file.read(settings.UPLOAD_CHUNK_BYTES)
+    ext = IMAGE_EXTENSIONS[sniff_image_type(chunk[:2048])]
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    tmp_path = os.path.join(UPLOAD_DIR, f".upload-{uuid.uuid4().hex}")
+    hasher, size = hashlib.sha256(), 0
+    out = await run_in_threadpool(open, tmp_path, "wb")
+    try:
+        while chunk:
+            size += len(chunk)
+            if size > settings.UPLOAD_MAX_BYTES: raise HTTPException(status_code=400, detail="File too large")
+            hasher.update(chunk)
+            await run_in_threadpool(out.write, chunk)
+            chunk = await file.read(settings.UPLOAD_CHUNK_BYTES)
+        await run_in_threadpool(out.close)
+        digest = hasher.hexdigest()
+        rel = f"{digest[:2]}/{digest}.{ext}"
+        path = os.path.join(UPLOAD_DIR, digest[:2], f"{digest}.{ext}")
+        if os.path.exists(path):
+            os.remove(tmp_path)  # 已有相同内容
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+    except BaseException:
+        out.close()
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+    return StoredImage(digest, path, f"/static/uploads/{rel}")
+
+_image_executor: Optional[ProcessPoolExecutor] = None
+
+def image_executor() -> ProcessPoolExecutor:
+    """图片处理进程池 (首次使用时创建；spawn 方式，子进程导入的模块见 imaging 的说明)"""
+    global _image_executor
+    if _image_executor is None:
+        _image_executor = ProcessPoolExecutor(max_workers=settings.IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _image_executor
+
+async def render_webp(src: str, dst: str, max_side: int) -> bool:
+    """在进程池中生成 WebP 变体；未安装 Pillow 或处理失败时返回 False"""
+    if not imaging.AVAILABLE: return False
+    try:
+        await asyncio.get_running_loop().run_in_executor(image_executor(), imaging.make_webp, src, dst, max_side)
+        return True
+    except Exception as e:
+        print(f"❌ 图片处理失败 {src}: {e}")
+        return False
+
+_background_tasks: set = set()
+
+def run_in_background(coro):
+    """保留任务引用直到完成，避免被垃圾回收提前取消"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def attach_delivery_thumbnail(order_id: int, image: StoredImage):
+    """生成回单缩略图并回写订单 (照片在此期间被替换则不写)"""
+    if not os.path.exists(image.thumb_path) and not await render_webp(image.path, image.thumb_path, settings.THUMBNAIL_MAX_SIDE):
+        return
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            update(Order.__table__)
+            .where(Order.__table__.c.id == order_id, Order.__table__.c.delivery_photo_url == image.url)
+            .values(delivery_photo_thumb_url=image.thumb_url)
+        )
+        await db.commit()
+
+# ==========================================
+# 6.11 静态文件 (Static)
+# ==========================================
+IMAGE_SIZES = {"thumb": settings.THUMBNAIL_MAX_SIDE, "medium": settings.IMAGE_MEDIUM_MAX_SIDE}
+RESIZABLE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+
+def is_content_addressed(path: str) -> bool:
+    """uploads/<aa>/<sha256>.<ext> 及其派生文件 (<sha256>.thumb.webp)：内容变化必然换 URL"""
+    name = os.path.basename(path).split(".", 1)[0]
+    return len(name) == 64 and all(c in "0123456789abcdef" for c in name)
+
+class ImageVariantCache:
+    """按需生成的图片尺寸变体 (WebP)，落盘缓存；总大小超过上限时淘汰最久未用的文件"""
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict = OrderedDict()  # 路径 -> 字节数，按最近使用排序
+        self.total = 0
+        self.loaded = False
+        self.pending: dict = {}  # 正在生成的变体，同一文件的并发请求共用一次生成
+
+    def _scan(self) -> list:
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".webp"): continue
+                path = os.path.join(root, name)
+                try: st = os.stat(path)
+                except FileNotFoundError: continue
+                found.append((st.st_mtime, path, st.st_size))
+        return sorted(found)
+
+    async def _load(self):
+        for _, path, size in await run_in_threadpool(self._scan):
+            self.entries[path] = size
+            self.total += size
+        self.loaded = True
+
+    def _add(self, path: str, size: int):
+        self.total += size - self.entries.pop(path, 0)
+        self.entries[path] = size
+        while self.total > self.max_bytes and len(self.entries) > 1:
+            old, old_size = self.entries.popitem(last=False)
+            self.total -= old_size
+            try: os.remove(old)
+            except FileNotFoundError: pass
+
+    async def _build(self, src: str, dst: str, max_side: int):
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if not await render_webp(src, dst, max_side): return None
+        st = os.stat(dst)
+        self._add(dst, st.st_size)
+        return dst, st
+
+    async def get(self, src: str, src_stat: os.stat_result, max_side: int):
+        """返回 (变体路径, stat)；无法生成 (未安装 Pillow / 文件损坏) 时返回 None，由调用方回退到原图"""
+        if not self.loaded: await self._load()
+        key = hashlib.sha1(f"{src}:{src_stat.st_mtime_ns}:{src_stat.st_size}:{max_side}".encode()).hexdigest()
+        dst = os.path.join(self.directory, key[:2], f"{key}.webp")
+        try:
+            st = os.stat(dst)
+        except FileNotFoundError:
+            pass
+        else:
+            self._add(dst, st.st_size)  # 命中 (可能由其他 worker 生成)，移到最近使用
+            return dst, st
+        task = self.pending.get(dst)
+        if task is None:
+            task = self.pending[dst] = asyncio.ensure_future(self._build(src, dst, max_side))
+            task.add_done_callback(lambda _: self.pending.pop(dst, None))
+        return await asyncio.shield(task)
+
+image_variants = ImageVariantCache(IMAGE_CACHE_DIR, settings.IMAGE_CACHE_MAX_BYTES)
+
+class CachedStaticFiles(StaticFiles):
+    """
+    /static 静态文件：内容哈希命名的文件返回 immutable 长缓存，其余缓存 STATIC_MAX_AGE 秒后以 ETag 协商；
+    条件请求 (304) 与 Range 由 FileResponse 处理。图片可带 ?size=thumb|medium 取缩放后的 WebP 变体。
+    """
+    async def get_response(self, path: str, scope) -> Response:
+        size = Request(scope).query_params.get("size", "full")
+        if size == "full" or scope["method"] not in ("GET", "HEAD"):
+            return await super().get_response(path, scope)
+        if size not in IMAGE_SIZES:
+            raise HTTPException(status_code=400, detail="size must be thumb, medium or full")
+        full_path, stat_result = await run_in_threadpool(self.lookup_path, path)
+        if (stat_result is None or not os.path.isfile(full_path)
+                or os.path.splitext(full_path)[1].lower() not in RESIZABLE_EXTENSIONS):
+            return await super().get_response(path, scope)
+        variant = await image_variants.get(full_path, stat_result, IMAGE_SIZES[size])
+        if variant is None:
+            return self.file_response(full_path, stat_result, scope)
+        return self.file_response(variant[0], variant[1], scope, source=full_path)
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200, source: Optional[str] = None) -> Response:
+        response = FileResponse(full_path, status_code=status_code, stat_result=stat_result)
+        response.headers["Cache-Control"] = IMMUTABLE_CACHE if is_content_addressed(source or full_path) else f"public, max-age={settings.STATIC_MAX_AGE}"
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        return response
+
+# ==========================================
+# 6.12 响应编码 (JSON & Compression)
+# ==========================================
+def dump_json(content) -> bytes:
+    """orjson 编码 (未安装时回退标准库)，非原生类型交给 jsonable_encoder"""
+    if orjson is not None:
+        return orjson.dumps(content, default=jsonable_encoder)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":"), default=jsonable_encoder).encode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    """
+    可信数据的快速通道：路由已按响应结构组装好数据时直接编码返回，
+    不再经过 response_model 的二次校验 (decorator 上的 response_model 仍用于文档)。content 可为已编码的 bytes。
+    """
+    def render(self, content) -> bytes:
+        return content if isinstance(content, bytes) else dump_json(content)
+
+_list_adapters: dict = {}
+
+def orm_json(schema, rows) -> bytes:
+    """ORM 行按 schema 校验一次，由 pydantic-core 直接编码为 JSON bytes (不经过中间 dict)"""
+    adapter = _list_adapters.get(schema)
+    if adapter is None: adapter = _list_adapters[schema] = TypeAdapter(List[schema])
+    return adapter.dump_json(adapter.validate_python(rows, from_attributes=True))
+
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript", "image/svg+xml")
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """从 Accept-Encoding 选出编码：br (已安装 brotli 时) 优先，其次 gzip；q=0 视为拒绝"""
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = params.strip().removeprefix("q=")
+        try:
+            if params and float(q) <= 0: continue
+        except ValueError:
+            continue
+        accepted.add(name.strip())
+    if brotli is not None and "br" in accepted: return "br"
+    if "gzip" in accepted or "*" in accepted: return "gzip"
+    return None
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    # 中等压缩级别：br 11 / gzip 9 体积只小几个百分点，CPU 却高出数倍
+    if encoding == "br": return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6, mtime=0)
+
+class CompressionMiddleware:
+    """
+    按 Accept-Encoding 压缩一次性发送的 JSON / 文本响应 (超过 minimum_size 字节)。
+    流式响应 (SSE、文件分块)、Range 响应、已编码或不可压缩类型原样透传。
+    """
+    def __init__(self, app, minimum_size: int):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", "")) if scope["type"] == "http" and self.minimum_size else None
+        if encoding is None:
+            return await self.app(scope, receive, send)
+        start = None  # 推迟发送响应头，拿到正文后再决定是否压缩
+
+        async def send_compressed(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if start is None:
+                return await send(message)
+            initial, start = start, None
+            headers = MutableHeaders(raw=initial["headers"])
+            body = message.get("body", b"")
+            if (message["type"] != "http.response.body" or message.get("more_body") or len(body) < self.minimum_size
+                    or "content-encoding" in headers or "content-range" in headers
+                    or not headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)):
+                await send(initial)
+                return await send(message)
+            # 大正文在线程池中压缩 (zlib / brotli 会释放 GIL)，不阻塞事件循环
+            body = compress_body(body, encoding) if len(body) < 64 * 1024 else await run_in_threadpool(compress_body, body, encoding)
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(body))
+            headers.add_vary_header("Accept-Encoding")
+            etag = headers.get("etag")
+            if etag and not etag.startswith("W/"): headers["ETag"] = f"W/{etag}"  # 压缩后字节不同，强 ETag 降为弱 ETag
+            await send(initial)
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_compressed)
+
+# ==========================================
+# 7. 定时任务 & 爬虫 (Tasks)
+# ==========================================
+class MarketDataError(Exception):
+    pass
+
+class CircuitBreaker:
+    """连续失败 threshold 次后熔断 cooldown 秒，期间直接跳过该数据源"""
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+
+    def allow(self) -> bool:
+        return time.monotonic() >= self.open_until
+
+    def success(self):
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.open_until = time.monotonic() + self.cooldown
+
+class MarketDataClient:
+    """
+    铜价/汇率抓取：共享一个 httpx.AsyncClient 连接池，
+    每个数据源独立的超时、指数退避重试与熔断；汇率单独缓存 (MARKET_FX_TTL_SECONDS)。
+    数据源地址来自 Settings，可指向本地桩服务进行测试；也可传入 transport (如 httpx.MockTransport)。
+    """
+    DEFAULT_FX_RATE = 7.07
+
+    def __init__(self, sina_url: str, fx_url: str, transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.sina_url = sina_url
+        self.fx_url = fx_url
+        self.transport = transport
+        self.breakers = {
+            "sina": CircuitBreaker(settings.MARKET_BREAKER_THRESHOLD, settings.MARKET_BREAKER_COOLDOWN),
+            "fx": CircuitBreaker(settings.MARKET_BREAKER_THRESHOLD, settings.MARKET_BREAKER_COOLDOWN),
+        }
+        self._client: Optional[httpx.AsyncClient] = None
+        self._fx_rate: Optional[float] = None
+        self._fx_expires = 0.0
+
+    async def start(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(limits=httpx.Limits(max_connections=10, max_keepalive_connections=4), transport=self.transport)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _get(self, source: str, url: str, timeout: float, headers: Optional[dict] = None) -> httpx.Response:
+        breaker = self.breakers[source]
+        if not breaker.allow(): raise MarketDataError(f"{source} circuit open")
+        await self.start()
+        delay = settings.MARKET_BACKOFF_SECONDS
+        for attempt in range(settings.MARKET_RETRIES + 1):
+            try:
+                resp = await self._client.get(url, headers=headers, timeout=timeout)
+                resp.raise_for_status()
+                breaker.success()
+                return resp
+            except httpx.HTTPError as e:
+                error = e
+                if attempt < settings.MARKET_RETRIES:
+                    await asyncio.sleep(delay)
+                    delay *= 2
+        breaker.failure()
+        raise MarketDataError(f"{source}: {error!r}")
+
+    async def fetch_copper_cny(self) -> float:
+        resp = await self._get("sina", self.sina_url, settings.MARKET_SINA_TIMEOUT, headers={"Referer": "https://finance.sina.com.cn/"})
+        try:
+            data_list = resp.text.split('"')[1].split(',')
+            return float(data_list[8]) if len(data_list) > 8 else 0.0
+        except (IndexError, ValueError) as e:
+            raise MarketDataError(f"sina: unexpected payload ({e})")
+
+    async def fetch_usd_cny_rate(self) -> float:
+        """优先使用缓存；抓取失败时沿用上一次的汇率 (首次失败用默认值)"""
+        if self._fx_rate is not None and time.monotonic() < self._fx_expires:
+            return self._fx_rate
+        try:
+            resp = await self._get("fx", self.fx_url, settings.MARKET_FX_TIMEOUT)
+            self._fx_rate = float(resp.json().get("rates", {}).get("CNY", self.DEFAULT_FX_RATE))
+            self._fx_expires = time.monotonic() + settings.MARKET_FX_TTL_SECONDS
+        except (MarketDataError, ValueError) as e:
+            print(f"⚠️ 汇率获取失败，沿用上次数据: {e}")
+        return self._fx_rate or self.DEFAULT_FX_RATE
+
+    async def get_realtime_copper_prices(self):
+        print("🕷️ 正在从新浪财经获取数据...", end=" ")
+        try:
+            cny_price = await self.fetch_copper_cny()
+        except MarketDataError as e:
+            print(f"\n❌ 新浪接口报错: {e}")
+            return None
+        usd_to_cny_rate = await self.fetch_usd_cny_rate()
+        usd_price = cny_price / usd_to_cny_rate if cny_price > 0 else 0.0
+        print(f"✅ 获取成功: ¥{cny_price}")
+        return {
+            "CNY": {"source": "沪铜连续", "symbol": "¥", "price": round(cny_price, 2), "change": 0.0},
+            "USD": {"source": f"折算 (1:{usd_to_cny_rate:.2f})", "symbol": "$", "price": round(usd_price, 2), "change": 0.0},
+            "exchange_rate": round(usd_to_cny_rate, 4),
+            "updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
+
+market_data = MarketDataClient(settings.SINA_API_URL, settings.EXCHANGE_RATE_API)
+
+@dataclass(frozen=True)
+class CopperQuote:
+    id: int
+    cny_price: float
+    usd_price: float
+    exchange_rate: float
+    payload: dict  # /meta/prices 的响应体 (预先构造)
+
+    @property
+    def etag(self) -> str:
+        return f'"cu-{self.id}"'
+
+class CopperPriceSnapshot:
+    """
+    最新铜价的进程内快照：启动时从库加载，定时任务写入新记录后整体替换 (引用赋值即原子)。
+    change 字段由相邻两次报价计算。
+    """
+    def __init__(self):
+        self.current: Optional[CopperQuote] = None
+
+    def publish(self, record: CopperPrice, previous: Optional[CopperQuote] = None):
+        previous = previous or self.current
+        cny_change = round(record.cny_price - previous.cny_price, 2) if previous else 0.0
+        usd_change = round(record.usd_price - previous.usd_price, 2) if previous else 0.0
+        self.current = CopperQuote(
+            id=record.id, cny_price=record.cny_price, usd_price=record.usd_price, exchange_rate=record.exchange_rate,
+            payload={
+                "CNY": {"source": "沪铜连续", "symbol": "¥", "price": record.cny_price, "change": cny_change},
+                "USD": {"source": "国际折算", "symbol": "$", "price": record.usd_price, "change": usd_change},
+                "exchange_rate": record.exchange_rate,
+                "updated": record.updated_at.strftime("%Y-%m-%d %H:%M:%S")
+            },
+        )
+
+    async def load(self, db: AsyncSession):
+        rows = (await db.execute(select(CopperPrice).order_by(desc(CopperPrice.updated_at)).limit(2))).scalars().all()
+        if not rows: return
+        self.current = None
+        if len(rows) > 1: self.publish(rows[1])
+        self.publish(rows[0])
+
+    def require(self) -> CopperQuote:
+        if self.current is None: raise HTTPException(status_code=400, detail="No market price found")
+        return self.current
+
+copper_snapshot = CopperPriceSnapshot()
+
+async def get_realtime_copper_prices():
+    return await market_data.get_realtime_copper_prices()
 
 async def update_copper_price_task():
     print(f"[{datetime.now()}] ⏰ 定时任务启动...")
-    data = get_realtime_copper_prices()
+    data = await get_realtime_copper_prices()
     if not data or data['CNY']['price'] <= 0: return
     async with AsyncSessionLocal() as db:
         try:
             record = CopperPrice(cny_price=data['CNY']['price'], usd_price=data['USD']['price'], exchange_rate=data['exchange_rate'], updated_at=datetime.now())
             db.add(record)
             await db.commit()
+            copper_snapshot.publish(record)
+            event_hub.publish("prices", copper_snapshot.current.payload)
             print(f"💾 数据库已更新: ¥{record.cny_price}")
         except Exception as e:
             print(f"❌ 数据库写入失败: {e}")
             await db.rollback()
 
+async def token_blocklist_sync_task():
+    """后台循环：轮询新注销的 token 与商品目录缓存版本，并按间隔清理过期记录"""
+    last_prune = datetime.utcnow()
+    while True:
+        await asyncio.sleep(settings.TOKEN_BLOCKLIST_POLL_SECONDS)
+        try:
+            async with AsyncSessionLocal() as db:
+                await revoked_tokens.poll(db)
+                await catalog_cache.sync(db)
+                if (datetime.utcnow() - last_prune).total_seconds() >= settings.TOKEN_BLOCKLIST_PRUNE_SECONDS:
+                    removed = await revoked_tokens.prune(db)
+                    last_prune = datetime.utcnow()
+                    if removed: print(f"🧹 已清理过期黑名单 token: {removed}")
+        except Exception as e:
+            print(f"❌ 黑名单同步失败: {e}")
+
+async def location_flush_task():
+    """后台循环：按周期把缓冲中的司机位置合并写库"""
+    while True:
+        await asyncio.sleep(settings.LOCATION_FLUSH_SECONDS)
+        try:
+            async with AsyncSessionLocal() as db:
+                await driver_locations.flush(db)
+        except Exception as e:
+            print(f"❌ 司机位置写入失败: {e}")
+
 # ==========================================
 # 8. FastAPI Application
 # ==========================================
-scheduler = BackgroundScheduler()
+scheduler = AsyncIOScheduler()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Init DB Tables
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(ensure_columns)
+        await conn.run_sync(search_index.setup)
     # Init Admin
     async with AsyncSessionLocal() as db:
         res = await db.execute(select(User).filter(User.email == settings.FIRST_SUPERUSER))
         if not res.scalars().first():
-            admin = User(email=settings.FIRST_SUPERUSER, username="Admin", hashed_password=get_password_hash(settings.FIRST_SUPERUSER_PASSWORD), role="admin", is_admin=True, is_active=True, company_name="HQ")
+            admin = User(email=settings.FIRST_SUPERUSER, username="Admin", hashed_password=await get_password_hash_async(settings.FIRST_SUPERUSER_PASSWORD), role="admin", is_admin=True, is_active=True, company_name="HQ")
             db.add(admin)
             await db.commit()
-    # Start Scheduler
+        if settings.DASHBOARD_COUNTERS:
+            await rebuild_status_counters(db)
+        await revoked_tokens.load(db)
+        await revoked_tokens.prune(db)
+        await copper_snapshot.load(db)
+        await rebuild_reserved_counters(db)
+        await rebuild_category_paths(db)
+        await catalog_cache.sync(db)
+    blocklist_task = asyncio.create_task(token_blocklist_sync_task())
+    location_task = asyncio.create_task(location_flush_task())
+    # Start Scheduler (首次抓取立即在后台执行，不阻塞启动)
     try:
-        await update_copper_price_task()
+        await market_data.start()
         if not scheduler.get_jobs():
-            scheduler.add_job(update_copper_price_task, 'interval', hours=1)
+            scheduler.add_job(update_copper_price_task, 'interval', hours=1, next_run_time=datetime.now())
+            scheduler.add_job(sweep_expired_reservations, 'interval', seconds=settings.RESERVATION_SWEEP_SECONDS)
             scheduler.start()
     except Exception as e:
         print(f"Task Error: {e}")
     yield
+    blocklist_task.cancel()
+    location_task.cancel()
+    try:
+        async with AsyncSessionLocal() as db: await driver_locations.flush(db)
+    except Exception as e:
+        print(f"❌ 司机位置写入失败: {e}")
+    password_executor.shutdown(wait=False)
+    if _image_executor: _image_executor.shutdown(wait=False, cancel_futures=True)
     if scheduler.running: scheduler.shutdown()
+    await market_data.close()
+    await engine.dispose()
 
 app = FastAPI(title="Amazon Cable API", version="1.1.0", lifespan=lifespan)
-app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+app.add_middleware(CompressionMiddleware, minimum_size=settings.COMPRESS_MIN_BYTES)
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"], expose_headers=["X-Next-Cursor"])
 os.makedirs(os.path.join(STATIC_DIR, "uploads"), exist_ok=True)
-app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
+app.mount("/static", CachedStaticFiles(directory=STATIC_DIR), name="static")
 
 # ==========================================
 # 9. Routers Implementation
@@ -875,11 +2753,10 @@ app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 # --- Meta Router (🟢 新增补充: 解决 404 /api/v1/meta/prices) ---
 meta_router = APIRouter(prefix="/api/v1/meta", tags=["Meta"])
 @meta_router.get("/prices", response_model=CopperDisplayResponse)
-async def get_meta_prices(db: AsyncSession = Depends(get_db)):
-    """获取最新铜价 (前端 Header/Footer 显示用)"""
-    res = await db.execute(select(CopperPrice).order_by(desc(CopperPrice.updated_at)).limit(1))
-    latest = res.scalars().first()
-    if not latest:
+async def get_meta_prices(request: Request):
+    """获取最新铜价 (前端 Header/Footer 显示用)，直接读取内存快照，不查库"""
+    quote = copper_snapshot.current
+    if not quote:
         # Fallback if db is empty
         return {
             "CNY": {"source": "System", "symbol": "¥", "price": 0.0, "change": 0.0},
@@ -887,28 +2764,67 @@ async def get_meta_prices(db: AsyncSession = Depends(get_db)):
             "exchange_rate": 7.0,
             "updated": "No Data"
         }
-    return {
-        "CNY": {"source": "沪铜连续", "symbol": "¥", "price": latest.cny_price, "change": 0.0},
-        "USD": {"source": "国际折算", "symbol": "$", "price": latest.usd_price, "change": 0.0},
-        "exchange_rate": latest.exchange_rate,
-        "updated": latest.updated_at.strftime("%Y-%m-%d %H:%M:%S")
-    }
+    headers = {"ETag": quote.etag, "Cache-Control": f"public, max-age={settings.PRICE_CACHE_MAX_AGE}"}
+    if etag_matches(request, quote.etag):
+        return Response(status_code=304, headers=headers)
+    return FastJSONResponse(content=quote.payload, headers=headers)
+
+# --- Stream Router (SSE) ---
+stream_router = APIRouter(prefix="/api/v1/stream", tags=["Stream"])
+@stream_router.get("")
+async def stream_events(request: Request, topics: str = "prices", order_id: Optional[int] = None, token: Optional[str] = None):
+    """
+    Server-Sent Events：topics=prices,orders
+    - prices 公开；orders 需通过 ?token= 鉴权 (EventSource 无法带 Authorization 头)
+    - 普通用户/司机只收到与自己相关的订单，可用 order_id 进一步过滤
+    """
+    topic_set = {t.strip() for t in topics.split(",") if t.strip()}
+    if not topic_set <= {"prices", "orders"}: raise HTTPException(status_code=400, detail="Unknown topic")
+    principal = await authenticate_stream(token) if token else None
+    if "orders" in topic_set and principal is None: raise HTTPException(status_code=401, detail="Token required for orders topic")
+    sub = event_hub.subscribe(Subscription(
+        topic_set, user_id=principal.id if principal else None,
+        is_admin=bool(principal and principal.is_admin), order_id=order_id,
+    ))
+
+    async def event_stream():
+        try:
+            yield "retry: 5000\n\n"
+            if "prices" in topic_set and copper_snapshot.current:
+                yield f"event: prices\ndata: {json.dumps(copper_snapshot.current.payload, ensure_ascii=False)}\n\n"
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(sub.queue.get(), settings.STREAM_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                if event is None: break  # 被判定为慢消费者
+                topic, data = event
+                yield f"event: {topic}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+        finally:
+            event_hub.unsubscribe(sub)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 # --- Auth Router ---
 auth_router = APIRouter(prefix="/api/v1/auth", tags=["Auth"])
 @auth_router.post("/login", response_model=Token)
 async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
     user = await get_user_by_email(db, form_data.username)
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    if not user or not await verify_password_async(form_data.password, user.hashed_password):
         raise HTTPException(status_code=401, detail="Incorrect email or password")
     if not user.is_active: raise HTTPException(status_code=400, detail="Inactive user")
+    if settings.PASSWORD_REHASH_ON_LOGIN and password_needs_rehash(user.hashed_password):
+        user.hashed_password = await get_password_hash_async(form_data.password)
+        await db.commit()
     access_token = create_access_token(data={"sub": user.email})
     return {"access_token": access_token, "token_type": "bearer", "user": user}
 
 @auth_router.post("/register", response_model=UserResponse)
 async def register(user: UserCreate, db: AsyncSession = Depends(get_db)):
     if await get_user_by_email(db, user.email): raise HTTPException(status_code=400, detail="Email already registered")
-    db_user = User(email=user.email, username=user.username, hashed_password=get_password_hash(user.password), company_name=user.company_name, role=user.role, is_admin=user.role=="admin")
+    hashed_password = await get_password_hash_async(user.password)
+    db_user = User(email=user.email, username=user.username, hashed_password=hashed_password, company_name=user.company_name, role=user.role, is_admin=user.role=="admin")
     db.add(db_user)
     await db.commit()
     await db.refresh(db_user)
@@ -916,14 +2832,26 @@ async def register(user: UserCreate, db: AsyncSession = Depends(get_db)):
 
 @auth_router.post("/logout")
 async def logout(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
-    db.add(TokenBlocklist(token=token))
-    await db.commit()
+    """只把签名有效且带 exp 的 token 写入黑名单 (到期后可被清理)；已过期的 token 本身已失效，无需记录"""
+    try:
+        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM], options={"require_exp": True})
+    except ExpiredSignatureError:
+        return {"message": "Successfully logged out"}
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Could not validate credentials", headers={"WWW-Authenticate": "Bearer"})
+    expires_at = datetime.utcfromtimestamp(payload["exp"])
+    db.add(TokenBlocklist(token=token, expires_at=expires_at))
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()  # 重复注销
+    revoked_tokens.add(token, expires_at)
     return {"message": "Successfully logged out"}
 
 # --- Users Router ---
 users_router = APIRouter(prefix="/api/v1/users", tags=["Users"])
 @users_router.get("/me", response_model=UserResponse)
-async def read_users_me(current_user: User = Depends(get_current_user)):
+async def read_users_me(current_user: Principal = Depends(get_current_user)):
     return current_user
 
 @users_router.get("/", response_model=List[UserResponse])
@@ -941,9 +2869,9 @@ categories_router = APIRouter(prefix="/api/v1/categories", tags=["Categories"])
 
 @categories_router.get("/", response_model=List[CategoryResponse])
 async def read_categories(skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_db)):
-    """获取分类列表 (平铺结构)"""
-    res = await db.execute(select(Category).options(selectinload(Category.children)).offset(skip).limit(limit))
-    return res.scalars().all()
+    """获取分类列表 (平铺结构，每项带完整子树)；直接取自缓存的分类树，不查库"""
+    index = await category_index.load(db)
+    return list(index.nodes.values())[skip:skip + limit]
 
 @categories_router.delete("/{id}")
 async def delete_category(id: int, db: AsyncSession = Depends(get_db), _ = Depends(get_current_active_superuser)):
@@ -954,29 +2882,32 @@ async def delete_category(id: int, db: AsyncSession = Depends(get_db), _ = Depen
         raise HTTPException(status_code=404, detail="Category not found")
     await db.delete(cat)
     await db.commit()
+    catalog_cache.invalidate()
     return {"ok": True}
 
 # --- Products Router ---
 
 products_router = APIRouter(prefix="/api/v1/products", tags=["Products"])
 @products_router.get("/categories/tree", response_model=List[CategoryTree])
-async def get_category_tree(db: AsyncSession = Depends(get_db)):
-    res = await db.execute(select(Category))
-    all_cats = res.scalars().all()
-    cat_map = {c.id: CategoryTree(id=c.id, name=c.name, parent_id=c.parent_id, children=[]) for c in all_cats}
-    roots = []
-    for cat in all_cats:
-        node = cat_map[cat.id]
-        if cat.parent_id is None: roots.append(node)
-        else:
-            if parent := cat_map.get(cat.parent_id): parent.children.append(node)
-    return roots
+async def get_category_tree(request: Request, db: AsyncSession = Depends(get_db)):
+    """分类树 (导航每页都会请求)：缓存已编码的 JSON，分类变更后重建；与商品列表共用目录 ETag"""
+    headers = {"ETag": catalog_cache.etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, catalog_cache.etag):
+        return Response(status_code=304, headers=headers)
+    return FastJSONResponse((await category_index.load(db)).tree_json, headers=headers)
 
 @products_router.post("/categories/", response_model=CategoryResponse)
 async def create_category(cat: CategoryCreate, db: AsyncSession = Depends(get_db), _=Depends(get_current_active_superuser)):
+    parent = None
+    if cat.parent_id is not None:
+        parent = (await db.execute(select(Category).filter(Category.id == cat.parent_id))).scalars().first()
+        if not parent: raise HTTPException(status_code=404, detail="父分类不存在")
     db_cat = Category(name=cat.name, parent_id=cat.parent_id)
     db.add(db_cat)
+    await db.flush()
+    db_cat.path = f"{parent.path if parent and parent.path else '/'}{db_cat.id}/"
     await db.commit()
+    catalog_cache.invalidate()
     return (await db.execute(select(Category).options(selectinload(Category.children)).filter(Category.id==db_cat.id))).scalars().first()
 
 @products_router.delete("/categories/{id}")
@@ -996,6 +2927,7 @@ async def delete_product_category(id: int, db: AsyncSession = Depends(get_db), _
         
     await db.delete(cat)
     await db.commit()
+    catalog_cache.invalidate()
     return {"ok": True}
 
 @products_router.post("/convert-from-cost", response_model=ProductResponse)
@@ -1034,16 +2966,50 @@ async def convert_cost_to_product(payload: ConvertCostToProduct, db: AsyncSessio
     cost_item.is_converted = True
 
     await db.commit()
+    catalog_cache.invalidate()
     
     # 6. 返回完整结构
     return (await db.execute(select(Product).options(selectinload(Product.variants)).filter(Product.id == new_product.id))).scalars().first()
 
 @products_router.get("/", response_model=List[ProductResponse])
-async def read_products(skip: int = 0, limit: int = 100, category_id: Optional[int] = None, search: Optional[str] = None, db: AsyncSession = Depends(get_db)):
-    query = select(Product).options(selectinload(Product.variants))
-    if category_id: query = query.filter(Product.category_id == category_id)
-    if search: query = query.filter(Product.name.contains(search))
-    return (await db.execute(query.offset(skip).limit(limit))).scalars().all()
+async def read_products(request: Request, skip: int = 0, limit: int = 100, category_id: Optional[int] = None, include_descendants: bool = False, search: Optional[str] = None, db: AsyncSession = Depends(get_db)):
+    """商品列表 (命中缓存时不查库；ETag 未变化时返回 304)；include_descendants 时包含子分类下的商品"""
+    etag = catalog_cache.etag
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    key = (category_id, include_descendants, search, skip, limit)
+    version = catalog_cache.version
+    payload = catalog_cache.get(key)
+    if payload is None:
+        query = select(Product).options(selectinload(Product.variants))
+        if category_id and include_descendants: query = query.filter((await category_index.load(db)).subtree_filter(category_id))
+        elif category_id: query = query.filter(Product.category_id == category_id)
+        if search:
+            ranked = search_index.product_ranking(search)
+            if ranked is not None: query = query.join(ranked, ranked.c.id == Product.id).order_by(ranked.c.score, Product.id)
+            else: query = query.filter(product_search_filter(search))
+        products = (await db.execute(query.offset(skip).limit(limit))).scalars().all()
+        payload = orm_json(ProductResponse, products)
+        # 查询期间目录若已变更，则不写入缓存，避免旧数据挂在新版本号下
+        if version == catalog_cache.version:
+            catalog_cache.put(key, payload)
+    # 压缩结果与原文一起缓存，命中时不必每次重新压缩 (带 Content-Encoding 的响应中间件会直接透传)
+    encoding = negotiate_encoding(request.headers.get("accept-encoding", "")) if 0 < settings.COMPRESS_MIN_BYTES <= len(payload) else None
+    if encoding:
+        body = catalog_cache.get(key + (encoding,))
+        if body is None:
+            body = await run_in_threadpool(compress_body, payload, encoding)
+            if version == catalog_cache.version: catalog_cache.put(key + (encoding,), body)
+        return Response(content=body, media_type="application/json", headers={**headers, "Content-Encoding": encoding})
+    return FastJSONResponse(content=payload, headers=headers)
+
+@products_router.get("/availability", response_model=List[VariantAvailability])
+async def read_availability(ids: List[int] = Query(..., max_length=500), db: AsyncSession = Depends(get_db)):
+    """按变体 id 查询可用库存 (stock - reserved)，主键查找，不扫描流水；已删除的规格不返回"""
+    res = await db.execute(select(ProductVariant.id, ProductVariant.stock, _reserved).where(ProductVariant.id.in_(ids), ProductVariant.deleted_at.is_(None)))
+    return [{"variant_id": vid, "stock": stock or 0, "reserved": reserved, "available": (stock or 0) - reserved} for vid, stock, reserved in res.all()]
 
 @products_router.get("/{id}", response_model=ProductResponse)
 async def read_product(id: int, db: AsyncSession = Depends(get_db)):
@@ -1058,10 +3024,63 @@ async def create_product(product: ProductCreate, db: AsyncSession = Depends(get_
     for v in product.variants: db_product.variants.append(ProductVariant(**v.dict()))
     db.add(db_product)
     await db.commit()
+    catalog_cache.invalidate()
     await db.refresh(db_product)
     return db_product
 
-@products_router.put("/{id}", response_model=ProductResponse)
+@products_router.post("/import")
+async def import_products(file: UploadFile = File(...), upsert: bool = True, db: AsyncSession = Depends(get_db), _=Depends(get_current_active_superuser)):
+    """批量导入商品 (CSV / XLSX，每行一个变体)；upsert=true 时按 sku_code 覆盖已有变体"""
+    try:
+        return await run_import(db, file, import_product_chunk, upsert)
+    finally:
+        catalog_cache.invalidate()
+
+VARIANT_FIELDS = tuple(ProductVariantCreate.model_fields)
+
+async def sync_product_variants(db: AsyncSession, product_id: int, incoming: List[dict]) -> dict:
+    """
+    按 id (其次 sku_code) 将提交的变体与库中变体对齐：
+    只更新有变化的列 (按变化列分组 executemany)，新增的批量插入，未提交的软删除。
+    软删除的变体再次提交时恢复。
+    """
+    table = ProductVariant.__table__
+    rows = (await db.execute(select(table).where(table.c.product_id == product_id).order_by(table.c.id))).mappings().all()
+    by_id = {r["id"]: r for r in rows}
+    by_sku = {}
+    for r in rows:
+        # 同一 sku_code 有多行时优先匹配未删除的
+        if r["sku_code"] and (r["sku_code"] not in by_sku or r["deleted_at"] is None): by_sku[r["sku_code"]] = r
+
+    matched, inserts, updates = set(), [], {}
+    for v in incoming:
+        v = dict(v)
+        row = by_id.get(v.pop("id", None))
+        if row is None and v.get("sku_code"): row = by_sku.get(v["sku_code"])
+        if row is None or row["id"] in matched:
+            inserts.append({**v, "product_id": product_id})
+            continue
+        matched.add(row["id"])
+        changed = {f: v[f] for f in VARIANT_FIELDS if row[f] != v[f]}
+        if row["deleted_at"] is not None: changed["deleted_at"] = None
+        if changed: updates.setdefault(tuple(sorted(changed)), []).append({"_id": row["id"], **changed})
+    removed = [r["id"] for r in rows if r["id"] not in matched and r["deleted_at"] is None]
+
+    conn = await db.connection()
+    for columns, params in updates.items():
+        stmt = update(table).where(table.c.id == bindparam("_id")).values({f: bindparam(f) for f in columns})
+        await conn.execute(stmt, params)
+    inserted = []
+    if inserts:
+        res = await conn.execute(insert(table).returning(table.c.id, sort_by_parameter_order=True), inserts)
+        inserted = res.scalars().all()
+    if removed:
+        await conn.execute(update(table).where(table.c.id.in_(removed)).values(deleted_at=datetime.utcnow()))
+
+    updated = [p["_id"] for params in updates.values() for p in params]
+    return {"inserted": inserted, "updated": updated, "deleted": removed, "unchanged": len(matched) - len(updated)}
+
+@products_router.put("/{id}", response_model=ProductUpdateResponse)
 async def update_product(
     id: int, 
     product_in: ProductUpdate, 
@@ -1087,24 +3106,24 @@ async def update_product(
         if field in update_data:
             setattr(db_product, field, update_data[field])
 
-    # 3. 更新变体信息 (覆盖式更新)
-    if "variants" in update_data and update_data["variants"] is not None:
-        # 删除旧变体
-        await db.execute(delete(ProductVariant).where(ProductVariant.product_id == id))
-        # 插入新变体
-        for v_data in update_data["variants"]:
-            new_variant = ProductVariant(**v_data, product_id=id)
-            db.add(new_variant)
-
     try:
+        # 3. 更新变体信息 (按 id / sku_code 差异更新，保留变体主键)
+        changes = None
+        if "variants" in update_data and update_data["variants"] is not None:
+            changes = await sync_product_variants(db, id, [v.dict() for v in product_in.variants])
+
         await db.commit()
+        catalog_cache.invalidate()
         # 重新拉取完整数据返回
         final_res = await db.execute(
             select(Product)
             .options(selectinload(Product.variants))
             .filter(Product.id == id)
+            .execution_options(populate_existing=True)
         )
-        return final_res.scalars().first()
+        result = ProductUpdateResponse.model_validate(final_res.scalars().first())
+        if changes is not None: result.changes = VariantChangeSummary(**changes)
+        return result
     except Exception as e:
         await db.rollback()
         raise HTTPException(status_code=500, detail=f"保存失败: {str(e)}")
@@ -1169,26 +3188,11 @@ async def update_cart_item(
 
 @cart_router.get("/", response_model=List[CartItemResponse])
 async def read_cart(db: AsyncSession = Depends(get_db), current_user=Depends(get_current_user)):
-    items = await get_cart_items(db, current_user.id)
-    return [
-        {
-            "id": i.id, 
-            "variant_id": i.variant_id, 
-            "quantity": i.quantity, 
-            "product_name": i.variant.product.name, 
-            "spec": i.variant.spec,   # 🟢 确保包含
-            "color": i.variant.color, # 🟢 补全
-            "unit": i.variant.unit,   # 🟢 补全
-            "price": i.variant.price, 
-            "subtotal": i.variant.price * i.quantity, 
-            "image_url": i.variant.product.image_url
-        } 
-        for i in items if i.variant and i.variant.product
-    ]
+    return FastJSONResponse([cart_line_response(line) for line in await price_cart(db, current_user.id)])
 
 @cart_router.post("/", response_model=CartItemResponse)
 async def add_to_cart(cart_data: CartItemCreate, db: AsyncSession = Depends(get_db), current_user=Depends(get_current_user)):
-    res = await db.execute(select(ProductVariant).filter(ProductVariant.id == cart_data.variant_id))
+    res = await db.execute(select(ProductVariant).filter(ProductVariant.id == cart_data.variant_id, ProductVariant.deleted_at.is_(None)))
     variant = res.scalars().first()
     if not variant: 
         raise HTTPException(status_code=404, detail="产品规格不存在")
@@ -1210,7 +3214,7 @@ async def add_to_cart(cart_data: CartItemCreate, db: AsyncSession = Depends(get_
     full_item = (await db.execute(query)).scalars().first()
     
     # 🟢 关键修复：返回所有 CartItemResponse 要求的字段
-    return {
+    return FastJSONResponse({
         "id": full_item.id, 
         "variant_id": full_item.variant_id, 
         "quantity": full_item.quantity, 
@@ -1221,8 +3225,71 @@ async def add_to_cart(cart_data: CartItemCreate, db: AsyncSession = Depends(get_
         "price": full_item.variant.price, 
         "subtotal": full_item.variant.price * full_item.quantity,
         "image_url": full_item.variant.product.image_url
+    })
+
+def cart_line_response(line) -> dict:
+    return {
+        "id": line.id, "variant_id": line.variant_id, "quantity": line.quantity, "product_name": line.name,
+        "spec": line.spec, "color": line.color, "unit": line.unit, "price": line.price,
+        "subtotal": line.price * line.quantity, "image_url": line.image_url,
     }
 
+@cart_router.post("/batch", response_model=CartBatchResponse)
+async def batch_update_cart(payload: CartBatchRequest, db: AsyncSession = Depends(get_db), current_user=Depends(get_current_user)):
+    """
+    批量修改购物车 (粘贴 BOM 等场景)：一次 IN 查询解析全部规格，
+    合并为每个规格的目标数量后分别以 executemany UPDATE / 多行 INSERT / DELETE 写入，返回完整购物车。
+    无法解析的行与负数量记入 errors，不影响其余行。
+    """
+    ids = {op.variant_id for op in payload.items if op.variant_id is not None}
+    skus = {op.sku_code for op in payload.items if op.variant_id is None and op.sku_code}
+    conds = [ProductVariant.id.in_(ids)] if ids else []
+    if skus: conds.append(ProductVariant.sku_code.in_(skus))
+    by_id, by_sku = {}, {}
+    if conds:
+        res = await db.execute(select(ProductVariant.id, ProductVariant.sku_code).where(or_(*conds), ProductVariant.deleted_at.is_(None)))
+        for vid, sku in res.all():
+            by_id[vid] = vid
+            if sku: by_sku.setdefault(sku, vid)
+
+    res = await db.execute(select(CartItem.id, CartItem.variant_id, CartItem.quantity).where(CartItem.user_id == current_user.id))
+    existing, duplicates = {}, {}
+    for line_id, vid, qty in res.all():
+        if vid in existing:  # 历史上的重复行：以第一条为准，本次涉及该规格时一并删除
+            duplicates.setdefault(vid, []).append(line_id)
+            continue
+        existing[vid] = (line_id, qty)
+
+    # 按顺序把各操作折算为每个规格的目标数量
+    target, errors = {}, []
+    for index, op in enumerate(payload.items):
+        vid = by_id.get(op.variant_id) if op.variant_id is not None else by_sku.get(op.sku_code)
+        if vid is None:
+            errors.append({"index": index, "detail": f"产品规格不存在: {op.variant_id if op.variant_id is not None else op.sku_code}"})
+            continue
+        if op.op != "remove" and op.quantity < 0:
+            errors.append({"index": index, "detail": f"数量不能为负数: {op.quantity}"})
+            continue
+        current = target.get(vid, existing[vid][1] if vid in existing else 0)
+        if op.op == "add": target[vid] = current + op.quantity
+        elif op.op == "set": target[vid] = op.quantity
+        else: target[vid] = 0
+
+    updates = [{"_id": existing[vid][0], "quantity": q} for vid, q in target.items() if vid in existing and q > 0 and q != existing[vid][1]]
+    inserts = [{"user_id": current_user.id, "variant_id": vid, "quantity": q} for vid, q in target.items() if vid not in existing and q > 0]
+    removed = [existing[vid][0] for vid, q in target.items() if vid in existing and q <= 0]
+    removed += [line_id for vid in target for line_id in duplicates.get(vid, ())]
+    table = CartItem.__table__
+    if updates:
+        await db.execute(update(table).where(table.c.id == bindparam("_id")).values(quantity=bindparam("quantity")), updates)
+    if inserts:
+        await db.execute(insert(table), inserts)
+    if removed:
+        await db.execute(delete(table).where(table.c.id.in_(removed)))
+    await db.commit()
+
+    return {"items": [cart_line_response(line) for line in await price_cart(db, current_user.id)], "errors": errors}
+
 # 🟢 [新增] 删除购物车条目接口 (前端 useCart.js 需要)
 @cart_router.delete("/{id}")
 async def delete_cart_item(id: int, db: AsyncSession = Depends(get_db), current_user=Depends(get_current_user)):
@@ -1244,70 +3311,80 @@ async def create_order(db: AsyncSession = Depends(get_db), current_user=Depends(
 # 1. 新增：公开物流追踪接口 (无需登录)
 # --------------------------------------------------------------------------
 @orders_router.get("/track/{order_id}")
-async def track_order_public(order_id: int, db: AsyncSession = Depends(get_db)):
+async def track_order_public(order_id: int):
     """
-    公开查询订单状态 (仅返回脱敏后的物流信息)
+    公开查询订单状态 (仅返回脱敏后的物流信息；投影查询 + 短时缓存，不加载订单明细)
     """
-    order = await get_order_by_id(db, order_id)
-    if not order:
+    snapshot = await tracking.snapshot(order_id)
+    if not snapshot:
         raise HTTPException(status_code=404, detail="订单号不存在")
-    
-    # 构建脱敏信息
-    driver_info = "等待分配"
-    if order.driver:
-        # 司机姓名脱敏 (如: 王师傅)
-        driver_name = order.driver.username[0] + "师傅" if order.driver.username else "司机"
-        driver_info = f"{driver_name} (正在配送)"
-    
-    status_map = {
-        "pending_confirmation": "待确认",
-        "confirmed": "仓库备货中",
-        "delivering": "配送途中",
-        "completed": "已送达",
-        "cancelled": "已取消"
-    }
-    
-    return {
-        "id": order.id,
-        "status_text": status_map.get(order.status, "处理中"),
-        "driver_info": driver_info,
-        "updated_at": order.created_at.strftime("%Y-%m-%d %H:%M"),
-        "item_count": len(order.items)
-    }
+    return snapshot
+
+@orders_router.websocket("/track/{order_id}/ws")
+async def track_order_ws(websocket: WebSocket, order_id: int):
+    """订单追踪推送：连接后立即发送当前快照，之后状态或司机位置变化时推送"""
+    ip = websocket.client.host if websocket.client else "-"
+    if not tracking.admit(ip):
+        await websocket.close(code=1013)  # Try Again Later
+        return
+    try:
+        snapshot = await tracking.snapshot(order_id)
+        if not snapshot:
+            await websocket.close(code=4404)
+            return
+        await websocket.accept()
+        await websocket.send_json(snapshot)
+        tracking.join(order_id, websocket, snapshot)
+        while True:
+            await websocket.receive_text()  # 忽略客户端消息，仅用于感知断开
+    except WebSocketDisconnect:
+        pass
+    finally:
+        tracking.leave(order_id, websocket)
+        tracking.release(ip)
 
 # --------------------------------------------------------------------------
 # 2. 新增：管理后台统计看板 (Admin Dashboard)
 # --------------------------------------------------------------------------
 @app.get("/api/v1/admin/stats", dependencies=[Depends(get_current_active_superuser)])
-async def get_admin_dashboard_stats(db: AsyncSession = Depends(get_db)):
+async def get_admin_dashboard_stats(period: Optional[str] = None, start: Optional[datetime] = None, end: Optional[datetime] = None, db: AsyncSession = Depends(get_db)):
     """
     聚合统计数据：待处理询价、待发货、销售额、活跃司机、库存预警
+    - 状态计数优先读计数表 (O(1) 行)，未启用时走 COUNT ... GROUP BY status
+    - 销售额默认为全部已完成订单；传 period=month / 30d 或 start/end 时按下单时间筛选
     """
-    # 1. 待处理询价 (Pending Inquiries)
-    q_inq = select(Inquiry).filter(Inquiry.status == InquiryStatus.PENDING)
-    res_inq = await db.execute(q_inq)
-    pending_inquiries = len(res_inq.scalars().all())
-
-    # 2. 待发货/配送中订单 (Active Orders)
-    q_ord = select(Order).filter(Order.status.in_([OrderStatus.CONFIRMED, OrderStatus.DELIVERING]))
-    res_ord = await db.execute(q_ord)
-    active_orders = len(res_ord.scalars().all())
-
-    # 3. 本月销售额 (Total Sales - Completed)
-    # 简化逻辑：计算所有 Completed 订单的总额
-    q_sales = select(Order).filter(Order.status == OrderStatus.COMPLETED)
-    res_sales = await db.execute(q_sales)
-    sales_orders = res_sales.scalars().all()
-    total_sales = sum([o.final_total_price for o in sales_orders])
+    start, end = resolve_stats_range(period, start, end)
+
+    # 1-2. 各状态的订单/询价数量与金额
+    if settings.DASHBOARD_COUNTERS:
+        rows = (await db.execute(select(StatusCounter))).scalars().all()
+        counters = {(r.scope, r.status): (r.count, r.amount) for r in rows}
+    else:
+        counters = {}
+        for scope, (model, _, _, amount_field) in COUNTER_SCOPES.items():
+            amount_col = func.sum(getattr(model, amount_field)) if amount_field else func.sum(0.0)
+            for st, cnt, amt in (await db.execute(select(model.status, func.count(), amount_col).group_by(model.status))).all():
+                counters[(scope, _status_value(st))] = (cnt, amt or 0.0)
+    count_of = lambda scope, st: counters.get((scope, st.value), (0, 0.0))[0]
+
+    pending_inquiries = count_of("inquiry", InquiryStatus.PENDING)
+    active_orders = count_of("order", OrderStatus.CONFIRMED) + count_of("order", OrderStatus.DELIVERING)
+
+    # 3. 销售额 (Completed)
+    if start or end:
+        q_sales = select(func.coalesce(func.sum(Order.final_total_price), 0.0)).filter(Order.status == OrderStatus.COMPLETED)
+        if start: q_sales = q_sales.filter(Order.created_at >= start)
+        if end: q_sales = q_sales.filter(Order.created_at < end)
+        total_sales = (await db.execute(q_sales)).scalar_one()
+    else:
+        total_sales = counters.get(("order", OrderStatus.COMPLETED.value), (0, 0.0))[1]
 
     # 4. 活跃司机 (Active Drivers)
-    q_driver = select(User).filter(User.role == UserRole.DRIVER)
-    res_driver = await db.execute(q_driver)
-    driver_count = len(res_driver.scalars().all())
+    driver_count = (await db.execute(select(func.count()).select_from(User).filter(User.role == UserRole.DRIVER))).scalar_one()
 
     # 5. 库存预警 (Low Stock Variants < 1000)
     # 获取前 5 个库存紧张的产品
-    q_stock = select(ProductVariant).filter(ProductVariant.stock < 1000).options(joinedload(ProductVariant.product)).limit(5)
+    q_stock = select(ProductVariant).filter(ProductVariant.stock < 1000, ProductVariant.deleted_at.is_(None)).options(joinedload(ProductVariant.product)).limit(5)
     res_stock = await db.execute(q_stock)
     low_stock_items = []
     for v in res_stock.scalars().all():
@@ -1322,10 +3399,54 @@ async def get_admin_dashboard_stats(db: AsyncSession = Depends(get_db)):
         "active_orders": active_orders,
         "total_sales": total_sales,
         "active_drivers": driver_count,
-        "low_stock_items": low_stock_items
+        "low_stock_items": low_stock_items,
+        "order_status_counts": {st.value: count_of("order", st) for st in OrderStatus},
+        "inquiry_status_counts": {st.value: count_of("inquiry", st) for st in InquiryStatus},
+        "sales_start": start.isoformat() if start else None,
+        "sales_end": end.isoformat() if end else None
     }
 
 # 🟢 关键修复: 添加 /my 接口 (必须在 /{order_id} 之前)
+async def authorize_location(db: AsyncSession, order_id: int, principal: Principal) -> int:
+    """
+    校验上报者是该订单的配送司机 (或管理员)，返回司机 id；
+    归属关系在 driver_locations 中缓存 LOCATION_ASSIGNMENT_TTL_SECONDS 秒，过期后重新查库。
+    """
+    driver_id = driver_locations.assigned_driver(order_id)
+    if driver_id is None:
+        row = (await db.execute(select(Order.driver_id, Order.status).filter(Order.id == order_id))).first()
+        if not row: raise HTTPException(status_code=404, detail="Order not found")
+        if row.status != OrderStatus.DELIVERING or row.driver_id is None:
+            driver_locations.forget_order(order_id)
+            raise HTTPException(status_code=400, detail="订单当前不在配送中")
+        driver_id = row.driver_id
+        driver_locations.assign(order_id, driver_id)
+    if not principal.is_admin and driver_id != principal.id: raise HTTPException(status_code=403)
+    return driver_id
+
+@orders_router.post("/driver/location")
+async def report_driver_location(body: DriverLocationBatch, db: AsyncSession = Depends(get_db), current_user=Depends(get_current_user)):
+    """司机一次上报一批定位点，并同步到 order_ids 中的配送订单 (只写内存，定时合并写库)"""
+    if current_user.role != UserRole.DRIVER.value: raise HTTPException(status_code=403)
+    for order_id in body.order_ids:
+        if await authorize_location(db, order_id, current_user) != current_user.id: raise HTTPException(status_code=403)
+    latest = driver_locations.record(current_user.id, to_fixes(body), body.order_ids)
+    for order_id in body.order_ids: tracking.notify(order_id, stale=False)
+    return {"ok": True, "accepted": len(body.fixes), "lat": latest and latest.lat, "lng": latest and latest.lng}
+
+@orders_router.get("/driver/positions", response_model=List[DriverPosition], dependencies=[Depends(get_current_active_superuser)])
+async def read_driver_positions(history: bool = False):
+    """全部在线司机的最新位置 (直接读内存，不查库)"""
+    positions = []
+    for driver_id, track in driver_locations.active(settings.LOCATION_ACTIVE_SECONDS):
+        latest = track[-1]
+        positions.append({
+            "driver_id": driver_id, "lat": latest.lat, "lng": latest.lng, "recorded_at": latest.recorded_at,
+            "order_ids": driver_locations.orders_of(driver_id),
+            "history": [{"lat": f.lat, "lng": f.lng, "recorded_at": f.recorded_at} for f in track] if history else None,
+        })
+    return positions
+
 @orders_router.get("/my", response_model=List[OrderResponse])
 async def read_my_orders(db: AsyncSession = Depends(get_db), current_user = Depends(get_current_user)):
     """快捷入口：查看我自己的订单"""
@@ -1335,12 +3456,18 @@ async def read_my_orders(db: AsyncSession = Depends(get_db), current_user = Depe
     return (await db.execute(query)).unique().scalars().all()
 
 @orders_router.get("/", response_model=List[OrderResponse])
-async def read_orders(skip: int = 0, limit: int = 100, q: Optional[str] = None, db: AsyncSession = Depends(get_db), current_user = Depends(get_current_user)):
-    query = select(Order).options(joinedload(Order.items), joinedload(Order.user), joinedload(Order.driver)).order_by(desc(Order.created_at))
+async def read_orders(response: Response, skip: int = 0, limit: int = 100, q: Optional[str] = None, after: Optional[str] = None, db: AsyncSession = Depends(get_db), current_user = Depends(get_current_user)):
+    """订单列表：传 after 游标走 (created_at, id) 键集分页，否则兼容 skip/limit"""
+    # items 用 selectinload 单独批量加载，LIMIT 只作用于订单行
+    query = select(Order).options(selectinload(Order.items), joinedload(Order.user), joinedload(Order.driver))
+    query = apply_keyset(query, Order.created_at, Order.id, after)
     if current_user.role == "driver": query = query.filter(Order.driver_id == current_user.id)
     elif not (current_user.is_admin or current_user.role == "admin"): query = query.filter(Order.user_id == current_user.id)
-    if q: query = query.join(User).filter(or_(User.email.ilike(f"%{q}%"), cast(Order.id, String).ilike(f"%{q}%")))
-    return (await db.execute(query.offset(skip).limit(limit))).unique().scalars().all()
+    if q: query = query.join(User, Order.user_id == User.id).filter(or_(User.email.ilike(f"%{q}%"), cast(Order.id, String).ilike(f"%{q}%")))
+    if not after: query = query.offset(skip)
+    orders = (await db.execute(query.limit(limit))).unique().scalars().all()
+    set_next_cursor(response, orders, "created_at", limit)
+    return orders
 
 @orders_router.get("/{order_id}", response_model=OrderResponse)
 async def read_order_detail(order_id: int, db: AsyncSession = Depends(get_db), current_user = Depends(get_current_user)):
@@ -1357,8 +3484,28 @@ async def assign_driver(order_id: int, req: AssignDriverRequest, db: AsyncSessio
     order.driver_id = req.driver_id
     order.status = OrderStatus.DELIVERING
     await db.commit()
+    driver_locations.forget_order(order_id)
+    publish_order_event(order)
     return await get_order_by_id(db, order_id)
 
+async def claim_order_status(db: AsyncSession, order: Order, new_status: OrderStatus) -> bool:
+    """
+    条件更新订单状态 (WHERE status = 读取时的状态)，并发请求中只有一个能完成迁移。
+    批量 UPDATE 不经过 before_flush，看板计数在此同步调整。
+    """
+    old_status = order.status
+    res = await db.execute(
+        update(Order).where(Order.id == order.id, Order.status == old_status)
+        .values(status=new_status).execution_options(synchronize_session=False)
+    )
+    if res.rowcount != 1: return False
+    set_committed_value(order, "status", new_status)
+    if settings.DASHBOARD_COUNTERS:
+        amount = order.final_total_price or 0.0
+        deltas = {("order", _status_value(old_status)): (-1, -amount), ("order", _status_value(new_status)): (1, amount)}
+        for stmt in counter_updates(deltas): await db.execute(stmt)
+    return True
+
 @orders_router.patch("/{order_id}/confirm", response_model=OrderResponse)
 async def confirm_order(
     order_id: int, 
@@ -1378,26 +3525,25 @@ async def confirm_order(
     if order.status != OrderStatus.PENDING_CONFIRMATION:
         raise HTTPException(status_code=400, detail="订单状态不正确，无法确认")
 
-    # 🟢 库存检查与扣减
-    for item in order.items:
-        if not item.variant_id:
-            continue
-            
-        # 锁定行以防止并发扣减
-        v_res = await db.execute(select(ProductVariant).filter(ProductVariant.id == item.variant_id).with_for_update())
-        variant = v_res.scalars().first()
-        
-        if not variant:
-            raise HTTPException(status_code=400, detail=f"商品 {item.product_name} 规格已失效")
-            
-        if variant.stock < item.quantity:
-            raise HTTPException(status_code=400, detail=f"商品 {item.product_name} ({item.product_spec}) 库存不足 (剩余: {variant.stock})")
-            
-        variant.stock -= item.quantity
-        db.add(variant)
-
-    order.status = OrderStatus.CONFIRMED
+    # 🟢 库存检查与扣减 (先抢占状态，再按批条件扣减；任一规格不足则整体回滚)
+    labels = {item.variant_id: (item.product_name, item.product_spec) for item in order.items if item.variant_id}
+    if not await claim_order_status(db, order, OrderStatus.CONFIRMED):
+        raise HTTPException(status_code=400, detail="订单状态已变化，请刷新后重试")
+    quantities = order_quantities(order)
+    await unreserve_stock(db, await order_reservations(db, order.id))
+    failed = await deduct_stock(db, quantities)
+    if failed:
+        await db.rollback()
+        name, spec = labels[failed[0]]
+        stock = (await db.execute(select(ProductVariant.stock).filter(ProductVariant.id == failed[0]))).scalar_one_or_none()
+        if stock is None:
+            raise HTTPException(status_code=400, detail=f"商品 {name} 规格已失效")
+        raise HTTPException(status_code=400, detail=f"商品 {name} ({spec}) 库存不足 (剩余: {stock})")
+    await write_ledger(db, LedgerKind.COMMIT, order.id, quantities)
+
     await db.commit()
+    catalog_cache.invalidate()  # 库存已变化
+    publish_order_event(order)
     return await get_order_by_id(db, order_id)
 
 @orders_router.patch("/{order_id}/cancel", response_model=OrderResponse)
@@ -1421,32 +3567,45 @@ async def cancel_order(
     # 🟢 如果订单已经确认过（即已经扣过库存），则需要返还
     should_restore_stock = order.status in [OrderStatus.CONFIRMED, OrderStatus.DELIVERING]
 
+    if not await claim_order_status(db, order, OrderStatus.CANCELLED):
+        raise HTTPException(status_code=400, detail="订单状态已变化，请刷新后重试")
     if should_restore_stock:
-        for item in order.items:
-            if item.variant_id:
-                v_res = await db.execute(select(ProductVariant).filter(ProductVariant.id == item.variant_id).with_for_update())
-                variant = v_res.scalars().first()
-                if variant:
-                    variant.stock += item.quantity
-                    db.add(variant)
-
-    order.status = OrderStatus.CANCELLED
+        quantities = order_quantities(order)
+        await restore_stock(db, quantities)  # 已失效的规格直接跳过
+        await write_ledger(db, LedgerKind.RESTOCK, order.id, quantities)
+    else:
+        await release_reservations(db, order.id)
+
     await db.commit()
+    if should_restore_stock: catalog_cache.invalidate()  # 库存已返还
+    driver_locations.forget_order(order_id)
+    publish_order_event(order)
     return await get_order_by_id(db, order_id)
 
+@orders_router.post("/{order_id}/location")
+async def report_order_location(order_id: int, body: Union[DriverLocationBatch, DriverLocationUpdate], db: AsyncSession = Depends(get_db), current_user=Depends(get_current_user)):
+    """上报单个或一批定位点 (只写内存，定时合并写库)"""
+    driver_id = await authorize_location(db, order_id, current_user)
+    latest = driver_locations.record(driver_id, to_fixes(body), [order_id])
+    tracking.notify(order_id, stale=False)
+    return {"ok": True, "lat": latest and latest.lat, "lng": latest and latest.lng}
+
 @orders_router.post("/{order_id}/complete", response_model=OrderResponse)
 async def complete_order(order_id: int, file: UploadFile = File(None), db: AsyncSession = Depends(get_db), current_user=Depends(get_current_user)):
     order = await get_order_by_id(db, order_id)
     if not order: raise HTTPException(status_code=404, detail="Order not found")
     if current_user.role != "admin" and order.driver_id != current_user.id: raise HTTPException(status_code=403)
+    image = None
     if file:
-        await validate_image_security(file)
-        fname = f"order_{order_id}_sign_{int(datetime.now().timestamp())}.{file.filename.split('.')[-1]}"
-        fpath = os.path.join(STATIC_DIR, "uploads", fname)
-        with open(fpath, "wb") as buffer: shutil.copyfileobj(file.file, buffer)
-        order.delivery_photo_url = f"/static/uploads/{fname}"
+        image = await store_image_upload(file)
+        order.delivery_photo_url = image.url
+        # 相同内容的缩略图已存在时直接复用，否则在后台生成
+        order.delivery_photo_thumb_url = image.thumb_url if os.path.exists(image.thumb_path) else None
     order.status = OrderStatus.COMPLETED
     await db.commit()
+    if image and not order.delivery_photo_thumb_url: run_in_background(attach_delivery_thumbnail(order_id, image))
+    driver_locations.forget_order(order_id)
+    publish_order_event(order)
     return await get_order_by_id(db, order_id)
 
 # --- News Router ---
@@ -1473,11 +3632,15 @@ async def create_inquiry(inq: InquiryCreate, db: AsyncSession = Depends(get_db),
     return inquiry
 
 @inquiries_router.get("/", response_model=List[InquiryResponse])
-async def read_inquiries(skip: int = 0, limit: int = 100, status: Optional[str] = None, db: AsyncSession = Depends(get_db), current_user=Depends(get_current_user)):
-    query = select(Inquiry).options(selectinload(Inquiry.items), selectinload(Inquiry.user)).order_by(desc(Inquiry.created_at))
+async def read_inquiries(response: Response, skip: int = 0, limit: int = 100, status: Optional[str] = None, after: Optional[str] = None, db: AsyncSession = Depends(get_db), current_user=Depends(get_current_user)):
+    query = select(Inquiry).options(selectinload(Inquiry.items), selectinload(Inquiry.user))
+    query = apply_keyset(query, Inquiry.created_at, Inquiry.id, after)
     if current_user.role != "admin": query = query.filter(Inquiry.user_id == current_user.id)
     if status: query = query.filter(Inquiry.status == status)
-    return (await db.execute(query.offset(skip).limit(limit))).unique().scalars().all()
+    if not after: query = query.offset(skip)
+    inquiries = (await db.execute(query.limit(limit))).unique().scalars().all()
+    set_next_cursor(response, inquiries, "created_at", limit)
+    return inquiries
 
 @inquiries_router.patch("/{inquiry_id}/quote", response_model=InquiryResponse)
 async def quote_inquiry(inquiry_id: int, q: InquiryQuoteUpdate, db: AsyncSession = Depends(get_db), _=Depends(get_current_active_superuser)):
@@ -1492,9 +3655,13 @@ async def quote_inquiry(inquiry_id: int, q: InquiryQuoteUpdate, db: AsyncSession
 # --- Specs Router ---
 specs_router = APIRouter(prefix="/api/v1/specs", tags=["Specs"])
 @specs_router.get("/", response_model=List[TechnicalSpecResponse])
-async def read_specs(skip: int=0, limit: int=100, category: str=None, db: AsyncSession = Depends(get_db)):
+async def read_specs(skip: int=0, limit: int=100, category: str=None, search: str=None, db: AsyncSession = Depends(get_db)):
     query = select(TechnicalSpec)
     if category: query = query.filter(TechnicalSpec.category == category)
+    if search:
+        ranked = search_index.ranking("technical_specs_fts", search)
+        if ranked is not None: query = query.join(ranked, ranked.c.id == TechnicalSpec.id).order_by(ranked.c.score, TechnicalSpec.id)
+        else: query = query.filter(or_(TechnicalSpec.model.contains(search), TechnicalSpec.feature.contains(search)))
     return (await db.execute(query.offset(skip).limit(limit))).scalars().all()
 
 @specs_router.post("/", response_model=TechnicalSpecResponse)
@@ -1508,16 +3675,8 @@ async def create_spec(spec: TechnicalSpecCreate, db: AsyncSession = Depends(get_
 # --- Admin Costs Router ---
 admin_costs_router = APIRouter(prefix="/api/v1/admin/costs", tags=["Admin Cost"], dependencies=[Depends(get_current_active_superuser)])
 
-PROCESS_FEES = {"BVR": 1000, "BV": 200, "RVV": 700}
-
 def calculate_copper_usd_price(market_cny: float, exchange_rate: float, category: str) -> float:
-    base_cny = (market_cny * 0.935) + 1500.0
-    surcharge = 0
-    cat_upper = category.upper() if category else ""
-    if "BVR" in cat_upper: surcharge = PROCESS_FEES["BVR"]
-    elif "RVV" in cat_upper: surcharge = PROCESS_FEES["RVV"]
-    elif "BV" in cat_upper: surcharge = PROCESS_FEES["BV"]
-    return ((base_cny + surcharge) / exchange_rate) / 1000.0
+    return cost_engine.copper_usd_price(market_cny, exchange_rate, category)
 
 
 # 🟢 [新增] 更新成本记录
@@ -1533,31 +3692,17 @@ async def update_cost_record(id: int, cost: CostUpdate, db: AsyncSession = Depen
     for key, value in cost_data.items():
         setattr(db_cost, key, value)
     
-    # 重新计算逻辑 (这部分逻辑最好封装，但为了单文件直接写在这里)
-    density = 0.214 if db_cost.material == "Al" else 0.7
-    # 注意：core_structure 是 JSON 类型，需要处理成对象列表计算
-    # 这里简化处理，假设前端传来的数据是正确的
+    # 重新计算 (core_structure 可能是 CoreGroup 对象或库中的 dict，由 freeze_structure 统一)
     core_struct_list = cost.core_structure if cost.core_structure else db_cost.core_structure
-    
-    # 重新计算重量和金额
-    # 注意：如果你用的是 Pydantic model 传进来的 core_structure，它是一个 List[CoreGroup] 对象
-    # 但如果是从数据库取的，可能是 dict。这里做一下兼容
-    def get_val(obj, key):
-        return getattr(obj, key) if hasattr(obj, key) else obj[key]
-
-    total_cw = 0.0
-    for g in core_struct_list:
-        gauge = get_val(g, 'gauge')
-        strands = get_val(g, 'strands')
-        cores = get_val(g, 'cores')
-        total_cw += (gauge**2 * strands * cores * density * db_cost.length) / 100.0
-
-    db_cost.copper_weight = round(total_cw, 4)
-    db_cost.copper_amount = round(total_cw * db_cost.copper_price, 2)
-    db_cost.pvc_weight = max(0.0, round(db_cost.total_weight - total_cw, 4))
-    db_cost.pvc_amount = round(db_cost.pvc_weight * db_cost.pvc_price, 2)
-    db_cost.total_cost = round(db_cost.copper_amount + db_cost.pvc_amount + db_cost.labor_cost, 2)
-    db_cost.reference_price = round(db_cost.total_cost * 1.15, 2)
+    try:
+        breakdown = cost_engine.compute_cost(
+            cost_engine.freeze_structure(core_struct_list), db_cost.material, db_cost.length,
+            db_cost.total_weight, db_cost.copper_price, db_cost.pvc_price, db_cost.labor_cost,
+        )
+    except cost_engine.CostInputError as e:
+        raise HTTPException(status_code=422, detail=e.rows[0])
+    for key, value in breakdown.items():
+        setattr(db_cost, key, value)
     db_cost.updated_at = datetime.utcnow()
 
     await db.commit()
@@ -1584,56 +3729,119 @@ async def get_cost_categories(db: AsyncSession = Depends(get_db)):
     return sorted([c for c in categories if c])
 
 @admin_costs_router.get("/calculate-unit-price")
-async def get_calculated_unit_price(category: str = "", db: AsyncSession = Depends(get_db)):
-    res = await db.execute(select(CopperPrice).order_by(desc(CopperPrice.updated_at)).limit(1))
-    latest = res.scalars().first()
-    if not latest: raise HTTPException(status_code=400, detail="No market price found")
+async def get_calculated_unit_price(category: str = ""):
+    latest = copper_snapshot.require()
     unit_price = calculate_copper_usd_price(latest.cny_price, latest.exchange_rate, category)
     return {"price": round(unit_price, 4), "market_cny": latest.cny_price, "rate": latest.exchange_rate}
 
+REPRICE_FIELDS = ("copper_price", "copper_weight", "copper_amount", "pvc_weight", "pvc_amount", "total_cost", "reference_price")
+
+async def reprice_costs(db: AsyncSession, quote: CopperQuote, dry_run: bool = False, chunk_size: int = 1000) -> dict:
+    """
+    批量重算全部成本记录：只读取所需列，交给 cost_engine 批量计算，
+    仅对有变化的行分批 executemany UPDATE，全部在同一事务内完成。
+    输入缺失/非法的行不重算也不改写，与导入相同地在 failed / errors 中逐条列出。
+    """
+    started = time.perf_counter()
+    rows = (await db.execute(select(
+        ProductCost.id, ProductCost.spec_name, ProductCost.category, ProductCost.material, ProductCost.core_structure,
+        ProductCost.length, ProductCost.total_weight, ProductCost.pvc_price, ProductCost.labor_cost,
+        *(getattr(ProductCost, f) for f in REPRICE_FIELDS),
+    ))).all()
+    n = len(rows)
+    if n == 0:
+        return {"scanned": 0, "changed": 0, "failed": 0, "errors": [], "elapsed_ms": 0.0, "dry_run": dry_run}
+
+    # 每个分类的铜单价只算一次
+    price_by_category = {}
+    valid, structures, errors = [], [], []
+    for r in rows:
+        if r.category not in price_by_category:
+            price_by_category[r.category] = round(calculate_copper_usd_price(quote.cny_price, quote.exchange_rate, r.category), 4)
+        try:
+            structure = cost_engine.freeze_structure(r.core_structure)
+        except (KeyError, TypeError, AttributeError):
+            problems = ["core_structure is malformed"]
+        else:
+            problems = cost_engine.input_errors(structure, r.length, r.total_weight, price_by_category[r.category], r.pvc_price, r.labor_cost)
+        if problems:
+            errors.append({"id": r.id, "spec_name": r.spec_name, "errors": problems})
+            continue
+        valid.append(r)
+        structures.append(structure)
+    rows = valid
+    copper_prices = [price_by_category[r.category] for r in rows]
+    computed = cost_engine.compute_costs_batch(
+        structures, [r.material for r in rows], [r.length for r in rows],
+        [r.total_weight for r in rows], copper_prices, [r.pvc_price for r in rows], [r.labor_cost for r in rows],
+    )
+
+    changes, diff = [], []
+    columns = {f: computed[f].tolist() for f in cost_engine.COST_FIELDS}
+    columns["copper_price"] = copper_prices
+    for i, r in enumerate(rows):
+        new_values = {f: columns[f][i] for f in REPRICE_FIELDS}
+        changed = {f: [getattr(r, f), v] for f, v in new_values.items() if getattr(r, f) != v}
+        if not changed: continue
+        changes.append({"_id": r.id, **new_values})
+        if dry_run: diff.append({"id": r.id, "spec_name": r.spec_name, "changes": changed})
+
+    if not dry_run and changes:
+        stmt = (
+            update(ProductCost.__table__)
+            .where(ProductCost.__table__.c.id == bindparam("_id"))
+            .values({f: bindparam(f) for f in REPRICE_FIELDS})
+        )
+        conn = await db.connection()
+        for offset in range(0, len(changes), chunk_size):
+            await conn.execute(stmt, changes[offset:offset + chunk_size])
+        await db.commit()
+
+    result = {"scanned": n, "changed": len(changes), "failed": len(errors), "errors": errors, "elapsed_ms": round((time.perf_counter() - started) * 1000, 2), "dry_run": dry_run}
+    if dry_run: result["diff"] = diff
+    return result
+
 @admin_costs_router.post("/sync-market-prices")
-async def sync_costs_with_market(db: AsyncSession = Depends(get_db)):
-    res = await db.execute(select(CopperPrice).order_by(desc(CopperPrice.updated_at)).limit(1))
-    latest = res.scalars().first()
-    if not latest: raise HTTPException(status_code=400, detail="No market price")
-    res_costs = await db.execute(select(ProductCost))
-    updated_count = 0
-    for cost in res_costs.scalars().all():
-        cost.copper_price = round(calculate_copper_usd_price(latest.cny_price, latest.exchange_rate, cost.category), 4)
-        # Recalculate
-        density = 0.214 if cost.material == "Al" else 0.7
-        total_cw = sum([(g['gauge']**2 * g['strands'] * g['cores'] * density * cost.length)/100.0 for g in cost.core_structure])
-        cost.copper_weight = round(total_cw, 4)
-        cost.copper_amount = round(total_cw * cost.copper_price, 2)
-        cost.pvc_weight = max(0.0, round(cost.total_weight - total_cw, 4))
-        cost.pvc_amount = round(cost.pvc_weight * cost.pvc_price, 2)
-        cost.total_cost = round(cost.copper_amount + cost.pvc_amount + cost.labor_cost, 2)
-        cost.reference_price = round(cost.total_cost * 1.15, 2)
-        updated_count += 1
-    await db.commit()
-    return {"message": f"Synced {updated_count} records"}
+async def sync_costs_with_market(dry_run: bool = False, db: AsyncSession = Depends(get_db)):
+    """按最新铜价重算全部成本记录；dry_run=true 时只返回差异不写库"""
+    latest = copper_snapshot.require()
+    result = await reprice_costs(db, latest, dry_run=dry_run)
+    return {"message": f"Synced {result['changed']} records", **result}
+
+@admin_costs_router.post("/import")
+async def import_cost_records(file: UploadFile = File(...), upsert: bool = True, db: AsyncSession = Depends(get_db)):
+    """批量导入成本记录 (CSV / XLSX，列名同 CostCreate)；upsert=true 时按 spec_name 覆盖已有记录"""
+    return await run_import(db, file, import_cost_chunk, upsert)
 
 @admin_costs_router.post("/", response_model=CostResponse)
 async def create_cost_record(cost: CostCreate, db: AsyncSession = Depends(get_db)):
-    density = 0.214 if cost.material == "Al" else 0.7
-    total_cw = sum([(g.gauge**2 * g.strands * g.cores * density * cost.length)/100.0 for g in cost.core_structure])
-    cw = round(total_cw, 4)
-    ca = round(total_cw * cost.copper_price, 2)
-    pw = max(0.0, round(cost.total_weight - total_cw, 4))
-    pa = round(pw * cost.pvc_price, 2)
-    tc = round(ca + pa + cost.labor_cost, 2)
-    new_cost = ProductCost(**cost.dict(), copper_weight=cw, copper_amount=ca, pvc_weight=pw, pvc_amount=pa, total_cost=tc, reference_price=round(tc*1.15, 2))
+    try:
+        breakdown = cost_engine.compute_cost(
+            cost_engine.freeze_structure(cost.core_structure), cost.material, cost.length,
+            cost.total_weight, cost.copper_price, cost.pvc_price, cost.labor_cost,
+        )
+    except cost_engine.CostInputError as e:
+        raise HTTPException(status_code=422, detail=e.rows[0])
+    new_cost = ProductCost(**cost.dict(), **breakdown)
     db.add(new_cost)
     await db.commit()
     await db.refresh(new_cost)
     return new_cost
 
 @admin_costs_router.get("/", response_model=List[CostResponse])
-async def read_costs(skip: int = 0, limit: int = 100, category: str = None, search: str = None, db: AsyncSession = Depends(get_db)):
-    query = select(ProductCost).order_by(desc(ProductCost.updated_at))
+async def read_costs(response: Response, skip: int = 0, limit: int = 100, category: str = None, search: str = None, after: Optional[str] = None, db: AsyncSession = Depends(get_db)):
+    """成本记录按 id 倒序 (新建在前)；updated_at 会被改价/编辑改写，不能作为游标键"""
+    query = apply_keyset(select(ProductCost), None, ProductCost.id, after)
     if category: query = query.filter(ProductCost.category == category)
-    if search: query = query.filter(or_(ProductCost.spec_name.contains(search), ProductCost.remark.contains(search)))
-    return (await db.execute(query.offset(skip).limit(limit))).scalars().all()
+    if search:
+        # 成本列表保持 id 顺序以兼容游标分页，FTS 仅用作过滤
+        ranked = search_index.ranking("product_costs_fts", search)
+        if ranked is not None: query = query.filter(ProductCost.id.in_(select(ranked.c.id)))
+        else: query = query.filter(or_(ProductCost.spec_name.contains(search), ProductCost.remark.contains(search)))
+    if not after: query = query.offset(skip)
+    costs = (await db.execute(query.limit(limit))).scalars().all()
+    set_next_cursor(response, costs, None, limit)
+    return costs
 
 # Register Routers
 app.include_router(meta_router) # 🟢 注册新 meta 路由
@@ -1647,6 +3855,7 @@ app.include_router(specs_router)
 app.include_router(admin_costs_router)
 app.include_router(categories_router)
 app.include_router(cart_router)
+app.include_router(stream_router)
 
 # ==========================================
 # 10. Start
@@ -0,0 +1,113 @@
+"""
+测试共用夹具：整个会话使用一个临时 SQLite 库与一次 lifespan，每个用例开始前清空数据。
+main 在导入时读取配置，因此环境变量必须在导入前设置。
+"""
+import os
+import sqlite3
+import tempfile
+
+_TMP = tempfile.mkdtemp(prefix="amazon-lite-tests-")
+DB_PATH = os.path.join(_TMP, "test.db")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{DB_PATH}"
+os.environ.setdefault("SECRET_KEY", "test-secret")
+os.environ.setdefault("FIRST_SUPERUSER_PASSWORD", "admin-password")
+os.environ["BCRYPT_ROUNDS"] = "4"
+os.environ["SINA_API_URL"] = "http://127.0.0.1:9/sina"  # 行情源指向不可达地址，启动时的抓取立即失败
+os.environ["EXCHANGE_RATE_API"] = "http://127.0.0.1:9/fx"
+os.environ["MARKET_RETRIES"] = "0"
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+@pytest.fixture(scope="session")
+def app_client():
+    """整个测试会话共用一次 lifespan (线程池、调度器等在关闭后无法重启)"""
+    with TestClient(main.app) as c:
+        yield c
+
+
+@pytest.fixture
+def client(app_client):
+    """每个用例开始前清空业务数据 (保留管理员) 与进程内缓存"""
+    keep_admin = {"users": f"email != '{main.settings.FIRST_SUPERUSER}'"}
+    for table in reversed(main.Base.metadata.sorted_tables):
+        sql(f"DELETE FROM {table.name} WHERE {keep_admin.get(table.name, '1')}")
+    for cache in (main.token_claims_cache, main.principal_cache, main.tracking.cache): cache.clear()
+    main.revoked_tokens.__init__(main.settings.TOKEN_BLOCKLIST_POLL_OVERLAP)
+    main.driver_locations.__init__(main.settings.LOCATION_HISTORY_SIZE, main.settings.LOCATION_ASSIGNMENT_TTL_SECONDS)
+    main.catalog_cache.invalidate()
+
+    async def reset_counters():
+        async with main.AsyncSessionLocal() as db: await main.rebuild_status_counters(db)
+    app_client.portal.call(reset_counters)
+    return app_client
+
+
+def sql(query: str, *args):
+    con = sqlite3.connect(DB_PATH, timeout=10)
+    try:
+        rows = con.execute(query, args).fetchall()
+        con.commit()
+        return rows
+    finally:
+        con.close()
+
+
+@pytest.fixture
+def db_sql(client):
+    return sql
+
+
+def auth_headers(client, email: str, password: str) -> dict:
+    r = client.post("/api/v1/auth/login", data={"username": email, "password": password})
+    assert r.status_code == 200, r.text
+    return {"Authorization": f"Bearer {r.json()['access_token']}"}
+
+
+@pytest.fixture
+def admin(client):
+    return auth_headers(client, main.settings.FIRST_SUPERUSER, main.settings.FIRST_SUPERUSER_PASSWORD)
+
+
+@pytest.fixture
+def make_user(client):
+    """注册并登录一个用户，返回 (id, headers)"""
+    def make(email: str, role: str = "user"):
+        r = client.post("/api/v1/auth/register", json={"email": email, "password": "pw-123456", "role": role})
+        assert r.status_code == 200, r.text
+        return r.json()["id"], auth_headers(client, email, "pw-123456")
+    return make
+
+
+@pytest.fixture
+def seed_product(client):
+    """插入一个商品及其规格 (create_product 路由不用于造数)，返回规格 id 列表"""
+    def seed(name: str = "YJV 4*70+1*35", stocks=(10,), price: float = 10.0, spec_prefix: str = "spec"):
+        if not sql("SELECT id FROM categories WHERE id = 1"):
+            sql("INSERT INTO categories (id, name, path) VALUES (1, 'Power Cable', '/1/')")
+        sql("INSERT INTO products (name, description, price, is_active, category_id) VALUES (?, '', 0, 1, 1)", name)
+        pid = sql("SELECT max(id) FROM products")[0][0]
+        ids = []
+        for i, stock in enumerate(stocks):
+            sql("INSERT INTO product_variants (product_id, spec, color, price, stock, reserved, unit, sku_code, copper_weight, process_cost) "
+                "VALUES (?, ?, '黑', ?, ?, 0, '米', ?, 0, 0)", pid, f"{spec_prefix}-{i}", price, stock, f"SKU-{pid}-{i}")
+            ids.append(sql("SELECT max(id) FROM product_variants")[0][0])
+        main.catalog_cache.invalidate()
+        return ids
+    return seed
+
+
+@pytest.fixture
+def place_order(client):
+    """以指定用户把 {规格 id: 数量} 加入购物车并下单，返回订单 JSON"""
+    def place(headers: dict, quantities: dict):
+        for vid, qty in quantities.items():
+            r = client.post("/api/v1/cart/", json={"variant_id": vid, "quantity": qty}, headers=headers)
+            assert r.status_code == 200, r.text
+        r = client.post("/api/v1/orders/", headers=headers)
+        assert r.status_code == 200, r.text
+        return r.json()
+    return place
@@ -0,0 +1,58 @@
+from datetime import timedelta
+
+from jose import jwt
+
+import main
+from conftest import sql
+
+
+def bearer(token):
+    return {"Authorization": f"Bearer {token}"}
+
+
+def test_logout_only_blocklists_verified_tokens(client, admin):
+    forged = jwt.encode({"sub": main.settings.FIRST_SUPERUSER}, "not-the-secret", algorithm=main.settings.ALGORITHM)
+    no_exp = jwt.encode({"sub": main.settings.FIRST_SUPERUSER}, main.settings.SECRET_KEY, algorithm=main.settings.ALGORITHM)
+    for token in ("garbage", forged, no_exp):
+        assert client.post("/api/v1/auth/logout", headers=bearer(token)).status_code == 401
+    expired = main.create_access_token({"sub": main.settings.FIRST_SUPERUSER}, timedelta(seconds=-10))
+    assert client.post("/api/v1/auth/logout", headers=bearer(expired)).status_code == 200
+    assert sql("SELECT count(*) FROM token_blocklist") == [(0,)]
+
+    assert client.post("/api/v1/auth/logout", headers=admin).status_code == 200
+    assert client.get("/api/v1/users/me", headers=admin).status_code == 401
+    assert sql("SELECT count(*) FROM token_blocklist WHERE expires_at IS NOT NULL") == [(1,)]
+
+
+def test_load_drops_rows_without_expiry(client):
+    sql("INSERT INTO token_blocklist (token, expires_at) VALUES ('garbage', NULL)")
+
+    async def reload():
+        async with main.AsyncSessionLocal() as db: await main.revoked_tokens.load(db)
+    client.portal.call(reload)
+    assert sql("SELECT count(*) FROM token_blocklist") == [(0,)]
+    assert "garbage" not in main.revoked_tokens
+
+
+def test_read_users_me_serves_cached_principal(client, make_user):
+    user_id, headers = make_user("me@example.com", "driver")
+    for _ in range(2):  # 第二次命中 principal_cache
+        r = client.get("/api/v1/users/me", headers=headers)
+        assert r.status_code == 200, r.text
+        assert (r.json()["id"], r.json()["email"], r.json()["role"]) == (user_id, "me@example.com", "driver")
+
+
+def test_poll_picks_up_rows_committed_out_of_id_order(client):
+    exp = "2999-01-01 00:00:00"
+
+    async def poll():
+        async with main.AsyncSessionLocal() as db: await main.revoked_tokens.poll(db)
+
+    # 另一个 worker 先分配了 id 5，但 id 10 先提交
+    sql("INSERT INTO token_blocklist (id, token, expires_at) VALUES (10, 'late-high', ?)", exp)
+    client.portal.call(poll)
+    assert "late-high" in main.revoked_tokens and main.revoked_tokens.last_id == 10
+
+    sql("INSERT INTO token_blocklist (id, token, expires_at) VALUES (5, 'early-low', ?)", exp)
+    client.portal.call(poll)
+    assert "early-low" in main.revoked_tokens and main.revoked_tokens.last_id == 10
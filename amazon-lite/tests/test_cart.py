@@ -0,0 +1,35 @@
+from conftest import sql
+
+
+def cart_lines(user_id):
+    return sql("SELECT variant_id, quantity FROM cart_items WHERE user_id = ? ORDER BY id", user_id)
+
+
+def test_batch_reports_negative_quantities_per_item(client, make_user, seed_product):
+    vid, other = seed_product(stocks=(10, 10))
+    user_id, headers = make_user("buyer@example.com")
+    sql("INSERT INTO cart_items (user_id, variant_id, quantity) VALUES (?, ?, 5)", user_id, vid)
+
+    r = client.post("/api/v1/cart/batch", headers=headers, json={"items": [
+        {"variant_id": vid, "quantity": -3, "op": "add"},
+        {"variant_id": vid, "quantity": -1, "op": "set"},
+        {"variant_id": other, "quantity": 2, "op": "add"},
+    ]})
+    assert r.status_code == 200, r.text
+    assert [e["index"] for e in r.json()["errors"]] == [0, 1]
+    assert cart_lines(user_id) == [(vid, 5), (other, 2)]
+
+
+def test_batch_collapses_and_removes_duplicate_lines(client, make_user, seed_product):
+    vid, other = seed_product(stocks=(10, 10))
+    user_id, headers = make_user("buyer@example.com")
+    for variant, qty in ((vid, 1), (other, 4), (vid, 2), (other, 6)):
+        sql("INSERT INTO cart_items (user_id, variant_id, quantity) VALUES (?, ?, ?)", user_id, variant, qty)
+
+    r = client.post("/api/v1/cart/batch", headers=headers, json={"items": [
+        {"variant_id": vid, "op": "remove"},
+        {"variant_id": other, "quantity": 3, "op": "set"},
+    ]})
+    assert r.status_code == 200, r.text
+    assert r.json()["errors"] == []
+    assert cart_lines(user_id) == [(other, 3)]
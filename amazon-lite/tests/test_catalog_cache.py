@@ -0,0 +1,43 @@
+import main
+from conftest import sql
+
+
+def sync(client):
+    async def go():
+        async with main.AsyncSessionLocal() as db: await main.catalog_cache.sync(db)
+    client.portal.call(go)
+
+
+def stocks(client):
+    r = client.get("/api/v1/products/")
+    assert r.status_code == 200, r.text
+    return [v["stock"] for p in r.json() for v in p["variants"]]
+
+
+def test_write_on_another_worker_invalidates_local_cache(client, seed_product):
+    seed_product(stocks=(10,))
+    sync(client)
+    assert stocks(client) == [10]
+
+    # 另一个 worker 改了库存并递增共享版本号
+    sql("UPDATE product_variants SET stock = 3")
+    assert stocks(client) == [10]  # 本地缓存尚未得知
+    sql("UPDATE cache_versions SET version = version + 1 WHERE name = 'catalog'")
+    sync(client)
+    assert stocks(client) == [3]
+
+
+def test_local_invalidation_is_published_once(client, seed_product):
+    seed_product(stocks=(10,))
+    sync(client)
+    shared = sql("SELECT version FROM cache_versions WHERE name = 'catalog'")[0][0]
+
+    main.catalog_cache.invalidate()
+    sync(client)
+    assert sql("SELECT version FROM cache_versions WHERE name = 'catalog'") == [(shared + 1,)]
+
+    stocks(client)
+    version = main.catalog_cache.version
+    sync(client)  # 自己发布的变化不会再清空一次本地缓存
+    assert main.catalog_cache.version == version
+    assert sql("SELECT version FROM cache_versions WHERE name = 'catalog'") == [(shared + 1,)]
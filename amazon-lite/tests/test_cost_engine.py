@@ -0,0 +1,133 @@
+import random
+from datetime import datetime
+
+import pytest
+
+import main
+from conftest import sql
+from cost_engine import COST_FIELDS, DENSITY, CostInputError, PROCESS_FEES, category_surcharge, compute_cost, compute_costs_batch, copper_weight, freeze_structure
+
+GAUGES = [0.3, 0.5, 0.75, 1.13, 1.38, 1.78, 2.25, 2.52, 3.0]
+
+
+def legacy(groups, material, length, total_weight, copper_price, pvc_price, labor_cost):
+    """抽取 cost_engine 之前 main.py 中的内联公式"""
+    density = 0.214 if material == "Al" else 0.7
+    total_cw = sum([(g["gauge"] ** 2 * g["strands"] * g["cores"] * density * length) / 100.0 for g in groups])
+    cw, ca = round(total_cw, 4), round(total_cw * copper_price, 2)
+    pw = max(0.0, round(total_weight - total_cw, 4))
+    pa = round(pw * pvc_price, 2)
+    tc = round(ca + pa + labor_cost, 2)
+    return {"copper_weight": cw, "copper_amount": ca, "pvc_weight": pw, "pvc_amount": pa,
+            "total_cost": tc, "reference_price": round(tc * 1.15, 2)}
+
+
+def random_structure(rng):
+    return [{"cores": rng.randint(1, 5), "strands": rng.choice([1, 7, 19, 37]), "gauge": rng.choice(GAUGES)}
+            for _ in range(rng.randint(1, 3))]
+
+
+def test_single_and_batch_match_legacy_formula():
+    rng = random.Random(42)
+    specs = [random_structure(rng) for _ in range(300)] + [[]]
+    rows = [(rng.choice(specs), rng.choice(["Cu", "Al"]), rng.choice([100.0, 200.0, 1000.0]), round(rng.uniform(1, 800), 3),
+             round(rng.uniform(8, 12), 4), round(rng.uniform(0.5, 2), 3), round(rng.uniform(0, 60), 2)) for _ in range(20000)]
+    frozen = [(freeze_structure(r[0]),) + r[1:] for r in rows]
+    expected = [legacy(*r) for r in rows]
+
+    copper_weight.cache_clear()
+    assert [compute_cost(*r) for r in frozen] == expected
+    batch = compute_costs_batch(*zip(*frozen))
+    assert [{f: batch[f][i].item() for f in COST_FIELDS} for i in range(len(rows))] == expected
+
+
+def test_density_table_drives_copper_weight():
+    structure = ((1, 1, 10.0),)
+    assert copper_weight(structure, "Al", 100.0) == pytest.approx(DENSITY["Al"] * 100)
+    assert copper_weight(structure, "Cu", 100.0) == pytest.approx(DENSITY["Cu"] * 100)
+    assert copper_weight(structure, "unknown", 100.0) == copper_weight(structure, "Cu", 100.0)
+
+
+@pytest.mark.parametrize("category, keyword", [("bvr-2.5", "BVR"), ("RVV护套", "RVV"), ("BV 单芯", "BV"), ("YJV", None), (None, None)])
+def test_category_surcharge(category, keyword):
+    assert category_surcharge(category) == (PROCESS_FEES[keyword] if keyword else 0)
+
+
+def test_endpoints_agree_with_compute_cost(client, admin, monkeypatch):
+    rng = random.Random(7)
+    created = []
+    for i in range(40):
+        body = {"spec_name": f"S-{i}", "category": rng.choice(["BV", "BVR", "RVV", "YJV"]), "material": rng.choice(["Cu", "Al"]),
+                "core_structure": random_structure(rng), "total_weight": round(rng.uniform(1, 800), 3),
+                "length": rng.choice([100.0, 200.0]), "copper_price": 9.5, "pvc_price": round(rng.uniform(0.5, 2), 3),
+                "labor_cost": round(rng.uniform(0, 60), 2)}
+        r = client.post("/api/v1/admin/costs/", json=body, headers=admin)
+        assert r.status_code == 200, r.text
+        row = r.json()
+        args = (freeze_structure(body["core_structure"]), body["material"], body["length"], body["total_weight"],
+                body["copper_price"], body["pvc_price"], body["labor_cost"])
+        assert {f: row[f] for f in COST_FIELDS} == compute_cost(*args)
+        created.append(body)
+
+    quote = main.CopperPrice(id=1, cny_price=71230.0, usd_price=9.9, exchange_rate=7.12, updated_at=datetime.utcnow())
+    monkeypatch.setattr(main.copper_snapshot, "current", None)
+    main.copper_snapshot.publish(quote)
+    r = client.post("/api/v1/admin/costs/sync-market-prices", headers=admin)
+    assert r.status_code == 200, r.text
+    assert r.json()["scanned"] == 40
+
+    rows = {c["spec_name"]: c for c in client.get("/api/v1/admin/costs/?limit=100", headers=admin).json()}
+    for body in created:
+        row = rows[body["spec_name"]]
+        price = round(main.calculate_copper_usd_price(quote.cny_price, quote.exchange_rate, body["category"]), 4)
+        assert row["copper_price"] == price
+        expected = compute_cost(freeze_structure(body["core_structure"]), body["material"], body["length"],
+                                body["total_weight"], price, body["pvc_price"], body["labor_cost"])
+        assert {f: row[f] for f in COST_FIELDS} == expected
+
+    r = client.post("/api/v1/admin/costs/sync-market-prices?dry_run=true", headers=admin)
+    assert r.json()["changed"] == 0
+
+
+def test_bad_inputs_are_rejected_by_both_entry_points():
+    good = (((1, 7, 1.13),), "Cu", 100.0, 20.0, 9.5, 1.2, 3.0)
+    bad_weight = (((1, 7, 1.13),), "Cu", 100.0, None, 9.5, 1.2, 3.0)
+    bad_price = (((1, 7, 1.13),), "Cu", 100.0, 20.0, 9.5, float("nan"), 3.0)
+    for row in (bad_weight, bad_price):
+        with pytest.raises(CostInputError):
+            compute_cost(*row)
+    with pytest.raises(CostInputError) as exc:
+        compute_costs_batch(*zip(good, bad_weight, good, bad_price))
+    assert exc.value.rows == {1: ["total_weight is missing"], 3: ["pvc_price is not a finite number"]}
+    assert compute_cost(*good[:-1], None) == compute_cost(*good[:-1], 0.0)  # 人工费为空按 0 计
+
+
+def test_reprice_reports_rows_with_missing_inputs(client, admin, monkeypatch):
+    for i in range(3):
+        body = {"spec_name": f"S-{i}", "category": "BV", "core_structure": [{"cores": 1, "strands": 7, "gauge": 1.13}],
+                "total_weight": 20.0, "copper_price": 9.5, "pvc_price": 1.2, "labor_cost": 3.0}
+        assert client.post("/api/v1/admin/costs/", json=body, headers=admin).status_code == 200
+    sql("UPDATE product_costs SET length = NULL WHERE spec_name = 'S-1'")
+    sql("UPDATE product_costs SET core_structure = '[{\"cores\": 1}]' WHERE spec_name = 'S-2'")
+    before = sql("SELECT total_cost, copper_price FROM product_costs WHERE spec_name IN ('S-1', 'S-2') ORDER BY id")
+
+    monkeypatch.setattr(main.copper_snapshot, "current", None)
+    main.copper_snapshot.publish(main.CopperPrice(id=1, cny_price=71230.0, usd_price=9.9, exchange_rate=7.12, updated_at=datetime.utcnow()))
+    r = client.post("/api/v1/admin/costs/sync-market-prices", headers=admin)
+    assert r.status_code == 200, r.text
+    result = r.json()
+    assert (result["scanned"], result["changed"], result["failed"]) == (3, 1, 2)
+    assert [(e["spec_name"], e["errors"]) for e in result["errors"]] == [
+        ("S-1", ["length is missing"]), ("S-2", ["core_structure is malformed"])]
+    assert sql("SELECT total_cost, copper_price FROM product_costs WHERE spec_name IN ('S-1', 'S-2') ORDER BY id") == before
+
+
+def test_import_reports_non_finite_values(client, admin):
+    csv = ("spec_name,category,core_structure,total_weight,copper_price,pvc_price,labor_cost\n"
+           "OK-1,BV,1*7*1.13,20,9.5,1.2,3\n"
+           "NAN-1,BV,1*7*1.13,nan,9.5,1.2,3\n")
+    r = client.post("/api/v1/admin/costs/import", files={"file": ("costs.csv", csv.encode(), "text/csv")}, headers=admin)
+    assert r.status_code == 200, r.text
+    report = r.json()
+    assert (report["inserted"], report["failed"]) == (1, 1)
+    assert report["errors"] == [{"row": 3, "errors": ["total_weight is not a finite number"]}]
@@ -0,0 +1,58 @@
+import main
+from conftest import sql
+
+
+def delivering_order(client, place_order, seed_product, make_user, driver_id):
+    (vid,) = seed_product()
+    _, buyer = make_user("buyer@example.com")
+    order = place_order(buyer, {vid: 1})
+    sql("UPDATE orders SET status = 'DELIVERING', driver_id = ? WHERE id = ?", driver_id, order["id"])
+    return order["id"]
+
+
+def age_assignments(seconds):
+    for order_id, (driver_id, verified_at) in list(main.driver_locations._assignments.items()):
+        main.driver_locations._assignments[order_id] = (driver_id, verified_at - seconds)
+
+
+def test_reassignment_by_another_worker_takes_effect_after_ttl(client, admin, make_user, seed_product, place_order):
+    old_id, old_driver = make_user("old@example.com", "driver")
+    new_id, new_driver = make_user("new@example.com", "driver")
+    order_id = delivering_order(client, place_order, seed_product, make_user, old_id)
+    fix = {"lat": 31.2, "lng": 121.5}
+
+    assert client.post(f"/api/v1/orders/{order_id}/location", json=fix, headers=old_driver).status_code == 200
+    positions = client.get("/api/v1/orders/driver/positions", headers=admin).json()
+    assert [(p["driver_id"], p["order_ids"]) for p in positions] == [(old_id, [order_id])]
+
+    # 其他 worker 改派订单：本进程的缓存不知情，有效期内仍按旧归属处理
+    sql("UPDATE orders SET driver_id = ? WHERE id = ?", new_id, order_id)
+    assert client.post(f"/api/v1/orders/{order_id}/location", json=fix, headers=new_driver).status_code == 403
+
+    age_assignments(main.settings.LOCATION_ASSIGNMENT_TTL_SECONDS + 1)
+    assert client.post(f"/api/v1/orders/{order_id}/location", json=fix, headers=old_driver).status_code == 403
+    assert client.post(f"/api/v1/orders/{order_id}/location", json=fix, headers=new_driver).status_code == 200
+    positions = {p["driver_id"]: p["order_ids"] for p in client.get("/api/v1/orders/driver/positions", headers=admin).json()}
+    assert positions == {old_id: [], new_id: [order_id]}
+
+
+def test_completed_elsewhere_is_rejected_and_dropped_after_ttl(client, admin, make_user, seed_product, place_order):
+    driver_id, driver = make_user("driver@example.com", "driver")
+    order_id = delivering_order(client, place_order, seed_product, make_user, driver_id)
+    assert client.post(f"/api/v1/orders/{order_id}/location", json={"lat": 31.2, "lng": 121.5}, headers=driver).status_code == 200
+
+    sql("UPDATE orders SET status = 'COMPLETED' WHERE id = ?", order_id)
+    age_assignments(main.settings.LOCATION_ASSIGNMENT_TTL_SECONDS + 1)
+    assert main.driver_locations.latest_for_order(order_id) is None
+    assert order_id not in main.driver_locations._assignments
+
+    r = client.post(f"/api/v1/orders/{order_id}/location", json={"lat": 31.3, "lng": 121.6}, headers=driver)
+    assert r.status_code == 400
+    positions = client.get("/api/v1/orders/driver/positions", headers=admin).json()
+    assert [(p["driver_id"], p["order_ids"]) for p in positions] == [(driver_id, [])]
+
+    # 结单前缓冲的位置不会写到已完成的订单上
+    async def flush():
+        async with main.AsyncSessionLocal() as db: return await main.driver_locations.flush(db)
+    client.portal.call(flush)
+    assert sql("SELECT driver_lat FROM orders WHERE id = ?", order_id) == [(None,)]
@@ -0,0 +1,100 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+
+SINA = "http://sina.test/list=nf_CU0"
+FX = "http://fx.test/latest/USD"
+SINA_BODY = 'var hq_str_nf_CU0="沪铜连续,0,1,2,3,4,5,6,71230.0,9";'
+
+
+class Upstream:
+    """按顺序返回预设响应 (状态码 / 异常)，并记录请求"""
+    def __init__(self, *script):
+        self.script = list(script)
+        self.requests = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        step = self.script.pop(0) if len(self.script) > 1 else self.script[0]
+        if isinstance(step, Exception): raise step
+        if request.url.host == "fx.test": return httpx.Response(step, json={"rates": {"CNY": 7.25}})
+        return httpx.Response(step, text=SINA_BODY)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """记录退避间隔，不真正等待"""
+    delays = []
+    async def fake_sleep(delay, *args, **kwargs): delays.append(delay)
+    monkeypatch.setattr(main.asyncio, "sleep", fake_sleep)
+    monkeypatch.setattr(main.settings, "MARKET_RETRIES", 2)
+    monkeypatch.setattr(main.settings, "MARKET_BACKOFF_SECONDS", 0.5)
+    monkeypatch.setattr(main.settings, "MARKET_BREAKER_THRESHOLD", 3)
+    monkeypatch.setattr(main.settings, "MARKET_BREAKER_COOLDOWN", 300)
+    return delays
+
+
+def run(upstream, fn):
+    async def go():
+        client = main.MarketDataClient(SINA, FX, transport=httpx.MockTransport(upstream))
+        try:
+            return await fn(client)
+        finally:
+            await client.close()
+    return asyncio.run(go())
+
+
+def test_retries_with_exponential_backoff_then_succeeds(sleeps):
+    upstream = Upstream(503, httpx.ConnectTimeout("slow"), 200)
+
+    async def fetch(client):
+        return await client.fetch_copper_cny(), client.breakers["sina"].failures
+    assert run(upstream, fetch) == (71230.0, 0)
+    assert len(upstream.requests) == 3
+    assert sleeps == [0.5, 1.0]
+    assert upstream.requests[0].headers["Referer"] == "https://finance.sina.com.cn/"
+
+
+def test_breaker_opens_after_threshold_and_recovers_after_cooldown(sleeps):
+    upstream = Upstream(500)
+
+    async def scenario(client):
+        breaker = client.breakers["sina"]
+        for _ in range(3):
+            with pytest.raises(main.MarketDataError):
+                await client.fetch_copper_cny()
+        assert len(upstream.requests) == 9 and not breaker.allow()
+
+        with pytest.raises(main.MarketDataError, match="circuit open"):
+            await client.fetch_copper_cny()
+        assert len(upstream.requests) == 9  # 熔断期间不发请求
+        assert await client.get_realtime_copper_prices() is None
+
+        breaker.open_until -= main.settings.MARKET_BREAKER_COOLDOWN  # 冷却期结束
+        upstream.script = [200]
+        prices = await client.get_realtime_copper_prices()
+        return prices, breaker.failures
+    prices, failures = run(upstream, scenario)
+    assert prices["CNY"]["price"] == 71230.0 and prices["exchange_rate"] == 7.25
+    assert failures == 0
+    assert sleeps == [0.5, 1.0] * 3
+
+
+def test_fx_rate_is_cached_and_falls_back_when_source_fails(sleeps):
+    upstream = Upstream(200)
+
+    async def cached(client):
+        return [await client.fetch_usd_cny_rate() for _ in range(3)]
+    assert run(upstream, cached) == [7.25] * 3
+    assert len(upstream.requests) == 1
+
+    upstream = Upstream(httpx.ReadTimeout("down"))
+
+    async def failing(client):
+        rate = await client.fetch_usd_cny_rate()
+        return rate, client.breakers["fx"].failures
+    assert run(upstream, failing) == (main.MarketDataClient.DEFAULT_FX_RATE, 1)
+    assert len(upstream.requests) == 3
@@ -0,0 +1,38 @@
+from datetime import datetime
+
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+def create_costs(client, admin, n):
+    for i in range(n):
+        body = {"spec_name": f"BV-{i}", "category": "BV", "core_structure": [{"cores": 1, "strands": 7, "gauge": 1.13}],
+                "total_weight": 20.0, "copper_price": 9.5, "pvc_price": 1.2, "labor_cost": 3.0}
+        assert client.post("/api/v1/admin/costs/", json=body, headers=admin).status_code == 200
+
+
+def test_cost_cursor_survives_reprice_between_pages(client, admin, monkeypatch):
+    create_costs(client, admin, 7)
+    monkeypatch.setattr(main.copper_snapshot, "current", None)
+    main.copper_snapshot.publish(main.CopperPrice(id=1, cny_price=70000.0, usd_price=9.8, exchange_rate=7.1, updated_at=datetime.utcnow()))
+    seen, after = [], None
+    while True:
+        r = client.get("/api/v1/admin/costs/", params={"limit": 3, **({"after": after} if after else {})}, headers=admin)
+        assert r.status_code == 200, r.text
+        page = r.json()
+        seen += [c["spec_name"] for c in page]
+        # 翻页期间改价会改写全部记录的 updated_at (包括还没翻到的)，不应影响后续页
+        assert client.post("/api/v1/admin/costs/sync-market-prices", headers=admin).status_code == 200
+        after = r.headers.get("X-Next-Cursor")
+        if not after: break
+    assert seen == [f"BV-{i}" for i in reversed(range(7))]
+
+
+def test_cursor_with_null_timestamp_round_trips():
+    assert main.decode_cursor(main.encode_cursor(None, 42)) == (None, 42)
+    ts = datetime(2026, 1, 2, 3, 4, 5)
+    assert main.decode_cursor(main.encode_cursor(ts, 7)) == (ts, 7)
+    with pytest.raises(HTTPException):
+        main.decode_cursor("not-a-cursor")
@@ -0,0 +1,88 @@
+import asyncio
+
+import main
+from conftest import sql
+
+
+def stock_of(vid):
+    return sql("SELECT stock, reserved FROM product_variants WHERE id = ?", vid)[0]
+
+
+def expire_reservations(order_id):
+    sql("UPDATE inventory_ledger SET expires_at = '2000-01-01 00:00:00' WHERE order_id = ? AND kind = 'RESERVE'", order_id)
+
+
+def test_confirm_after_expiry_cannot_spend_stock_reserved_by_others(client, admin, make_user, seed_product, place_order):
+    (vid,) = seed_product(stocks=(5,))
+    _, alice = make_user("alice@example.com")
+    _, bob = make_user("bob@example.com")
+
+    order_a = place_order(alice, {vid: 5})
+    assert stock_of(vid) == (5, 5)
+    expire_reservations(order_a["id"])
+    client.portal.call(main.sweep_expired_reservations)
+    assert stock_of(vid) == (5, 0)
+
+    order_b = place_order(bob, {vid: 5})
+    assert stock_of(vid) == (5, 5)
+
+    r = client.patch(f"/api/v1/orders/{order_a['id']}/confirm", headers=admin)
+    assert r.status_code == 400 and "库存不足" in r.json()["detail"]
+    assert stock_of(vid) == (5, 5)
+
+    r = client.patch(f"/api/v1/orders/{order_b['id']}/confirm", headers=admin)
+    assert r.status_code == 200, r.text
+    assert stock_of(vid) == (0, 0)
+
+
+def test_sweep_racing_confirm_releases_hold_once(client, admin, make_user, seed_product, place_order):
+    (vid,) = seed_product(stocks=(10,))
+    _, alice = make_user("alice@example.com")
+    orders = [place_order(alice, {vid: 2}) for _ in range(3)]
+    for o in orders: expire_reservations(o["id"])
+    assert stock_of(vid) == (10, 6)
+
+    # 让清理任务在读出过期预留后暂停，期间确认全部订单，再放行清理任务
+    real_session, gate, paused = main.AsyncSessionLocal, asyncio.Event(), asyncio.Event()
+
+    def pausing_session():
+        db = real_session()
+        execute = db.execute
+        async def first_read_then_wait(*args, **kwargs):
+            result = await execute(*args, **kwargs)
+            if not paused.is_set():
+                paused.set()
+                await gate.wait()
+            return result
+        db.execute = first_read_then_wait
+        return db
+
+    async def race():
+        main.AsyncSessionLocal = pausing_session
+        try:
+            sweeper = asyncio.create_task(main.sweep_expired_reservations())
+            await paused.wait()
+            for o in orders:
+                async with real_session() as db:
+                    await main.confirm_order(o["id"], db, None)
+            gate.set()
+            await sweeper
+        finally:
+            main.AsyncSessionLocal = real_session
+    client.portal.call(race)
+
+    # 三笔预留均由确认结清；清理任务若重复扣回，reserved 会变成负数
+    assert stock_of(vid) == (4, 0)
+    assert sql("SELECT COUNT(*) FROM inventory_ledger WHERE kind = 'RELEASE'")[0][0] == 0
+
+
+def test_availability_rejects_oversized_requests_and_hides_deleted_variants(client, seed_product):
+    live, dropped = seed_product(stocks=(5, 5))
+    sql("UPDATE product_variants SET deleted_at = '2026-01-01 00:00:00' WHERE id = ?", dropped)
+
+    r = client.get("/api/v1/products/availability", params={"ids": [live, dropped]})
+    assert r.status_code == 200
+    assert [v["variant_id"] for v in r.json()] == [live]
+
+    r = client.get("/api/v1/products/availability", params={"ids": list(range(1, 502))})
+    assert r.status_code == 422
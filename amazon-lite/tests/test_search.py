@@ -0,0 +1,23 @@
+import main
+from conftest import sql
+
+
+def search(client, term):
+    main.catalog_cache.invalidate()
+    r = client.get("/api/v1/products/", params={"search": term})
+    assert r.status_code == 200, r.text
+    return [p["name"] for p in r.json()]
+
+
+def test_soft_deleted_variant_no_longer_matches(client, seed_product):
+    assert main.search_index.enabled
+    seed_product(name="YJV 3*95", stocks=(10, 10), spec_prefix="ZZQQ")
+    seed_product(name="BV 2.5", stocks=(10,), spec_prefix="plain")
+    assert search(client, "ZZQQ") == ["YJV 3*95"]
+
+    sql("UPDATE product_variants SET deleted_at = CURRENT_TIMESTAMP WHERE spec = 'ZZQQ-0'")
+    assert search(client, "ZZQQ") == ["YJV 3*95"]  # 仍有未删除的规格命中
+
+    sql("UPDATE product_variants SET deleted_at = CURRENT_TIMESTAMP WHERE spec LIKE 'ZZQQ-%'")
+    assert search(client, "ZZQQ") == []
+    assert search(client, "YJV 3*95") == ["YJV 3*95"]  # 商品本身仍可按名称搜到
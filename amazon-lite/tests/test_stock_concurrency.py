@@ -0,0 +1,53 @@
+import asyncio
+
+import main
+from conftest import sql
+
+
+async def run_concurrently(calls):
+    """每个调用使用独立会话 (独立连接) 并发执行，返回成功次数"""
+    async def attempt(endpoint, order_id):
+        async with main.AsyncSessionLocal() as db:
+            try:
+                await endpoint(order_id, db, None)
+                return True
+            except main.HTTPException as e:
+                assert e.status_code == 400, e.detail
+                return False
+    return sum(await asyncio.gather(*[attempt(endpoint, order_id) for endpoint, order_id in calls]))
+
+
+def test_concurrent_confirms_never_oversell(client, make_user, seed_product, place_order):
+    (vid,) = seed_product(stocks=(40,))
+    _, alice = make_user("alice@example.com")
+    orders = [place_order(alice, {vid: 2}) for _ in range(20)]
+    # 预留全部过期释放后把库存降到 15：20 个确认争抢，只能成功 7 个
+    sql("UPDATE inventory_ledger SET expires_at = '2000-01-01 00:00:00'")
+    client.portal.call(main.sweep_expired_reservations)
+    sql("UPDATE product_variants SET stock = 15 WHERE id = ?", vid)
+
+    wins = client.portal.call(run_concurrently, [(main.confirm_order, o["id"]) for o in orders])
+
+    stock, reserved = sql("SELECT stock, reserved FROM product_variants WHERE id = ?", vid)[0]
+    confirmed = sql("SELECT COUNT(*) FROM orders WHERE status = 'CONFIRMED'")[0][0]
+    assert wins == confirmed == 7
+    assert (stock, reserved) == (1, 0)
+    assert sql("SELECT COUNT(*) FROM inventory_ledger WHERE kind = 'COMMIT'")[0][0] == 7
+
+
+def test_racing_confirm_and_cancel_on_one_order_has_single_winner(client, make_user, seed_product, place_order):
+    (vid,) = seed_product(stocks=(10,))
+    _, alice = make_user("alice@example.com")
+    order_id = place_order(alice, {vid: 4})["id"]
+
+    calls = [(main.confirm_order if i % 2 else main.cancel_order, order_id) for i in range(16)]
+    wins = client.portal.call(run_concurrently, calls)
+
+    assert wins == 1
+    status = sql("SELECT status FROM orders WHERE id = ?", order_id)[0][0]
+    stock, reserved = sql("SELECT stock, reserved FROM product_variants WHERE id = ?", vid)[0]
+    assert reserved == 0
+    assert (status, stock) in (("CONFIRMED", 6), ("CANCELLED", 10))
+    # 看板计数只随获胜的那一次迁移变化
+    counts = dict(sql("SELECT status, count FROM status_counters WHERE scope = 'order'"))
+    assert counts[status.lower()] == 1 and counts["pending_confirmation"] == 0